@@ -1,9 +1,12 @@
 import time
-import struct
 import datetime
 import calendar
+import numpy as np
 import soaculib as aculib
 import scan_helpers as sh
+import broadcast_helpers as bh
+import status_helpers
+import upload_helpers as uh
 from soaculib.twisted_backend import TwistedHttpBackend
 import argparse
 import soaculib.status_keys as status_keys
@@ -31,37 +34,6 @@ def timecode(acutime):
     return comptime
 
 
-def uploadtime_to_ctime(ptstack_time, upload_year):
-    year = int(upload_year)
-    gyear = calendar.timegm(time.strptime(str(year), '%Y'))
-    day_of_year = float(ptstack_time.split(',')[0]) - 1.0
-    hour = float(ptstack_time.split(',')[1].split(':')[0])
-    minute = float(ptstack_time.split(',')[1].split(':')[1])
-    second = float(ptstack_time.split(',')[1].split(':')[2])
-    comptime = gyear + day_of_year * 60 * 60 * 24 + hour * 60 * 60 + minute * 60 + second
-    return comptime
-
-
-def pop_first_vals(data_dict, group_size):
-    new_data_dict = {}
-    for key in data_dict.keys():
-        if len(data_dict[key]):
-            new_data_dict[key] = data_dict[key][group_size:]
-        else:
-            print('no more data')
-    return new_data_dict
-
-
-def front_group(data_dict, group_size):
-    new_data_dict = {}
-    for key in data_dict.keys():
-        if len(data_dict[key]) > group_size:
-            new_data_dict[key] = data_dict[key][:group_size]
-        else:
-            new_data_dict[key] = data_dict[key]
-    return new_data_dict
-
-
 class ACUAgent:
     """
     Agent to acquire data from an ACU and control telescope pointing with the
@@ -71,10 +43,21 @@ class ACUAgent:
         acu_config (str):
             The configuration for the ACU, as referenced in aculib.configs.
             Default value is 'guess'.
+        broadcast_block_duration (float):
+            Max time span in seconds of each multi-sample block published to
+            the acu_udp_stream feed. Default value is 1.
+        status_publish_mode (str):
+            'all' to publish every status block on every query, or 'changes'
+            to publish status blocks only when one of their values changes
+            or status_heartbeat seconds have passed. Default value is 'all'.
+        status_heartbeat (float):
+            Max time in seconds between publishing unchanged status blocks in
+            'changes' mode. Default value is 10.
 
     """
 
-    def __init__(self, agent, acu_config='guess'):
+    def __init__(self, agent, acu_config='guess', broadcast_block_duration=1.,
+                 status_publish_mode='all', status_heartbeat=10.):
         self.lock = TimeoutLock()
         self.jobs = {
             'monitor': 'idle',
@@ -91,6 +74,9 @@ class ACUAgent:
         self.acu8100 = self.acu_config['status']['status_name']
         self.monitor_fields = status_keys.status_fields[self.acu_config['platform']]['status_fields']
         self.motion_limits = self.acu_config['motion_limits']
+        self.broadcast_block_duration = broadcast_block_duration
+        self.status_publish_mode = status_publish_mode
+        self.status_heartbeat = status_heartbeat
 
         self.log = agent.log
 
@@ -133,6 +119,8 @@ class ACUAgent:
         self.agent = agent
 
         self.take_data = False
+        # Time of the ACU query behind the current self.data['status']
+        self.status_query_time = 0.
 
         # self.web_agent = tclient.Agent(reactor)
         tclient._HTTP11ClientFactory.noisy = False
@@ -274,6 +262,26 @@ class ACUAgent:
                 return False
             self.jobs[job_name] = 'idle'
 
+    def _free_positions(self):
+        """
+        Returns the most recently reported number of free ProgramTrack stack
+        positions and the time the ACU was queried for it.
+        """
+        return (self.data['status']['summary']['Free_upload_positions'],
+                self.status_query_time)
+
+    def _publish_upload_stats(self, session, stats):
+        """
+        Publishes ProgramTrack upload metrics (see
+        upload_helpers.ProgramTrackUploader) and adds them to session.data.
+        """
+        session.data['upload_stats'] = dict(stats)
+        acu_upload_stats = {'timestamp': time.time(),
+                            'block_name': 'ACU_upload_stats',
+                            'data': dict(stats)
+                            }
+        self.agent.publish_to_feed('acu_upload', acu_upload_stats, from_reactor=True)
+
     #
     # The Operations
     #
@@ -289,6 +297,11 @@ class ACUAgent:
         Azimuth position, Azimuth velocity, Elevation mode, Elevation position,
         Elevation velocity, Boresight mode, and Boresight position.
 
+        With status_publish_mode set to 'changes', status blocks are only
+        published when one of their values changes or status_heartbeat
+        seconds have passed, and the influx status only carries changed
+        fields alongside the summary fields, which are always published.
+
         """
         ok, msg = self._try_set_job('monitor')
         if not ok:
@@ -298,18 +311,14 @@ class ACUAgent:
         version = yield self.acu_read.http.Version()
         self.log.info(version)
 
-        mode_key = {'Stop': 0,
-                    'Preset': 1,
-                    'ProgramTrack': 2,
-                    'Stow': 3,
-                    'SurvivalMode': 4,
-                    'Rate': 5,
-                    'StarTrack': 6,
-                    }
-        tfn_key = {'None': float('nan'),
-                   'False': 0,
-                   'True': 1,
-                   }
+        field_map = status_helpers.StatusFieldMap(self.monitor_fields)
+        influx_status = {}
+        changes_only = self.status_publish_mode == 'changes'
+        change_filter = status_helpers.ChangeFilter(self.status_heartbeat)
+        # Position, velocity and mode fields go to influx at the full rate
+        influx_fast = {f + '_influx' for f in
+                       self.monitor_fields.get('summary', {}).values()}
+        influx_fast.add('ctime_influx')
         report_t = time.time()
         report_period = 20
         n_ok = 0
@@ -344,59 +353,26 @@ class ACUAgent:
                 yield dsleep(1)
                 continue
 
-            for (key, value) in session.data.items():
-                for category in self.monitor_fields:
-                    if key in self.monitor_fields[category]:
-                        if isinstance(value, bool):
-                            self.data['status'][category][self.monitor_fields[category][key]] = int(value)
-                        elif isinstance(value, int) or isinstance(value, float):
-                            self.data['status'][category][self.monitor_fields[category][key]] = value
-                        elif value is None:
-                            self.data['status'][category][self.monitor_fields[category][key]] = float('nan')
-                        else:
-                            self.data['status'][category][self.monitor_fields[category][key]] = str(value)
-            self.data['status']['summary']['ctime'] =\
-                timecode(self.data['status']['summary']['Time'])
-
-            # influx_status refers to all other self.data['status'] keys. Do not add
-            # more keys to any self.data['status'] categories beyond this point
-            influx_status = {}
-            for category in self.data['status']:
-                if category != 'commands':
-                    for statkey, statval in self.data['status'][category].items():
-                        if isinstance(statval, float):
-                            influx_status[statkey + '_influx'] = statval
-                        elif isinstance(statval, str):
-                            if statval == 'None':
-                                influx_status[statkey + '_influx'] = float('nan')
-                            elif statval in ['True', 'False']:
-                                influx_status[statkey + '_influx'] = tfn_key[statval]
-                            else:
-                                influx_status[statkey + '_influx'] = mode_key[statval]
-                        elif isinstance(statval, int):
-                            if statkey in ['Year', 'Free_upload_positions']:
-                                influx_status[statkey + '_influx'] = float(statval)
-                            else:
-                                influx_status[statkey + '_influx'] = int(statval)
-                elif category == 'commands':
-                    if str(self.data['status']['commands']['Azimuth_commanded_position']) != 'nan':
-                        acucommand_az = {'timestamp': self.data['status']['summary']['ctime'],
-                                         'block_name': 'ACU_commanded_positions_az',
-                                         'data': {'Azimuth_commanded_position_influx': self.data['status']['commands']['Azimuth_commanded_position']}
-                                         }
-                        self.agent.publish_to_feed('acu_commands_influx', acucommand_az)
-                    if str(self.data['status']['commands']['Elevation_commanded_position']) != 'nan':
-                        acucommand_el = {'timestamp': self.data['status']['summary']['ctime'],
-                                         'block_name': 'ACU_commanded_positions_el',
-                                         'data': {'Elevation_commanded_position_influx': self.data['status']['commands']['Elevation_commanded_position']}
-                                         }
-                        self.agent.publish_to_feed('acu_commands_influx', acucommand_el)
-                    if str(self.data['status']['commands']['Boresight_commanded_position']) != 'nan':
-                        acucommand_bs = {'timestamp': self.data['status']['summary']['ctime'],
-                                         'block_name': 'ACU_commanded_positions_boresight',
-                                         'data': {'Boresight_commanded_position_influx': self.data['status']['commands']['Boresight_commanded_position']}
-                                         }
-                        self.agent.publish_to_feed('acu_commands_influx', acucommand_bs)
+            field_map.apply(session.data, self.data['status'], influx_status)
+            self.status_query_time = query_t
+            ctime = timecode(self.data['status']['summary']['Time'])
+            self.data['status']['summary']['ctime'] = ctime
+            influx_status['ctime_influx'] = ctime
+
+            commands = self.data['status']['commands']
+            for axis, block_name in [('Azimuth', 'ACU_commanded_positions_az'),
+                                     ('Elevation', 'ACU_commanded_positions_el'),
+                                     ('Boresight', 'ACU_commanded_positions_boresight')]:
+                field = axis + '_commanded_position'
+                if str(commands[field]) != 'nan':
+                    acucommand = {'timestamp': ctime,
+                                  'block_name': block_name,
+                                  'data': {field + '_influx': commands[field]}
+                                  }
+                    if changes_only and not change_filter.block(
+                            block_name, acucommand['data'], query_t):
+                        continue
+                    self.agent.publish_to_feed('acu_commands_influx', acucommand)
             if self.data['uploads']['PtStack_Time'] == '000, 00:00:00.000000':
                 self.data['uploads']['PtStack_ctime'] = self.data['status']['summary']['ctime']
 
@@ -452,14 +428,21 @@ class ACUAgent:
             acustatus_influx = {'timestamp':
                                 self.data['status']['summary']['ctime'],
                                 'block_name': 'ACU_status_INFLUX',
-                                'data': influx_status
+                                'data': dict(influx_status)
                                 }
             status_blocks = [acustatus_summary, acustatus_axisfaults, acustatus_poserrors,
                              acustatus_axislims, acustatus_axiswarn, acustatus_axisfail,
                              acustatus_axisstate, acustatus_oscalarm, acustatus_commands,
                              acustatus_acufails, acustatus_platform, acustatus_emergency]
             for block in status_blocks:
+                if changes_only and not change_filter.block(
+                        block['block_name'], block['data'], query_t):
+                    continue
                 self.agent.publish_to_feed('acu_status', block)
+            if changes_only:
+                acustatus_influx['data'] = change_filter.fields(
+                    'ACU_status_INFLUX', influx_status, query_t,
+                    always=influx_fast)
             self.agent.publish_to_feed('acu_status_influx', acustatus_influx, from_reactor=True)
 
         # self._set_job_stop('monitor')
@@ -472,83 +455,66 @@ class ACUAgent:
         """broadcast()
 
         **Process** - Read UDP data from the port specified by self.acu_config,
-        decode it, and publish to an HK feed.
+        decode it, and publish to an HK feed. Samples are published to the
+        acu_udp_stream feed in multi-sample blocks spanning up to
+        broadcast_block_duration seconds.
 
         """
         ok, msg = self._try_set_job('broadcast')
         if not ok:
             return ok, msg
         session.set_status('running')
-        FMT = self.udp_schema['format']
-        FMT_LEN = struct.calcsize(FMT)
         UDP_PORT = self.udp['port']
-        udp_data = []
-        fields = self.udp_schema['fields']
+        fields = [f.replace(' ', '_') for f in self.udp_schema['fields']]
+        udp_buffer = bh.UDPRingBuffer(
+            bh.udp_dtype(self.udp_schema['format'], fields))
+        batcher = bh.BroadcastBatcher(fields,
+                                      max_duration=self.broadcast_block_duration)
 
         class MonitorUDP(protocol.DatagramProtocol):
 
             def datagramReceived(self, data, src_addr):
-                host, port = src_addr
-                offset = 0
-                while len(data) - offset >= FMT_LEN:
-                    d = struct.unpack(FMT, data[offset:offset + FMT_LEN])
-                    udp_data.append(d)
-                    offset += FMT_LEN
+                udp_buffer.push(data)
         handler = reactor.listenUDP(int(UDP_PORT), MonitorUDP())
         while self.jobs['broadcast'] == 'run':
-            if udp_data:
-                process_data = udp_data[:200]
-                udp_data = udp_data[200:]
+            if len(udp_buffer):
+                process_data = udp_buffer.pop(200)
                 year = datetime.datetime.now().year
                 gyear = calendar.timegm(time.strptime(str(year), '%Y'))
-                if len(process_data):
-                    sample_rate = (len(process_data)
-                                   / ((process_data[-1][0] - process_data[0][0]) * 86400
-                                   + process_data[-1][1] - process_data[0][1]))
+                ctimes = bh.udp_ctimes(process_data, fields, gyear)
+                if len(process_data) > 1 and ctimes[-1] > ctimes[0]:
+                    sample_rate = len(process_data) / (ctimes[-1] - ctimes[0])
                 else:
                     sample_rate = 0.0
-                latest_az = process_data[2]
-                latest_el = process_data[3]
-                latest_az_raw = process_data[4]
-                latest_el_raw = process_data[5]
+                latest = process_data[-1]
                 session.data = {'sample_rate': sample_rate,
-                                'latest_az': latest_az,
-                                'latest_el': latest_el,
-                                'latest_az_raw': latest_az_raw,
-                                'latest_el_raw': latest_el_raw
+                                'latest_az': latest[fields[2]].item(),
+                                'latest_el': latest[fields[3]].item(),
+                                'latest_az_raw': latest[fields[4]].item(),
+                                'latest_el_raw': latest[fields[5]].item(),
+                                'dropped': udp_buffer.dropped,
                                 }
-                bcast_first = {}
-                pd0 = process_data[0]
-                pd0_gday = (pd0[0] - 1) * 86400
-                pd0_sec = pd0[1]
-                pd0_data_ctime = gyear + pd0_gday + pd0_sec
-                bcast_first['Time_bcast_influx'] = pd0_data_ctime
-                for i in range(2, len(pd0)):
-                    bcast_first[fields[i].replace(' ', '_') + '_bcast_influx'] = pd0[i]
+                bcast_first = {'Time_bcast_influx': ctimes[0].item()}
+                for f in fields[2:]:
+                    bcast_first[f + '_bcast_influx'] = process_data[f][0].item()
                 acu_broadcast_influx = {'timestamp': bcast_first['Time_bcast_influx'],
                                         'block_name': 'ACU_position_bcast_influx',
                                         'data': bcast_first,
                                         }
                 self.agent.publish_to_feed('acu_broadcast_influx', acu_broadcast_influx, from_reactor=True)
-                for d in process_data:
-                    gday = (d[0] - 1) * 86400
-                    sec = d[1]
-                    data_ctime = gyear + gday + sec
-                    self.data['broadcast']['Time'] = data_ctime
-                    for i in range(2, len(d)):
-                        self.data['broadcast'][fields[i].replace(' ', '_')] = d[i]
-                    acu_udp_stream = {'timestamp': self.data['broadcast']['Time'],
-                                      'block_name': 'ACU_broadcast',
-                                      'data': self.data['broadcast']
-                                      }
-                    # print(acu_udp_stream)
+                self.data['broadcast']['Time'] = ctimes[-1].item()
+                for f in fields[2:]:
+                    self.data['broadcast'][f] = latest[f].item()
+                for block in batcher.add(ctimes, process_data):
                     self.agent.publish_to_feed('acu_udp_stream',
-                                               acu_udp_stream, from_reactor=True)
+                                               block, from_reactor=True)
             else:
                 yield dsleep(1)
             yield dsleep(0.005)
 
         handler.stopListening()
+        for block in batcher.flush():
+            self.agent.publish_to_feed('acu_udp_stream', block, from_reactor=True)
         self._set_job_done('broadcast')
         return True, 'Acquisition exited cleanly.'
 
@@ -847,8 +813,7 @@ class ACUAgent:
         self.agent.publish_to_feed('acu_upload', acu_upload)
 
         # Follow the scan in ProgramTrack mode, then switch to Stop mode
-        all_lines = sh.ptstack_format(times, azs, els, vas, ves, azflags, elflags)
-        self.log.info('all_lines generated')
+        start_time = time.time() + 3.
         self.data['uploads']['PtStack_Lines'] = 'True'
         if azonly:
             yield self.acu_control.azmode('ProgramTrack')
@@ -858,44 +823,36 @@ class ACUAgent:
         print(m)
         self.log.info('mode is now ProgramTrack')
         if simulator:
-            group_size = len(all_lines)
+            group_size = len(times)
         else:
             group_size = 120
-        spec = {'times': times,
-                'azs': azs,
-                'els': els,
-                'vas': vas,
-                'ves': ves,
-                'azflags': azflags,
-                'elflags': elflags,
-                }
-        while len(all_lines):
-            upload_lines = all_lines[:group_size]
-            all_lines = all_lines[group_size:]
-            upload_vals = front_group(spec, group_size)
-            spec = pop_first_vals(spec, group_size)
-
-            for u in range(len(upload_vals['azs'])):
-                self.data['uploads']['PtStack_Time'] = upload_lines[u].split(';')[0]
-                self.data['uploads']['PtStack_Azimuth'] = upload_vals['azs'][u]
-                self.data['uploads']['PtStack_Elevation'] = upload_vals['els'][u]
-                self.data['uploads']['PtStack_AzVelocity'] = upload_vals['vas'][u]
-                self.data['uploads']['PtStack_ElVelocity'] = upload_vals['ves'][u]
-                self.data['uploads']['PtStack_AzFlag'] = upload_vals['azflags'][u]
-                self.data['uploads']['PtStack_ElFlag'] = upload_vals['elflags'][u]
-                self.data['uploads']['PtStack_ctime'] = uploadtime_to_ctime(self.data['uploads']['PtStack_Time'], int(self.data['status']['summary']['Year']))
-                acu_upload = {'timestamp': self.data['uploads']['PtStack_ctime'],
-                              'block_name': 'ACU_upload',
-                              'data': self.data['uploads']
-                              }
-                self.agent.publish_to_feed('acu_upload', acu_upload, from_reactor=True)
-            text = ''.join(upload_lines)
-            free_positions = self.data['status']['summary']['Free_upload_positions']
-            while free_positions < 9899:
-                free_positions = self.data['status']['summary']['Free_upload_positions']
-                yield dsleep(0.1)
-            yield self.acu_control.http.UploadPtStack(text)
-            self.log.info('Uploaded a group')
+
+        # Groups taken by the uploader but not yet uploaded
+        pending = []
+
+        def upload_groups():
+            for i in range(0, len(times), group_size):
+                group = slice(i, i + group_size)
+                upload_lines = sh.ptstack_format(
+                    times[group], azs[group], els[group], vas[group],
+                    ves[group], azflags[group], elflags[group],
+                    start_offset=start_time, generator=True)
+                pending.append(group)
+                yield upload_lines
+
+        def on_upload(upload_lines, stats):
+            group = pending.pop(0)
+            acu_upload = uh.upload_block(
+                self.data['uploads'], upload_lines,
+                np.asarray(times[group], dtype=float) + start_time,
+                azs[group], els[group], vas[group], ves[group],
+                azflags[group], elflags[group])
+            self.agent.publish_to_feed('acu_upload', acu_upload, from_reactor=True)
+            self._publish_upload_stats(session, stats)
+
+        uploader = uh.ProgramTrackUploader(self.acu_control.http.UploadPtStack,
+                                           self._free_positions, min_free=9899)
+        yield uploader.run(upload_groups(), on_upload=on_upload)
         self.log.info('No more lines to upload')
         free_positions = self.data['status']['summary']['Free_upload_positions']
         while free_positions < 9999:
@@ -979,19 +936,11 @@ class ACUAgent:
         g = sh.generate_constant_velocity_scan(az_endpoint1, az_endpoint2,
                                                az_speed, acc, el_endpoint1, el_endpoint2, el_speed)
         self.acu_control.mode('ProgramTrack')
-        while self.jobs['control'] == 'run':
-            lines = next(g)
-            current_lines = lines
-            group_size = 250
-            while len(current_lines):
-                upload_lines = current_lines[:group_size]
-                text = ''.join(upload_lines)
-                current_lines = current_lines[group_size:]
-                free_positions = self.data['status']['summary']['Free_upload_positions']
-                while free_positions < 5099:
-                    yield dsleep(0.1)
-                    free_positions = self.data['status']['summary']['Free_upload_positions']
-                yield self.acu_control.http.UploadPtStack(text)
+        uploader = uh.ProgramTrackUploader(self.acu_control.http.UploadPtStack,
+                                           self._free_positions, min_free=5099)
+        yield uploader.run(uh.line_groups(g, 250),
+                           running=lambda: self.jobs['control'] == 'run',
+                           on_upload=lambda block, stats: self._publish_upload_stats(session, stats))
         yield self.acu_control.stop()
         self._set_job_done('control')
         return True, 'Track generation ended cleanly'
@@ -1002,6 +951,16 @@ def add_agent_args(parser_in=None):
         parser_in = argparse.ArgumentParser()
     pgroup = parser_in.add_argument_group('Agent Options')
     pgroup.add_argument("--acu_config")
+    pgroup.add_argument("--broadcast-block-duration", type=float, default=1.,
+                        help="Max time span in seconds of each multi-sample "
+                             "block published to the acu_udp_stream feed.")
+    pgroup.add_argument("--status-publish-mode", default='all',
+                        choices=['all', 'changes'],
+                        help="Publish every status block on every query, or "
+                             "only blocks whose values have changed.")
+    pgroup.add_argument("--status-heartbeat", type=float, default=10.,
+                        help="Max time in seconds between publishing "
+                             "unchanged status blocks in 'changes' mode.")
     return parser_in
 
 
@@ -1010,6 +969,9 @@ if __name__ == '__main__':
     args = site_config.parse_args(agent_class='ACUAgent', parser=parser)
 
     agent, runner = ocs_agent.init_site_agent(args)
-    acu_agent = ACUAgent(agent, args.acu_config)
+    acu_agent = ACUAgent(agent, args.acu_config,
+                         broadcast_block_duration=args.broadcast_block_duration,
+                         status_publish_mode=args.status_publish_mode,
+                         status_heartbeat=args.status_heartbeat)
 
     runner.run(agent, auto_reconnect=True)
@@ -0,0 +1,232 @@
+import re
+import struct
+
+import numpy as np
+
+
+_BYTE_ORDERS = {'<': '<', '>': '>', '!': '>', '=': '=', '@': '='}
+_INT_CODES = 'bhilqn'
+_UINT_CODES = 'BHILQN'
+_FLOAT_CODES = 'efd'
+
+
+def udp_dtype(fmt, fields):
+    """
+    Produces a structured numpy dtype that decodes records in the same way as
+    ``struct.unpack(fmt, ...)``, including any alignment padding, so that a
+    whole datagram can be decoded with a single ``np.frombuffer``.
+
+    Parameters:
+        fmt (str): struct format string of a single record, such as the
+            ``format`` of the ACU UDP stream schema
+        fields (list): Names of each value in the record
+
+    Returns:
+        np.dtype: Structured dtype with one field per value
+    """
+    order = _BYTE_ORDERS.get(fmt[:1], '=')
+    prefix = fmt[:1] if fmt[:1] in _BYTE_ORDERS else '@'
+    codes = []
+    for count, code in re.findall(r'(\d*)([a-zA-Z?])', fmt):
+        count = int(count) if count else 1
+        if code == 's':
+            codes.append(f'{count}s')
+        elif code != 'x':
+            codes.extend([code] * count)
+        else:
+            codes.append(f'{count}x')
+
+    formats, offsets = [], []
+    sofar = ''
+    for code in codes:
+        sofar += code
+        if code.endswith('x'):
+            continue
+        size = struct.calcsize(prefix + code)
+        # The end of this item, minus its size, gives its aligned offset
+        offsets.append(struct.calcsize(prefix + sofar) - size)
+        c = code[-1]
+        if c == 's':
+            formats.append(f'S{size}')
+        elif c == '?':
+            formats.append('?')
+        elif c in _INT_CODES:
+            formats.append(f'{order}i{size}')
+        elif c in _UINT_CODES:
+            formats.append(f'{order}u{size}')
+        elif c in _FLOAT_CODES:
+            formats.append(f'{order}f{size}')
+        else:
+            raise ValueError(f"Unsupported struct code {c!r} in {fmt!r}")
+
+    if len(formats) != len(fields):
+        raise ValueError(f"Format {fmt!r} has {len(formats)} values but "
+                         f"{len(fields)} fields were given")
+    return np.dtype({'names': list(fields), 'formats': formats, 'offsets': offsets,
+                     'itemsize': struct.calcsize(fmt)})
+
+
+class UDPRingBuffer:
+    """
+    Preallocated ring buffer of decoded UDP broadcast records. Datagrams are
+    copied into the ring as raw bytes, which the structured dtype decodes in
+    place, and records are read back out as structured arrays.
+
+    Parameters:
+        dtype (np.dtype): Structured dtype of a single record (see
+            ``udp_dtype``)
+        size (int): Max number of records to hold. If the buffer is full,
+            the oldest records are overwritten.
+
+    Attributes:
+        dropped (int): Number of records that have been overwritten before
+            being read.
+    """
+
+    def __init__(self, dtype, size=10000):
+        self.dtype = np.dtype(dtype)
+        self.buf = np.zeros(size, dtype=self.dtype)
+        self._raw = memoryview(self.buf.view(np.uint8))
+        self.size = size
+        self.start = 0
+        self.count = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, data):
+        """
+        Decodes all complete records in a datagram and adds them to the
+        buffer. Trailing partial records are ignored.
+
+        Parameters:
+            data (bytes): Datagram contents
+        """
+        itemsize = self.dtype.itemsize
+        n = len(data) // itemsize
+        if n == 0:
+            return
+        data = memoryview(data)[:n * itemsize]
+        if n > self.size:
+            self.dropped += n - self.size
+            data = data[-self.size * itemsize:]
+            n = self.size
+
+        # Copy the raw bytes straight into the ring; the structured dtype
+        # decodes them in place.
+        end = (self.start + self.count) % self.size
+        first = min(n, self.size - end)
+        self._raw[end * itemsize:(end + first) * itemsize] = data[:first * itemsize]
+        if first < n:
+            self._raw[:(n - first) * itemsize] = data[first * itemsize:]
+
+        overflow = max(self.count + n - self.size, 0)
+        self.dropped += overflow
+        self.start = (self.start + overflow) % self.size
+        self.count += n - overflow
+
+    def pop(self, n=None):
+        """
+        Removes and returns the oldest records from the buffer.
+
+        Parameters:
+            n (int or None): Max number of records to return. Returns all
+                buffered records if None.
+
+        Returns:
+            np.ndarray: Structured array of records
+        """
+        n = self.count if n is None else min(n, self.count)
+        stop = self.start + n
+        if stop <= self.size:
+            recs = self.buf[self.start:stop].copy()
+        else:
+            recs = np.concatenate([self.buf[self.start:],
+                                   self.buf[:stop - self.size]])
+        self.start = (self.start + n) % self.size
+        self.count -= n
+        return recs
+
+
+def udp_ctimes(recs, fields, gyear):
+    """
+    Computes ctimes of decoded broadcast records, whose first two fields are
+    the day of the year and the seconds of that day.
+
+    Parameters:
+        recs (np.ndarray): Structured array of records
+        fields (list): Field names of the records
+        gyear (float): ctime of the start of the current year
+
+    Returns:
+        np.ndarray: ctime of each record
+    """
+    return gyear + (recs[fields[0]] - 1) * 86400 + recs[fields[1]]
+
+
+class BroadcastBatcher:
+    """
+    Collects decoded broadcast records and groups them into multi-sample
+    blocks for the ``acu_udp_stream`` feed, so the stream is published as a
+    few messages per second rather than one message per sample.
+
+    Parameters:
+        fields (list): Field names of the records. The first two (day and
+            seconds of day) are replaced by a ``Time`` column.
+        max_duration (float): Max time span of a single block in seconds.
+            Blocks are released once the buffered samples span this long.
+        block_name (str): Block name of published messages
+
+    """
+
+    def __init__(self, fields, max_duration=1., block_name='ACU_broadcast'):
+        self.fields = list(fields[2:])
+        self.max_duration = max_duration
+        self.block_name = block_name
+        self._times = []
+        self._recs = []
+
+    def add(self, ctimes, recs):
+        """
+        Adds records to the buffer.
+
+        Parameters:
+            ctimes (np.ndarray): ctime of each record
+            recs (np.ndarray): Structured array of records
+
+        Returns:
+            list: Completed blocks, or an empty list if the buffered samples
+            don't yet span ``max_duration``.
+        """
+        if len(ctimes) == 0:
+            return []
+        self._times.append(np.asarray(ctimes, dtype=float))
+        self._recs.append(recs)
+        if self._times[-1][-1] - self._times[0][0] < self.max_duration:
+            return []
+        return self.flush()
+
+    def flush(self):
+        """
+        Returns all buffered records as a list of blocks, each spanning less
+        than ``max_duration``, and clears the buffer.
+        """
+        if not self._times:
+            return []
+        times = np.concatenate(self._times)
+        recs = np.concatenate(self._recs)
+        self._times, self._recs = [], []
+
+        bins = np.floor((times - times[0]) / self.max_duration)
+        splits = np.flatnonzero(np.diff(bins)) + 1
+        blocks = []
+        for i0, i1 in zip(np.r_[0, splits], np.r_[splits, len(times)]):
+            ts = times[i0:i1].tolist()
+            data = {'Time': ts}
+            for f in self.fields:
+                data[f] = recs[f][i0:i1].tolist()
+            blocks.append({'timestamps': ts,
+                           'block_name': self.block_name,
+                           'data': data})
+        return blocks
@@ -4,7 +4,7 @@ import time
 
 def constant_velocity_scanpoints(azpts, el, azvel, acc, ntimes):
     """
-    Produces lists of times, azimuths, elevations, azimuthal velocities,
+    Produces arrays of times, azimuths, elevations, azimuthal velocities,
     elevation velocities, azimuth motion flags, and elevation motion flags
     for a finitely long azimuth scan with constant velocity. Scan begins
     at the first azpts value.
@@ -20,7 +20,7 @@ def constant_velocity_scanpoints(azpts, el, azvel, acc, ntimes):
             return to left.
 
     Returns:
-        tuple of lists : (times, azimuths, elevations, azimuth veolicities,
+        tuple of arrays : (times, azimuths, elevations, azimuth veolicities,
         elevation velocities, azimuth flags, elevation flags)
     """
     if float(azvel) == 0.0:
@@ -35,53 +35,38 @@ def constant_velocity_scanpoints(azpts, el, azvel, acc, ntimes):
     if num_dirpoints < 2:
         print('Scan is too short to run')
         return False
+
+    # Each leg starts a turnaround after the end of the previous one
+    sect_start_times = np.empty(ntimes)
     sect_start_time = 0.0
-    conctimes = []
-    concaz = []
-    el1 = np.linspace(el, el, num_dirpoints)
-    concel = list(el1)
-    concva = []
-    ve1 = np.zeros(num_dirpoints)
-    concve = list(ve1)
+    for n in range(ntimes):
+        sect_start_times[n] = sect_start_time
+        sect_start_time = (sect_start_time + tot_time_dir) + turn_time
+
+    npts = ntimes * num_dirpoints
+    conctimes = np.linspace(sect_start_times, sect_start_times + tot_time_dir,
+                            num_dirpoints, axis=1).reshape(npts)
+    concaz = np.empty((ntimes, num_dirpoints))
+    concaz[0::2] = np.linspace(azpts[0], azpts[1], num_dirpoints)
+    concaz[1::2] = np.linspace(azpts[1], azpts[0], num_dirpoints)
+    concva = np.empty((ntimes, num_dirpoints))
+    concva[0::2] = np.sign(azpts[1] - azpts[0]) * azvel
+    concva[1::2] = np.sign(azpts[0] - azpts[1]) * azvel
+    concel = np.full(npts, float(el))
+    concve = np.zeros(npts)
 
     # Flag values:
     # 0 : unidentified portion of the scan
     # 1 : constant velocity, with the next point at the same velocity
     # 2 : final point before a turnaround
-    azflags = [1 for i in range(num_dirpoints - 1)]
-    azflags += [2]
-    all_azflags = []
-
-    elflags = [0 for i in range(num_dirpoints)]
-    all_elflags = []
-
-    for n in range(ntimes):
-        # print(str(n)+' '+str(sect_start_time))
-        end_dir_time = sect_start_time + tot_time_dir
-        time_for_section = np.linspace(sect_start_time, end_dir_time,
-                                       num_dirpoints)
-        if n % 2 != 0:
-            new_az = np.linspace(azpts[1], azpts[0], num_dirpoints)
-            new_va = np.zeros(num_dirpoints) + \
-                np.sign(azpts[0] - azpts[1]) * azvel
-        else:
-            new_az = np.linspace(azpts[0], azpts[1], num_dirpoints)
-            new_va = np.zeros(num_dirpoints) + \
-                np.sign(azpts[1] - azpts[0]) * azvel
-
-        conctimes.extend(time_for_section)
-        concaz.extend(new_az)
-        concel.extend(el1)
-        concva.extend(new_va)
-        concve.extend(ve1)
-        all_azflags.extend(azflags)
-        all_elflags.extend(elflags)
-        sect_start_time = time_for_section[-1] + turn_time
-
+    all_azflags = np.ones((ntimes, num_dirpoints), dtype=int)
+    all_azflags[:, -1] = 2
+    all_azflags = all_azflags.reshape(npts)
     all_azflags[-1] = 0
+    all_elflags = np.zeros(npts, dtype=int)
 
-    return conctimes, concaz, concel, concva, concve, all_azflags, \
-        all_elflags
+    return conctimes, concaz.reshape(npts), concel, concva.reshape(npts), \
+        concve, all_azflags, all_elflags
 
 
 def from_file(filename):
@@ -125,6 +110,130 @@ def from_file(filename):
     return conctimes, concaz, concel, concva, concve, az_flags, el_flags
 
 
+def _right_align(strs, width=None):
+    """
+    Packs a list of strings into a right-aligned uint8 character array,
+    padded on the left with zeros.
+    """
+    if width is None:
+        width = max((len(s) for s in strs), default=0)
+    packed = np.array([s.rjust(width, '\0') for s in strs], dtype=f'S{width}')
+    return packed.view(np.uint8).reshape(len(strs), width)
+
+
+# Zero-filled character codes for 0-999, packed into 4 bytes so that digits
+# can be looked up three at a time with a single 1D gather
+_DIGITS = np.frombuffer(
+    ''.join('0%03d' % i for i in range(1000)).encode(), dtype=np.uint32
+)
+
+
+def _digit_chars(v, ndigits):
+    """
+    Returns a uint8 character array of the zero-filled decimal digits of
+    non-negative integers.
+    """
+    out = np.empty((len(v), ndigits), dtype=np.uint8)
+    for end in range(ndigits, 0, -3):
+        start = max(end - 3, 0)
+        v, r = np.divmod(v, 1000)
+        chars = _DIGITS[r].view(np.uint8).reshape(-1, 4)
+        out[:, start:end] = chars[:, 4 - (end - start):]
+    return out
+
+
+def _fixed_chars(x, decimals):
+    """
+    Formats values as ``'%.<decimals>f'`` into a right-aligned uint8 character
+    array, padded on the left with zeros. Each row is identical to
+    ``'%.*f' % (decimals, x)``, which rounds the exact binary value of x to
+    the nearest decimal, with exact ties rounded to even, and keeps the sign
+    of negative values that round to zero (e.g. ``-0.000000``).
+
+    Values are rounded as ``rint(|x| * 10**decimals)``, which is split into
+    integer and fractional digits, so carries (e.g. 359.9999996 to
+    360.000000) propagate into the integer part. The product is rounded by
+    at most half an ulp, so this only differs from the correct rounding when
+    it lies within an ulp of a tie. Values within 2 ulp of a tie, values of
+    2**52 or more after scaling, and nan and inf are formatted with ``'%.*f'``
+    instead.
+    """
+    x = np.asarray(x, dtype=float)
+    n, scale = len(x), 10**decimals
+    with np.errstate(invalid='ignore', over='ignore'):
+        y = np.abs(x) * scale
+        slow = ~(y < 2**52) | (np.abs(y - np.floor(y) - 0.5) <= 2 * np.spacing(y))
+    y[slow] = 0
+    ip, fp = np.divmod(np.rint(y).astype(np.int64), scale)
+
+    ndig = np.ones(n, dtype=int)
+    k = 10
+    while n and k <= ip.max():
+        ndig += ip >= k
+        k *= 10
+    nint = int(ndig.max(initial=1))
+
+    slow_strs = ['%.*f' % (decimals, v) for v in x[slow]]
+    width = max([nint + decimals + 2] + [len(s) for s in slow_strs])
+    out = np.zeros((n, width), dtype=np.uint8)
+    out[:, width - decimals:] = _digit_chars(fp, decimals)
+    out[:, width - decimals - 1] = ord('.')
+    int_chars = _digit_chars(ip, nint)
+    int_chars[np.arange(nint) < (nint - ndig)[:, None]] = 0
+    out[:, width - decimals - 1 - nint:width - decimals - 1] = int_chars
+    neg = np.flatnonzero(np.signbit(x))
+    out[neg, width - decimals - 2 - ndig[neg]] = ord('-')
+    if slow_strs:
+        out[slow] = _right_align(slow_strs, width)
+    return out
+
+
+def _str_chars(vals):
+    """
+    Formats values with ``str`` into a right-aligned uint8 character array.
+    Each distinct value is only formatted once.
+    """
+    _, first_idxs, inv = np.unique(
+        np.asarray(vals), return_index=True, return_inverse=True)
+    return _right_align([str(vals[i]) for i in first_idxs])[inv.ravel()]
+
+
+def _run_starts(x):
+    """Returns the start index of each run of equal values in x"""
+    return np.concatenate([[0], np.flatnonzero(x[1:] != x[:-1]) + 1])
+
+
+def _ptstack_lines(times, concaz, concel, concva, concve, az_flags, el_flags):
+    """
+    Formats ProgramTrack lines in bulk. Each field is formatted for all points
+    at once into a character array, and the ``%j, %H:%M`` time prefix is only
+    computed when the minute changes. The result is identical to formatting
+    each line with ``time.strftime`` and ``str.format``.
+    """
+    n = len(times)
+    if n == 0:
+        return []
+    secs = np.floor(times)
+    starts = _run_starts(secs // 60)
+    prefixes = _right_align([time.strftime('%j, %H:%M:', time.gmtime(t))
+                             for t in secs[starts]])
+    prefixes = np.repeat(prefixes, np.diff(np.append(starts, n)), axis=0)
+    ss = (secs % 60).astype(np.uint8)
+
+    def literal(s):
+        return np.broadcast_to(np.frombuffer(s, dtype=np.uint8), (n, len(s)))
+
+    sep = literal(b'; ')
+    chars = np.hstack([
+        prefixes, ss[:, None] // np.uint8([10, 1]) % 10 + 48,
+        _fixed_chars(times % 1., 6)[:, -7:], sep,
+        _fixed_chars(concaz, 6), sep, _fixed_chars(concel, 6), sep,
+        _fixed_chars(concva, 4), sep, _fixed_chars(concve, 4), sep,
+        _str_chars(az_flags), sep, _str_chars(el_flags), literal(b'\r\n'),
+    ])
+    return chars[chars != 0].tobytes().decode().splitlines(keepends=True)
+
+
 def ptstack_format(conctimes, concaz, concel, concva, concve, az_flags,
                    el_flags, start_offset=3., generator=False):
     """
@@ -151,23 +260,60 @@ def ptstack_format(conctimes, concaz, concel, concva, concve, az_flags,
         list: Lines in the correct format to upload to the ACU
     """
 
-    fmt = '%j, %H:%M:%S'
     if generator:
         start_time = start_offset
     else:
         start_time = time.time() + start_offset
-    true_times = [start_time + i for i in conctimes]
-    fmt_times = [time.strftime(fmt, time.gmtime(t))
-                 + ('{tt:.6f}'.format(tt=t % 1.))[1:] for t in true_times]
+    true_times = np.asarray(conctimes, dtype=float) + start_time
+    # Extra values beyond the number of times are ignored
+    n = len(true_times)
+    return _ptstack_lines(true_times, *[np.asarray(x)[:n] for x in
+                                        (concaz, concel, concva, concve,
+                                         az_flags, el_flags)])
+
+
+def _constant_velocity_leg(t, az, increasing, az_min, az_max, daz, az_speed,
+                           step_time):
+    """
+    Computes the times and azimuths of one leg of a constant-velocity scan,
+    from ``az`` up to and including the point at the endpoint, before the
+    turnaround. Positions and times are accumulated with the same sequence of
+    floating point operations as stepping through the leg point by point.
+
+    Returns:
+        tuple: (times, azimuths) arrays for the leg
+    """
+    if increasing:
+        step, limit, end = daz, az_max - 2 * daz, az_max
+    else:
+        step, limit, end = -daz, az_min + 2 * daz, az_min
 
-    all_lines = [('{ftime}; {az:.6f}; {el:.6f}; {azvel:.4f}; '
-                  '{elvel:.4f}; {azflag}; {elflag}'
-                  '\r\n'.format(ftime=fmt_times[n], az=concaz[n],
-                                el=concel[n], azvel=concva[n], elvel=concve[n],
-                                azflag=az_flags[n], elflag=el_flags[n]))
-                 for n in range(len(fmt_times))]
+    # Steps are taken until the position is within two steps of the endpoint
+    n = int(np.ceil(abs(end - az) / daz)) + 2
+    while True:
+        azs = np.full(n, step)
+        azs[0] = az
+        np.add.accumulate(azs, out=azs)
+        stepping = azs <= limit if increasing else azs >= limit
+        if not stepping.all():
+            break
+        n *= 2
+    nsteps = np.argmin(stepping) + 1
+    azs = azs[:nsteps + 1]
+    azs[nsteps] = end
 
-    return all_lines
+    times = np.full(nsteps + 1, step_time)
+    times[0] = t
+    np.add.accumulate(times[:nsteps], out=times[:nsteps])
+    if increasing:
+        az_remaining = az_max - azs[nsteps - 1]
+    else:
+        az_remaining = azs[nsteps - 1] - az_min
+    time_remaining = az_remaining / az_speed
+    t_end = times[nsteps - 1] + step_time
+    t_end += (time_remaining - step_time)
+    times[nsteps] = t_end
+    return times, azs
 
 
 def generate_constant_velocity_scan(az_endpoint1, az_endpoint2, az_speed,
@@ -231,10 +377,8 @@ def generate_constant_velocity_scan(az_endpoint1, az_endpoint2, az_speed,
     el_flag = 0
     if az < az_endpoint2:
         increasing = True
-        az_vel = az_speed
     elif az > az_endpoint2:
         increasing = False
-        az_vel = -1 * az_speed
     else:
         raise ValueError('Need two different motion endpoints')
     if num_batches is None:
@@ -242,78 +386,41 @@ def generate_constant_velocity_scan(az_endpoint1, az_endpoint2, az_speed,
     else:
         stop_iter = num_batches
         batch_size = int(np.ceil((az_max - az_min) / daz))
+
+    # Whole legs are computed at once and buffered until there are enough
+    # points for a batch
+    buf = [np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=int)]
     i = 0
     while i < stop_iter:
         i += 1
-        point_block = [[], [], [], [], [], [], []]
-        for j in range(batch_size):
-            point_block[0].append(t + t0)
-            point_block[1].append(az)
-            point_block[2].append(el)
-            point_block[3].append(az_vel)
-            point_block[4].append(el_vel)
-            point_block[5].append(az_flag)
-            point_block[6].append(el_flag)
-            t += step_time
-            if increasing:
-                if az <= (az_max - 2 * daz):
-                    az += daz
-                    az_vel = az_speed
-                    el_vel = el_speed
-                    az_flag = 1
-                    el_flag = 0
-                    increasing = True
-                elif az == az_max:
-                    t += turntime
-                    az_vel = -1 * az_speed
-                    el_vel = el_speed
-                    az_flag = 1
-                    el_flag = 0
-                    increasing = False
-                else:
-                    az_remaining = az_max - az
-                    time_remaining = az_remaining / az_speed
-                    az = az_max
-                    t += (time_remaining - step_time)
-                    az_vel = az_speed
-                    el_vel = el_speed
-                    az_flag = 2
-                    el_flag = 0
-                    increasing = True
-            else:
-                if az >= (az_min + 2 * daz):
-                    az -= daz
-                    az_vel = -1 * az_speed
-                    el_vel = el_speed
-                    az_flag = 1
-                    el_flag = 0
-                    increasing = False
-                elif az == az_min:
-                    t += turntime
-                    az_vel = az_speed
-                    el_vel = el_speed
-                    az_flag = 1
-                    el_flag = 0
-                    increasing = True
-                else:
-                    az_remaining = az - az_min
-                    time_remaining = az_remaining / az_speed
-                    az = az_min
-                    t += (time_remaining - step_time)
-                    az_vel = -1 * az_speed
-                    el_vel = el_speed
-                    az_flag = 2
-                    el_flag = 0
-                    increasing = False
+        while len(buf[0]) < batch_size:
+            times, azs = _constant_velocity_leg(
+                t, az, increasing, az_min, az_max, daz, az_speed, step_time)
+            az_vels = np.full(len(azs), az_speed if increasing else -1 * az_speed)
+            az_flags = np.ones(len(azs), dtype=int)
+            az_flags[0] = az_flag
+            az_flags[-1] = 2
+            buf = [np.concatenate([col, leg]) for col, leg
+                   in zip(buf, [times, azs, az_vels, az_flags])]
+
+            # Turnaround at the endpoint
+            t = times[-1] + step_time
+            t += turntime
+            az = azs[-1]
+            az_flag = 1
+            increasing = not increasing
+
+        batch = [col[:batch_size] for col in buf]
+        buf = [col[batch_size:] for col in buf]
+        point_block = [
+            (batch[0] + t0).tolist(), batch[1].tolist(), [el] * batch_size,
+            batch[2].tolist(), [el_vel] * batch_size, batch[3].tolist(),
+            [el_flag] * batch_size
+        ]
         if ptstack_fmt:
-            yield ptstack_format(point_block[0], point_block[1],
-                                 point_block[2], point_block[3],
-                                 point_block[4], point_block[5],
-                                 point_block[6], generator=True)
+            yield ptstack_format(*point_block, generator=True)
         else:
-            yield (point_block[0], point_block[1], point_block[2],
-                   point_block[3], point_block[4], point_block[5],
-                   point_block[6])
+            yield tuple(point_block)
 
 
 # if __name__ == "__main__":
@@ -0,0 +1,174 @@
+MODE_KEY = {'Stop': 0,
+            'Preset': 1,
+            'ProgramTrack': 2,
+            'Stow': 3,
+            'SurvivalMode': 4,
+            'Rate': 5,
+            'StarTrack': 6,
+            }
+TFN_KEY = {'None': float('nan'),
+           'False': 0,
+           'True': 1,
+           }
+INFLUX_STR_KEY = dict(MODE_KEY, **TFN_KEY)
+
+# Status fields that are integers in the ACU dataset but are published to
+# influx as floats
+INFLUX_FLOAT_FIELDS = ('Year', 'Free_upload_positions')
+
+
+def _nan(value):
+    return float('nan')
+
+
+def _same(value):
+    return value
+
+
+# Converts values from the ACU dataset, keyed on their type. Anything not
+# listed here is converted to str.
+STATUS_CONVERTERS = {bool: int,
+                     int: _same,
+                     float: _same,
+                     type(None): _nan,
+                     }
+
+
+def _influx_value(value):
+    if type(value) is str:
+        return INFLUX_STR_KEY[value]
+    return value
+
+
+def _influx_float_value(value):
+    if type(value) is int:
+        return float(value)
+    return _influx_value(value)
+
+
+class StatusFieldMap:
+    """
+    Precompiled mapping from ACU dataset keys to the status fields they are
+    stored in, so that each ``Values`` response is processed in a single pass
+    over its keys.
+
+    Parameters:
+        monitor_fields (dict): Maps each status category to a dict mapping
+            ACU dataset keys to output field names, as in
+            ``soaculib.status_keys``.
+        influx_exclude (tuple): Categories that aren't included in the influx
+            status block.
+
+    Attributes:
+        fields (dict): Maps each monitored dataset key to a tuple of
+            ``(category, field, influx_key, influx_converter)`` targets.
+            ``influx_key`` is None for excluded categories.
+
+    """
+
+    def __init__(self, monitor_fields, influx_exclude=('commands',)):
+        self.fields = {}
+        for category, keys in monitor_fields.items():
+            for key, field in keys.items():
+                if category in influx_exclude:
+                    target = (category, field, None, None)
+                else:
+                    conv = (_influx_float_value if field in INFLUX_FLOAT_FIELDS
+                            else _influx_value)
+                    target = (category, field, field + '_influx', conv)
+                self.fields[key] = self.fields.get(key, ()) + (target,)
+
+    def apply(self, values, status, influx):
+        """
+        Converts the monitored values of an ACU dataset response and stores
+        them in the status and influx dicts.
+
+        Parameters:
+            values (dict): ``Values`` response from the ACU
+            status (dict): Maps each category to the dict of its status
+                fields, updated in place.
+            influx (dict): Flat dict of influx status fields, updated in
+                place.
+        """
+        fields = self.fields
+        converters = STATUS_CONVERTERS
+        for key, value in values.items():
+            targets = fields.get(key)
+            if targets is None:
+                continue
+            value = converters.get(type(value), str)(value)
+            for category, field, influx_key, influx_conv in targets:
+                status[category][field] = value
+                if influx_key is not None:
+                    influx[influx_key] = influx_conv(value)
+
+
+def _equal(a, b):
+    return a == b or (a != a and b != b)
+
+
+class ChangeFilter:
+    """
+    Tracks the last published contents of status blocks, for publishing
+    slowly varying blocks only when their values change.
+
+    Parameters:
+        heartbeat (float): Max time in seconds between publishing a block,
+            even if none of its values have changed.
+
+    """
+
+    def __init__(self, heartbeat=10.):
+        self.heartbeat = heartbeat
+        self._last = {}
+
+    def _expired(self, name, now):
+        last = self._last.get(name)
+        return last is None or now - last[1] >= self.heartbeat
+
+    def block(self, name, data, now):
+        """
+        Checks whether a block should be published, and if so records its
+        contents as published.
+
+        Parameters:
+            name (str): Block name
+            data (dict): Block data
+            now (float): Current time
+
+        Returns:
+            bool: True if any value has changed since the block was last
+            published, or the heartbeat interval has passed.
+        """
+        if not self._expired(name, now):
+            last = self._last[name][0]
+            if last == data or (last.keys() == data.keys() and all(
+                    _equal(last[k], v) for k, v in data.items())):
+                return False
+        self._last[name] = (dict(data), now)
+        return True
+
+    def fields(self, name, data, now, always=()):
+        """
+        Selects the fields of a block that should be published, and records
+        them as published.
+
+        Parameters:
+            name (str): Block name
+            data (dict): Block data
+            now (float): Current time
+            always (set): Fields that are always published
+
+        Returns:
+            dict: Fields that have changed since they were last published
+            or are listed in ``always``. All fields are returned if the
+            heartbeat interval has passed.
+        """
+        if self._expired(name, now):
+            self._last[name] = (dict(data), now)
+            return dict(data)
+        last = self._last[name][0]
+        out = {k: v for k, v in data.items()
+               if k in always or k not in last or not _equal(last[k], v)}
+        last.update(out)
+        return out
@@ -0,0 +1,172 @@
+from collections import deque
+
+import numpy as np
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks, maybeDeferred
+
+
+def line_groups(batches, group_size):
+    """
+    Regroups an iterable of batches of ProgramTrack lines into groups of
+    ``group_size`` lines, without copying the rest of the scan for each
+    group. The final group may be shorter.
+
+    Parameters:
+        batches (iterable): Iterable of lists of lines, such as the output of
+            scan_helpers.generate_constant_velocity_scan
+        group_size (int): Number of lines per group
+
+    Yields:
+        list: Lines to upload in a single UploadPtStack call
+    """
+    leftover = []
+    for batch in batches:
+        i = 0
+        if leftover:
+            i = group_size - len(leftover)
+            leftover = leftover + list(batch[:i])
+            if len(leftover) < group_size:
+                continue
+            yield leftover
+        while i + group_size <= len(batch):
+            yield batch[i:i + group_size]
+            i += group_size
+        leftover = list(batch[i:])
+    if leftover:
+        yield leftover
+
+
+def upload_block(uploads, lines, ctimes, azs, els, vas, ves, azflags,
+                 elflags, block_name='ACU_upload'):
+    """
+    Summarizes a group of uploaded ProgramTrack points as a single
+    multi-sample block, with the same fields as the single-sample
+    ``ACU_upload`` blocks.
+
+    Parameters:
+        uploads (dict): The agent's current upload status, which is updated
+            in place to the last point of the group
+        lines (list): Formatted ProgramTrack lines of the group
+        ctimes (array): ctime of each point
+        azs, els, vas, ves, azflags, elflags (array): Azimuth and elevation
+            positions, velocities and flags of each point
+
+    Returns:
+        dict: Block with ``timestamps`` and a list for each field
+    """
+    n = len(lines)
+    columns = {'PtStack_Time': [line.split(';')[0] for line in lines],
+               'PtStack_ctime': np.asarray(ctimes, dtype=float)[:n].tolist()}
+    for field, vals in [('PtStack_Azimuth', azs), ('PtStack_Elevation', els),
+                        ('PtStack_AzVelocity', vas), ('PtStack_ElVelocity', ves),
+                        ('PtStack_AzFlag', azflags), ('PtStack_ElFlag', elflags)]:
+        # Extra values beyond the number of lines are ignored
+        columns[field] = np.asarray(vals)[:n].tolist()
+    data = {k: [v] * n for k, v in uploads.items() if k not in columns}
+    data.update(columns)
+    uploads.update({k: v[-1] for k, v in columns.items()})
+    return {'timestamps': columns['PtStack_ctime'],
+            'block_name': block_name,
+            'data': data}
+
+
+class ProgramTrackUploader:
+    """
+    Streams blocks of ProgramTrack lines to the ACU stack, uploading each
+    block as soon as enough stack positions are free. The next block is
+    taken from the source (and so formatted) while the previous upload is
+    in flight.
+
+    The free position count reported by the ACU lags the uploads, so lines
+    uploaded after the most recent report are subtracted from it to
+    estimate the current stack occupancy.
+
+    Parameters:
+        upload (callable): Uploads the text of a block to the ACU, returning
+            a Deferred, e.g. ``AcuControl.http.UploadPtStack``
+        free_positions (callable): Returns the most recently reported
+            number of free stack positions and the time it was queried
+        min_free (int): Number of free positions required before uploading
+            a block
+        stack_size (int): Number of positions reported free when the stack
+            is empty
+        poll_interval (float): Time in seconds between checks of the free
+            position count while waiting for space
+        clock (IReactorTime): Provides the time and delayed calls
+
+    Attributes:
+        stats (dict): Metrics for the most recent upload. ``upload_lag`` is
+            the time from stack space becoming available to the upload
+            completing, ``upload_latency`` is the duration of the upload
+            request, and ``stack_fill`` is the estimated number of occupied
+            stack positions after the upload.
+
+    """
+
+    def __init__(self, upload, free_positions, min_free, stack_size=9999,
+                 poll_interval=0.1, clock=reactor):
+        self.upload = upload
+        self.free_positions = free_positions
+        self.min_free = min_free
+        self.stack_size = stack_size
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.stats = {}
+        self._uploads = deque()
+
+    def estimate_free(self):
+        """
+        Estimates the number of free stack positions, accounting for lines
+        uploaded since the last report.
+        """
+        free, report_time = self.free_positions()
+        while self._uploads and self._uploads[0][0] <= report_time:
+            self._uploads.popleft()
+        return free - sum(n for _, n in self._uploads)
+
+    @inlineCallbacks
+    def run(self, blocks, running=None, on_upload=None):
+        """
+        Uploads each block of lines in order.
+
+        Parameters:
+            blocks (iterable): Lists of lines to upload
+            running (callable): Stops uploading when this returns False
+            on_upload (callable): Called with the block and ``stats`` after
+                each upload
+
+        Returns:
+            Deferred firing with the number of lines uploaded.
+        """
+        blocks = iter(blocks)
+        block = next(blocks, None)
+        nlines = 0
+        while block is not None:
+            if running is not None and not running():
+                break
+            t_space = self.clock.seconds()
+            while self.estimate_free() < self.min_free:
+                yield task.deferLater(self.clock, self.poll_interval,
+                                      lambda: None)
+                if running is not None and not running():
+                    return nlines
+                t_space = self.clock.seconds()
+
+            t_start = self.clock.seconds()
+            d = maybeDeferred(self.upload, ''.join(block))
+            # Prepare the next block while the upload is in flight
+            next_block = next(blocks, None)
+            yield d
+            t_done = self.clock.seconds()
+
+            self._uploads.append((t_done, len(block)))
+            nlines += len(block)
+            self.stats = {'upload_lag': t_done - t_space,
+                          'upload_latency': t_done - t_start,
+                          'stack_fill': self.stack_size - self.estimate_free(),
+                          'lines_uploaded': nlines,
+                          }
+            if on_upload is not None:
+                on_upload(block, self.stats)
+            block = next_block
+        return nlines
@@ -9,21 +9,119 @@ import ast
 from scipy import signal
 import queue
 import time
+import pickle
+import traceback
+from collections import deque
+import multiprocessing as mp
+import threading
+from twisted.internet import reactor, task
 from ocs import ocs_agent, site_config
 
 MAX_CHANS = 4096
 CHANS_PER_BAND = 512
 pA_per_rad = 9e6 / (2 * np.pi)
 
+# Map from data quantity to the lyrebird data-val index
+LYREBIRD_DATA_IDXS = {'raw': 0, 'demod': 1, 'wl': 2}
 
-# Map from primary key-names to their index in the SuperTimestream
-# This will be populated when the first frame comes in
-primary_idxs = {}
+MASK_REGISTER = 'AMCc.SmurfProcessor.ChannelMapper.Mask'
+
+
+class FrameDecoder:
+    """
+    Decodes detector data from smurf Scan frames into a float32 buffer that is
+    reused across frames, so steady-state decoding doesn't allocate. For
+    G3SuperTimestreams, data is scaled directly from the frame's array into the
+    buffer in a single pass. For G3TimestreamMaps, the channel-name lookups are
+    resolved once and only refreshed after a Wiring frame (or if the number
+    of channels changes), rather than being rebuilt for every Scan frame.
+
+    The returned data array is a view into the decoder's buffer, and will be
+    overwritten by the next call to ``decode``. Callers that need to hold onto
+    it should make a copy.
+
+    Args:
+        nchans : int
+            Initial number of channels to allocate the buffer for
+        nsamps : int
+            Initial number of samples to allocate the buffer for. The buffer
+            grows as needed if larger frames come in.
+
+    Attributes:
+        primary_idxs : dict
+            Map from primary key-names to their index in the primary
+            SuperTimestream
+        chan_names : list
+            Resolved channel names for G3TimestreamMap data
+    """
+    scale = np.float32(2 * np.pi / 2**16)
+
+    def __init__(self, nchans=MAX_CHANS, nsamps=400):
+        self.buf = np.zeros((nchans, nsamps), dtype=np.float32)
+        self.primary_idxs = {}
+        self.chan_names = None
+
+    def reset(self):
+        """
+        Invalidates cached channel lookups. This should be called whenever a
+        Wiring frame comes in, since the set of streamed channels may change.
+        """
+        self.primary_idxs = {}
+        self.chan_names = None
+
+    def _get_buf(self, nchans, nsamps):
+        if nchans > self.buf.shape[0] or nsamps > self.buf.shape[1]:
+            self.buf = np.zeros((max(nchans, self.buf.shape[0]),
+                                 max(nsamps, self.buf.shape[1])),
+                                dtype=np.float32)
+        return self.buf[:nchans, :nsamps]
+
+    def _load_times(self, primary):
+        if isinstance(primary, core.G3TimesampleMap):
+            return np.array(primary['UnixTime']) / 1e9
+        if not self.primary_idxs:
+            self.primary_idxs = {
+                name: i for i, name in enumerate(primary.names)
+            }
+        return primary.data[self.primary_idxs['UnixTime']] / 1e9
+
+    def decode(self, frame):
+        """
+        Returns detector data from a G3Stream.
+
+        Returns:
+            times : np.ndarray
+                Array with shape (nsamps) of timestamps (sec)
+            data : np.ndarray
+                Array with shape (nchans, nsamps) of detector phase data (phi0).
+                This is a view into the decoder buffer.
+        """
+        times = self._load_times(frame['primary'])
+
+        d = frame['data']
+        if isinstance(d, core.G3TimestreamMap):
+            nchans, nsamps = len(d), d.n_samples
+            if self.chan_names is None or len(self.chan_names) != nchans:
+                self.chan_names = [f'r{i:0>4}' for i in range(nchans)]
+            data = self._get_buf(nchans, nsamps)
+            for i, name in enumerate(self.chan_names):
+                data[i] = d[name]
+            data *= self.scale
+
+        else:  # G3SuperTimestream probably
+            # ``d.data`` is a view of the frame's array, so this reads it
+            # once without making an intermediate float64 copy
+            raw = d.data
+            data = self._get_buf(*raw.shape)
+            np.multiply(raw, self.scale, out=data, casting='unsafe')
+
+        return times, data
 
 
 def load_frame_data(frame):
     """
-    Returns detector data from a G3Stream.
+    Returns detector data from a G3Stream. This allocates new arrays for every
+    call. Use a FrameDecoder to reuse a buffer across frames.
 
     Returns:
         times : np.ndarray
@@ -31,51 +129,429 @@ def load_frame_data(frame):
         data : np.ndarray
             Array with shape (nchans, nsamps) of detector phase data (phi0)
     """
-    primary = frame['primary']
-    if isinstance(primary, core.G3TimesampleMap):
-        times = np.array(primary['UnixTime']) / 1e9
+    d = frame['data']
+    nchans = len(d) if isinstance(d, core.G3TimestreamMap) else len(d.names)
+    decoder = FrameDecoder(nchans=nchans, nsamps=0)
+    return decoder.decode(frame)
+
+
+def read_frames(sources, log, running):
+    """
+    Generator that reads G3Frames from a list of sources. Sources can be
+    addresses of G3NetworkSenders beginning with ``tcp://``, or G3File
+    paths which will be read in series. If a network source disconnects, the
+    reader will attempt to reconnect.
+
+    Args
+    ----
+    sources : List[str]
+        List of sources to read
+    log : txaio.Logger
+        Logger to report connection errors to
+    running : callable
+        Function that returns False when reading should stop
+
+    Yields
+    -------
+    frame : G3Frame
+        Frame read from the source
+    source_offset : float
+        If the source is a file, this is the offset that should be subtracted
+        from data timestamps to line up with the current time. Otherwise
+        this is 0.
+    """
+    src_idx = 0
+    reader = None
+    source = None
+    source_offset = 0
+    while running():
+
+        if reader is None:
+            try:
+                source = sources[src_idx]
+                source_is_file = not source.startswith('tcp://')
+                reader = core.G3Reader(source, timeout=5)
+            except RuntimeError as e:
+                if source_is_file:
+                    # Raise error if file cannot be found
+                    raise e
+                else:
+                    # If not a file, log error and try again
+                    log.error("G3Reader could not connect! Retrying in 10 sec.")
+                    time.sleep(10)
+                    continue
+
+        frames = reader.Process(None)
+        if not frames:
+            # If source is a file, start over with next file or break if
+            # finished all sources. If socket, just reset reader and try to
+            # reconnect
+            if source_is_file:
+                src_idx += 1
+                if src_idx >= len(sources):
+                    log.info("Finished reading all sources")
+                    break
+            reader = None
+            continue
+
+        frame = frames[0]
+
+        # If this source is a file, this will shift the timestamps so that
+        # data lines up with the current timestamp instead of using the
+        # timestamps in the file
+        if source_is_file and (not source_offset):
+            source_offset = frame['time'].time / core.G3Units.s \
+                - time.time()
+        elif not source_is_file:
+            source_offset = 0
+
+        yield frame, source_offset
+
+
+def load_channel_mask(frame):
+    """
+    Returns the readout channel mask from a smurf status frame, or None if
+    the frame does not contain the channel mask.
+    """
+    if 'session_id' not in frame:
+        return None
+    if MASK_REGISTER in frame['status']:
+        status = yaml.safe_load(frame['status'])
+        return np.array(ast.literal_eval(status[MASK_REGISTER]))
+    return None
+
+
+def downsample_monitored_chans(times, data, monitored_channels, sample_rate):
+    """
+    Downsamples data for monitored channels. Monitored channels that are not
+    in the data are skipped.
+
+    Args
+    ----
+    times : np.ndarray
+        Array with shape (nsamps) of timestamps (sec)
+    data : np.ndarray
+        Array with shape (nchans, nsamps) of detector data
+    monitored_channels : list
+        List of ``(readout_chan_number, field_name)`` tuples.
+    sample_rate : float
+        Sample rate (Hz) to target when downsampling
+
+    Returns
+    -------
+    times : np.ndarray
+        Downsampled timestamps
+    fields : tuple
+        Field names of the monitored channels present in the data
+    data : np.ndarray
+        Array with shape (len(fields), nsamps_out) of downsampled data
+    """
+    if len(times) <= 1:
+        ds_factor = 1
     else:
-        if not primary_idxs:
-            for i, name in enumerate(frame['primary'].names):
-                primary_idxs[name] = i
-        times = np.array(primary.data[primary_idxs['UnixTime']]) / 1e9
+        input_rate = 1. / np.median(np.diff(times))
+        ds_factor = max(int(input_rate // sample_rate), 1)
 
-    d = frame['data']
-    if isinstance(d, core.G3TimestreamMap):
-        nchans, nsamps = len(d), d.n_samples
-        data = np.ndarray((nchans, nsamps), dtype=np.float32)
-        for i in range(nchans):
-            data[i] = d[f'r{i:0>4}'] * (2 * np.pi) / 2**16
+    sl = slice(None, None, ds_factor)
+    chans = [(rc, f) for rc, f in monitored_channels if rc < len(data)]
+    rcs = [rc for rc, _ in chans]
+    fields = tuple(f for _, f in chans)
+    return times[sl], fields, data[rcs, sl]
+
+
+class MonitoredChanBatcher:
+    """
+    Buffers downsampled monitored-channel data so that all monitored channels
+    are published to the ``detector_tods`` feed as a single block once per
+    flush interval, instead of as one message per channel per frame.
+    Buffered data is flushed when data is added after the flush interval
+    has elapsed, or by calling ``poll`` periodically, so that data isn't held
+    back if the stream stalls. The buffer may be shared between threads.
+
+    Args
+    -----
+    flush_interval : float
+        Time (sec) between flushes
+    max_points : int
+        Max number of data points (samples x channels) per published block.
+        Larger flushes are split into multiple blocks.
+    block_name : str
+        Block name of published blocks
+
+    Attributes
+    -----------
+    fields : tuple
+        Field names of the buffered data. If data with a different set of
+        fields is added, the buffer is flushed first.
+    """
 
-    else:  # G3SuperTimestream probably
-        data = d.data * (2 * np.pi) / 2**16
+    def __init__(self, flush_interval=1., max_points=10000,
+                 block_name='monitored_channels'):
+        self.flush_interval = flush_interval
+        self.max_points = max_points
+        self.block_name = block_name
+        self.fields = None
+        self._times = []
+        self._data = []
+        self._last_flush = time.time()
+        self._lock = threading.RLock()
+
+    def add(self, times, fields, data, now=None):
+        """
+        Adds downsampled data to the buffer.
+
+        Returns:
+            blocks : list
+                List of blocks to publish. This is empty unless the flush
+                interval has elapsed or the set of fields has changed.
+        """
+        with self._lock:
+            blocks = []
+            if fields != self.fields:
+                blocks.extend(self.flush(now=now))
+                self.fields = fields
+            if len(fields) and len(times):
+                self._times.append(times)
+                self._data.append(data)
+            blocks.extend(self.poll(now=now))
+            return blocks
+
+    def poll(self, now=None):
+        """
+        Flushes the buffer if the flush interval has elapsed.
+
+        Returns:
+            blocks : list
+                List of blocks to publish, which is empty if the flush
+                interval hasn't elapsed.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if now - self._last_flush < self.flush_interval:
+                return []
+            return self.flush(now=now)
 
-    return times, data
+    def flush(self, now=None):
+        """
+        Returns the buffered data as a list of blocks, and clears the buffer.
+        """
+        with self._lock:
+            self._last_flush = time.time() if now is None else now
+            if not self._times:
+                return []
+            times = np.concatenate(self._times)
+            data = np.concatenate(self._data, axis=1)
+            self._times, self._data = [], []
+            fields = self.fields
+
+        step = max(self.max_points // len(fields), 1)
+        blocks = []
+        for i in range(0, len(times), step):
+            blocks.append({
+                'timestamps': times[i:i + step].tolist(),
+                'block_name': self.block_name,
+                'data': {
+                    f: d.tolist() for f, d in zip(fields, data[:, i:i + step])
+                }
+            })
+        return blocks
 
 
-def sleep_while_running(duration, session, interval=1):
+def sample_frames(times, data):
     """
-    Sleeps for a certain duration as long as a session object's status is
-    'starting' or 'running'. If the session is changed to 'stopping',
-    this will quickly return False. If the sleep is completed without
-    interruption this will return True.
+    Creates lyrebird frames that each contain a single sample of a single
+    data quantity. This is the frame format understood by all lyrebird
+    builds.
 
     Args
     ----
-    duration : float
-        Amount of time (sec) to sleep for.
-    session : OpSessions
-        Session whose status should be monitored
-    interval : float, optional
-        Polling interval (sec) to check the session status. Defaults to 1 sec.
+    times : np.ndarray
+        Array with shape (nsamps) of timestamps (sec)
+    data : dict
+        Dict mapping data quantity (a key of ``LYREBIRD_DATA_IDXS``) to an
+        array of shape (nsamps, nelems).
+
+    Returns
+    --------
+    frames : List[G3Frame]
+        List of ``nsamps * len(data)`` frames, ordered by sample.
     """
-    end_time = time.time() + duration
-    while session.status in ['starting', 'running']:
-        now = time.time()
-        if now >= end_time:
-            return True
-        time.sleep(min(interval, end_time - now))
-    return False
+    out = []
+    for i, t in enumerate(times):
+        for name, d in data.items():
+            fr = core.G3Frame(core.G3FrameType.Scan)
+            fr['idx'] = LYREBIRD_DATA_IDXS[name]
+            fr['data'] = core.G3VectorDouble(d[i])
+            fr['timestamp'] = core.G3Time(t * core.G3Units.s)
+            out.append(fr)
+    return out
+
+
+def block_frame(times, data):
+    """
+    Packs a block of samples for all data quantities into a single lyrebird
+    frame. Each quantity is stored as a flattened (nsamps, nelems)
+    G3VectorDouble under its own key. The ``timestamp`` key holds the time of
+    the first sample so block frames can be paced like single-sample frames.
+
+    Args
+    ----
+    times : np.ndarray
+        Array with shape (nsamps) of timestamps (sec)
+    data : dict
+        Dict mapping data quantity (a key of ``LYREBIRD_DATA_IDXS``) to an
+        array of shape (nsamps, nelems).
+    """
+    fr = core.G3Frame(core.G3FrameType.Scan)
+    fr['timestamp'] = core.G3Time(times[0] * core.G3Units.s)
+    fr['timestamps'] = core.G3VectorTime(times * core.G3Units.s)
+    fr['nsamps'] = len(times)
+    for name, d in data.items():
+        fr[name] = core.G3VectorDouble(d.ravel())
+    return fr
+
+
+def unpack_block_frame(frame):
+    """
+    Unpacks a frame created by ``block_frame`` into single-sample frames,
+    for lyrebird builds that do not support block frames.
+    """
+    times = np.array([t.time for t in frame['timestamps']]) / core.G3Units.s
+    data = {
+        name: np.array(frame[name]).reshape(len(times), -1)
+        for name in LYREBIRD_DATA_IDXS if name in frame
+    }
+    return sample_frames(times, data)
+
+
+class PacingScheduler:
+    """
+    Schedules outgoing lyrebird frames so that the delay between frame
+    timestamps and when they are sent is fixed. Send times are computed
+    against a monotonic clock, anchored on the first frame, and frames are
+    released in batches of everything that has come due.
+
+    Frames that are more than ``latency_budget`` seconds late are dropped if
+    there are newer frames waiting, so the stream catches up after a stall in
+    sending. If the newest available frame is late (for instance because the
+    source stalled or restarted), the clock is instead re-anchored on that
+    frame so the full ``delay`` is restored.
+
+    Args
+    -----
+    delay : float
+        Delay (sec) between frame timestamps (relative to the anchor frame)
+        and when they should be sent
+    latency_budget : float
+        Max time (sec) past its send time that a frame can be sent
+    batch_interval : float
+        Max time (sec) the send loop waits between batches
+
+    Attributes
+    -----------
+    pending : deque
+        Queue of ``(send_time, frame)`` tuples waiting to be sent
+    last_send_time : float
+        Send time of the most recently scheduled frame
+    drops : int
+        Number of frames dropped for exceeding the latency budget
+    resyncs : int
+        Number of times the clock has been re-anchored
+    """
+
+    def __init__(self, delay, latency_budget=2., batch_interval=0.05):
+        self.delay = delay
+        self.latency_budget = latency_budget
+        self.batch_interval = batch_interval
+        self.pending = deque()
+        self.last_send_time = None
+        self.drops = 0
+        self.resyncs = 0
+        self._anchor = None
+        self._lateness = []
+
+    def _send_time(self, t):
+        t0, mono0 = self._anchor
+        return mono0 + (t - t0) + self.delay
+
+    def wants_frames(self, now):
+        """
+        Returns True if more frames should be scheduled to fill the current
+        batch. Frames are only pulled shortly before they are due so that
+        the outgoing queue still applies backpressure.
+        """
+        return (self.last_send_time is None
+                or self.last_send_time <= now + self.batch_interval)
+
+    def add(self, frame, now, caught_up=False):
+        """
+        Schedules a frame to be sent.
+
+        Args
+        -----
+        frame : G3Frame
+            Outgoing frame containing a ``timestamp``
+        now : float
+            Current monotonic time
+        caught_up : bool
+            True if this is the newest available frame
+
+        Returns:
+            scheduled : bool
+                False if the frame was dropped
+        """
+        t = frame['timestamp'].time / core.G3Units.s
+        if self._anchor is None:
+            self._anchor = (t, now)
+        send_time = self._send_time(t)
+        if now - send_time > self.latency_budget:
+            if not caught_up:
+                self.drops += 1
+                return False
+            self._anchor = (t, now)
+            self.resyncs += 1
+            send_time = self._send_time(t)
+
+        self.pending.append((send_time, frame))
+        self.last_send_time = send_time
+        return True
+
+    def pop_due(self, now):
+        """
+        Returns the list of frames whose send time has passed
+        """
+        frames = []
+        while self.pending and self.pending[0][0] <= now:
+            send_time, frame = self.pending.popleft()
+            self._lateness.append(now - send_time)
+            frames.append(frame)
+        return frames
+
+    def wait_time(self, now):
+        """
+        Returns how long (sec) to wait until the next frame is due, capped at
+        ``batch_interval``
+        """
+        if not self.pending:
+            return self.batch_interval
+        return min(max(self.pending[0][0] - now, 0), self.batch_interval)
+
+    def stats(self):
+        """
+        Returns a dict of pacing metrics and resets the send-latency stats.
+        ``send_latency`` and ``send_jitter`` are the mean and standard
+        deviation of how late (sec) frames were sent since the last call.
+        """
+        lateness = np.array(self._lateness)
+        self._lateness = []
+        return {
+            'pending': len(self.pending),
+            'dropped_frames': self.drops,
+            'resyncs': self.resyncs,
+            'send_latency': float(np.mean(lateness)) if len(lateness) else 0.,
+            'send_jitter': float(np.std(lateness)) if len(lateness) else 0.,
+        }
 
 
 class FIRFilter:
@@ -87,18 +563,51 @@ class FIRFilter:
 
         a[0]*y[n] = b[0]*x[n] + b[1]*x[n-1] + ... + b[M]*x[n-M]
                               - a[1]*y[n-1] - ... - a[N]*y[n-N]
+
+    If ``decimate`` is set and the filter has no feedback terms, the filter
+    will track the last M input samples instead of the scipy filter state.
+    This lets ``lfilt_at`` compute the output at a subset of sample indices
+    directly from the input, without filtering every sample. Moving-average
+    filters are computed with a running sum, like a single-stage CIC filter.
+    Decimation isn't possible for filters with feedback terms, so for these
+    ``lfilt_at`` filters the full segment and returns the requested samples.
     """
 
-    def __init__(self, b, a, nchans=None):
+    def __init__(self, b, a, nchans=None, decimate=False):
         if nchans is None:
             nchans = MAX_CHANS
         self.b = b
         self.a = a
-        self.z = np.zeros((nchans, len(b) - 1))
+        self.is_fir = not np.any(a[1:])
+        self.decimate = decimate and self.is_fir
+        if self.decimate:
+            self.b = np.asarray(b) / a[0]
+            self.hist = np.zeros((nchans, len(b) - 1))
+        else:
+            self.z = np.zeros((nchans, len(b) - 1))
+
+    def _extend(self, data):
+        """
+        Prepends the input history to a data segment and updates the history
+        """
+        n, nsamps = data.shape
+        ntaps = self.hist.shape[1]
+        x = np.empty((n, ntaps + nsamps), dtype=np.result_type(data, float))
+        x[:, :ntaps] = self.hist[:n]
+        x[:, ntaps:] = data
+        self.hist[:n] = x[:, nsamps:]
+        return x
 
     def lfilt(self, data, in_place=True):
         """Filters data in place"""
         n = len(data)
+        if self.decimate:
+            x = self._extend(data)
+            d = signal.lfilter(self.b, [1.], x, axis=1)[:, x.shape[1] - data.shape[1]:]
+            if in_place:
+                data[:, :] = d
+                return
+            return d
         if in_place:
             data[:, :], self.z[:n] = signal.lfilter(
                 self.b, self.a, data, axis=1, zi=self.z[:n]
@@ -109,6 +618,40 @@ class FIRFilter:
             )
             return d
 
+    def lfilt_at(self, data, idxs):
+        """
+        Filters data, only returning the output at the sample indices
+        ``idxs``. Filter state is updated using the full data segment.
+
+        Args
+        ----
+        data : np.ndarray
+            Array of shape (nchans, nsamps)
+        idxs : np.ndarray
+            Sample indices at which to compute the filter output
+
+        Returns
+        --------
+        out : np.ndarray
+            Array of shape (nchans, len(idxs))
+        """
+        if not self.decimate:
+            return self.lfilt(data, in_place=False)[:, idxs]
+
+        x = self._extend(data)
+        ntaps = len(self.b) - 1
+        idxs = np.asarray(idxs) + ntaps
+        if np.all(self.b == self.b[0]):
+            csum = np.zeros((len(x), x.shape[1] + 1))
+            np.cumsum(x, axis=1, out=csum[:, 1:])
+            return self.b[0] * (csum[:, idxs + 1] - csum[:, idxs - ntaps])
+
+        out = np.zeros((len(x), len(idxs)))
+        for j, bj in enumerate(self.b):
+            if bj != 0:
+                out += bj * x[:, idxs - j]
+        return out
+
     @classmethod
     def butter_highpass(cls, cutoff, fs, order=5):
         """
@@ -148,7 +691,7 @@ class FIRFilter:
         return cls(b, a)
 
     @classmethod
-    def moving_avg(cls, width):
+    def moving_avg(cls, width, decimate=False):
         """
         Creates a moving avg filter
 
@@ -156,14 +699,17 @@ class FIRFilter:
         -----
         width : int
             number of samples to average together
+        decimate : bool
+            If True, the filter supports computing output only at requested
+            samples with ``lfilt_at``.
         """
         b = 1. / width * np.ones(width, dtype=float)
         a = np.zeros_like(b)
         a[0] = 1
-        return cls(b, a)
+        return cls(b, a, decimate=decimate)
 
     @classmethod
-    def differ(cls, delay=1):
+    def differ(cls, delay=1, decimate=False):
         """
         FIR filter to calculate a rolling diff of incoming data.
 
@@ -171,12 +717,15 @@ class FIRFilter:
         ----
         delay : int
             Sets the diff spacing
+        decimate : bool
+            If True, the filter supports computing output only at requested
+            samples with ``lfilt_at``.
         """
         b = np.zeros(1 + int(delay))
         a = np.zeros_like(b)
         b[0], b[-1] = 1, -1
         a[0] = 1
-        return cls(b, a)
+        return cls(b, a, decimate=decimate)
 
 
 class Demodulator:
@@ -198,22 +747,35 @@ class Demodulator:
         self.lp_sin = FIRFilter.butter_lowpass(bw, fs)
         self.lp_cos = FIRFilter.butter_lowpass(bw, fs)
 
-    def apply(self, times, data):
+    def apply(self, times, data, idxs=None):
         """
         Applies demodulation to data segment.
 
+        Args
+        ----
+        times : np.ndarray
+            Array of shape (nsamps) containing sample timestamps
+        data : np.ndarray
+            Array of shape (nchans, nsamps)
+        idxs : np.ndarray, optional
+            If set, only the demodulated signal at these sample indices will
+            be returned. The lowpass filter is recursive, so the filter state
+            still needs to be updated for every sample.
+
         Returns
         --------
         demod : np.ndarray
             Array of (unnormalized) demodulated data in the same shape as the
-            input data
+            input data, or of shape (nchans, len(idxs)) if idxs is set.
         """
         sin = np.sin(2 * np.pi * self.f * times)
         cos = np.cos(2 * np.pi * self.f * times)
+        if idxs is None:
+            idxs = slice(None)
 
         # We don't really care about normalization
-        demod_sin = self.lp_sin.lfilt(data * sin[None, :], in_place=False)
-        demod_cos = self.lp_cos.lfilt(data * cos[None, :], in_place=False)
+        demod_sin = self.lp_sin.lfilt_at(data * sin[None, :], idxs)
+        demod_cos = self.lp_cos.lfilt_at(data * cos[None, :], idxs)
 
         return np.sqrt(demod_sin**2 + demod_cos**2)
 
@@ -230,24 +792,337 @@ class WhiteNoiseCalculator:
         Number of samples to average over in the RMS calc
     """
 
-    def __init__(self, fs=200, navg=200):
+    def __init__(self, fs=200, navg=200, decimate=False):
         # Aiming for 20 Hz
         delay = fs // 20
         self.differ = FIRFilter.differ(delay=delay)
-        self.averager = FIRFilter.moving_avg(navg)
+        self.averager = FIRFilter.moving_avg(navg, decimate=decimate)
         self.fsamp = fs
 
-    def apply(self, data):
+    def apply(self, data, idxs=None):
         """
-        Returns rms / sqrt(fsamp), which estimates the white noise level
+        Returns rms / sqrt(fsamp), which estimates the white noise level.
+        If ``idxs`` is set, this will only be returned at those sample
+        indices.
         """
+        if idxs is None:
+            return np.sqrt(
+                self.averager.lfilt(
+                    self.differ.lfilt(data, in_place=False)**2, in_place=False
+                ) / self.fsamp
+            )
         return np.sqrt(
-            self.averager.lfilt(
-                self.differ.lfilt(data, in_place=False)**2, in_place=False
+            self.averager.lfilt_at(
+                self.differ.lfilt(data, in_place=False)**2, idxs
             ) / self.fsamp
         )
 
 
+class DemodNoiseEngine:
+    """
+    Computes the demodulated amplitude and white noise level of incoming
+    timestreams in a single pass over the data. Results are equivalent to
+    those of the ``Demodulator`` and ``WhiteNoiseCalculator`` classes, but
+    with far fewer full-size temporaries:
+
+     - The sin and cos modulated timestreams are written into a single
+       interleaved work buffer, and lowpassed with one ``lfilter`` call.
+     - The white noise rolling diff and moving average are computed with
+       running sums instead of FIR filters, so the cost does not scale with
+       the averaging width.
+
+    Work buffers are allocated once and reused between frames. They're only
+    reallocated if a frame contains more samples than any previous frame.
+    The lowpass and running-sum state are kept in double precision, since
+    the lowpass poles sit very close to the unit circle.
+
+    Args
+    -----
+    f : float
+        Demodulation frequency
+    bw : float
+        Bandwidth. This will be the filter-cutoff of the applied lowpass filter
+    fs : float
+        Sample rate of incoming data
+    navg : int
+        Number of samples to average over in the RMS calc
+    wl_scale : float
+        Factor to multiply white noise levels by, for instance to convert
+        from rad to pA.
+    nchans : int
+        Max number of channels that will be processed
+    dtype : np.dtype
+        dtype of the modulated-data work buffer
+    """
+
+    def __init__(self, f, bw=1, fs=200, navg=200, wl_scale=1., nchans=None,
+                 dtype=np.float32):
+        if nchans is None:
+            nchans = MAX_CHANS
+        self.f = f
+        self.fsamp = fs
+        self.navg = int(navg)
+        self.delay = int(fs // 20)
+        self.wl_scale = wl_scale
+        self.dtype = dtype
+
+        nyq = 0.5 * fs
+        b, a = signal.butter(5, bw / nyq, btype='low', analog=False)
+        # Rows 2i and 2i+1 of the lowpass state correspond to the sin and cos
+        # components of channel i.
+        self.lowpass = FIRFilter(b, a, nchans=2 * nchans)
+
+        self.diff_hist = np.zeros((nchans, self.delay))
+        self.sq_hist = np.zeros((nchans, self.navg - 1))
+        self._bufs = {}
+
+    def _buf(self, name, shape, dtype=np.float64):
+        """
+        Returns a view of the named work buffer with the requested shape,
+        growing the buffer if it is too small.
+        """
+        buf = self._bufs.get(name)
+        if buf is None or buf.shape[0] < shape[0] or buf.shape[1] < shape[1]:
+            buf = np.empty(shape, dtype=dtype)
+            self._bufs[name] = buf
+        return buf[:shape[0], :shape[1]]
+
+    def demod(self, times, data, idxs=None):
+        """
+        Returns (unnormalized) demodulated data in the same shape as the input
+        data. If ``idxs`` is set, this will only be returned at those sample
+        indices, though the lowpass still runs over every sample.
+        """
+        nchans, nsamps = data.shape
+        phase = 2 * np.pi * self.f * times
+        mod = self._buf('mod', (2 * nchans, nsamps), dtype=self.dtype)
+        np.multiply(data, np.sin(phase)[None, :], out=mod[0::2])
+        np.multiply(data, np.cos(phase)[None, :], out=mod[1::2])
+        if idxs is None:
+            idxs = slice(None)
+        filt = self.lowpass.lfilt_at(mod, idxs)
+        return np.hypot(filt[0::2], filt[1::2])
+
+    def white_noise(self, data, idxs=None):
+        """
+        Returns wl_scale * rms / sqrt(fsamp), which estimates the white noise
+        level.
+
+        Args
+        ----
+        data : np.ndarray
+            Array of shape (nchans, nsamps)
+        idxs : np.ndarray, optional
+            Sample indices to return white noise levels for. Running state is
+            always updated with the full frame. Defaults to all samples.
+        """
+        nchans, nsamps = data.shape
+        delay, navg = self.delay, self.navg
+
+        # Rolling diff: x[n] - x[n - delay]
+        x = self._buf('diff_in', (nchans, delay + nsamps))
+        x[:, :delay] = self.diff_hist[:nchans]
+        x[:, delay:] = data
+        sq = self._buf('sq', (nchans, navg - 1 + nsamps))
+        sq[:, :navg - 1] = self.sq_hist[:nchans]
+        np.subtract(x[:, delay:], x[:, :nsamps], out=sq[:, navg - 1:])
+        np.square(sq[:, navg - 1:], out=sq[:, navg - 1:])
+        self.diff_hist[:nchans] = x[:, nsamps:]
+
+        # Moving sum over navg samples from a cumulative sum
+        csum = self._buf('csum', (nchans, navg + nsamps))
+        csum[:, 0] = 0
+        np.cumsum(sq, axis=1, out=csum[:, 1:])
+        self.sq_hist[:nchans] = sq[:, nsamps:]
+
+        if idxs is None:
+            idxs = np.arange(nsamps)
+        msq = csum[:, idxs + navg] - csum[:, idxs]
+        # Rounding in the cumsum can leave tiny negative values
+        np.maximum(msq, 0, out=msq)
+        return self.wl_scale * np.sqrt(msq / (navg * self.fsamp))
+
+
+class P2Quantile:
+    """
+    Streaming quantile estimator using the P-squared algorithm (Jain &
+    Chlamtac, 1985), vectorized over channels. Each channel keeps five
+    markers whose heights are adjusted with a piecewise-parabolic update as
+    samples come in, so the estimate takes constant memory and time per
+    sample instead of requiring the full history to be sorted.
+
+    Args
+    -----
+    p : float
+        Quantile to estimate, between 0 and 1
+    """
+
+    def __init__(self, p=0.5):
+        self.p = p
+        self.dn = np.array([0, p / 2, p, (1 + p) / 2, 1])
+        self.reset()
+
+    def reset(self):
+        """Clears all samples"""
+        self.count = 0
+        self._init = []
+        self.q = None
+        self.n = None
+        self.ns = 4 * self.dn
+
+    def update(self, x):
+        """
+        Adds samples to the estimator.
+
+        Args
+        -----
+        x : np.ndarray
+            Array with shape (nchans) or (nchans, nsamps). If the number of
+            channels changes, the estimator will be reset.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim == 1:
+            x = x[:, None]
+        if self.count and len(x) != len(self._init[0]):
+            self.reset()
+
+        for col in x.T:
+            if self.count < 5:
+                self._init.append(col)
+                self.count += 1
+                if self.count == 5:
+                    self.q = np.sort(np.stack(self._init, axis=1), axis=1)
+                    self.n = np.tile(np.arange(5.), (len(col), 1))
+                continue
+            self._update(col)
+            self.count += 1
+
+    def _update(self, x):
+        q, n = self.q, self.n
+        # Cell containing each sample, extending the outer markers if needed
+        k = np.sum(q[:, 1:4] <= x[:, None], axis=1)
+        np.minimum(q[:, 0], x, out=q[:, 0])
+        np.maximum(q[:, 4], x, out=q[:, 4])
+        n[:, 1:] += np.arange(1, 5) > k[:, None]
+        self.ns += self.dn
+
+        for i in (1, 2, 3):
+            d = self.ns[i] - n[:, i]
+            up = (d >= 1) & (n[:, i + 1] - n[:, i] > 1)
+            down = (d <= -1) & (n[:, i - 1] - n[:, i] < -1)
+            m = up | down
+            if not m.any():
+                continue
+            s = np.where(up[m], 1., -1.)
+            qi, qm, qp = q[m, i], q[m, i - 1], q[m, i + 1]
+            ni, nm, np_ = n[m, i], n[m, i - 1], n[m, i + 1]
+            qpar = qi + s / (np_ - nm) * (
+                (ni - nm + s) * (qp - qi) / (np_ - ni)
+                + (np_ - ni - s) * (qi - qm) / (ni - nm)
+            )
+            qlin = np.where(s > 0, qi + (qp - qi) / (np_ - ni),
+                            qi - (qm - qi) / (nm - ni))
+            q[m, i] = np.where((qm < qpar) & (qpar < qp), qpar, qlin)
+            n[m, i] += s
+
+    def estimate(self):
+        """
+        Returns the current quantile estimate for each channel, or None if no
+        samples have been added. Until five samples have been added, the exact
+        quantile of the stored samples is returned.
+        """
+        if self.count == 0:
+            return None
+        if self.count < 5:
+            return np.quantile(np.stack(self._init, axis=1), self.p, axis=1)
+        return self.q[:, 2].copy()
+
+
+class FrameProcessor:
+    """
+    Downsamples incoming detector data to the target rate, and computes the
+    demodulated signal and white noise levels at the downsampled sample
+    indices. Filter state and the downsample offset are carried between
+    frames.
+
+    Args
+    -----
+    target_rate : float
+        Target sample rate (Hz) of downsampled data
+    demod_freq : float
+        Demodulation frequency
+    demod_bandwidth : float
+        Filter cutoff for demodulation lowpass
+
+    Attributes
+    -----------
+    ds_offset : int
+        Offset for downsample to avoid hiccups at frame boundaries
+    dsp : DemodNoiseEngine
+        Engine used to calculate the demod signal and white noise levels for
+        incoming timestreams. This is created when the first frame is
+        processed, once the sample rate is known.
+    """
+
+    def __init__(self, target_rate, demod_freq, demod_bandwidth):
+        self.target_rate = target_rate
+        self.demod_freq = demod_freq
+        self.demod_bandwidth = demod_bandwidth
+        self.ds_offset = 0
+        self.dsp = None
+
+    def process(self, times, data, sample_rate=None):
+        """
+        Processes a segment of detector data.
+
+        Args
+        ----
+        times : np.ndarray
+            Array with shape (nsamps) of timestamps (sec)
+        data : np.ndarray
+            Array with shape (nchans, nsamps) of detector phase data (rad)
+        sample_rate : float, optional
+            Sample rate (Hz) of the data. If None, this is estimated from
+            ``times``. Segments split from a single frame should be passed
+            the rate of the whole frame, so they are downsampled the same way
+            as the frame would be.
+
+        Returns
+        --------
+        sample_idxs : np.ndarray
+            Indices of the downsampled samples
+        demod : np.ndarray
+            Array with shape (nchans, len(sample_idxs)) of demodulated data
+        wl : np.ndarray
+            Array with shape (nchans, len(sample_idxs)) of white noise levels
+            (pA/rt(Hz))
+        """
+        if sample_rate is None:
+            sample_rate = 1. / np.median(np.diff(times))
+        nsamps = len(times)
+
+        if self.dsp is None:
+            # white noise in units of pA/rt(Hz)
+            self.dsp = DemodNoiseEngine(
+                self.demod_freq, self.demod_bandwidth, fs=sample_rate,
+                navg=int(sample_rate), wl_scale=pA_per_rad
+            )
+
+        ds_factor = sample_rate // self.target_rate
+        if np.isnan(ds_factor):  # There is only one element in the timestream
+            ds_factor = 1
+        ds_factor = max(int(ds_factor), 1)  # Prevents downsample factors < 1
+
+        sample_idxs = np.arange(self.ds_offset, nsamps, ds_factor, dtype=np.int32)
+        # Index of the next downsampled sample, relative to the next segment
+        self.ds_offset = (self.ds_offset - nsamps) % ds_factor
+
+        # Filters are only evaluated at the downsampled indices
+        demod = self.dsp.demod(times, data, idxs=sample_idxs)
+        wl = self.dsp.white_noise(data, idxs=sample_idxs)
+        return sample_idxs, demod, wl
+
+
 class VisElem:
     """
     Container for config info for Lyrebird visual elements.
@@ -335,65 +1210,121 @@ class VisElem:
 class FocalplaneConfig:
     def __init__(self):
         """
-        Object to configure the focal-plane layout.
+        Object to configure the focal-plane layout. Visual element info is
+        stored in columns so that large focal-planes can be built and packed
+        into config frames without creating per-element objects.
 
         Attributes
         -------------
         chan_mask : np.ndarray
             Map from absolute_smurf_chan --> Visual Element index
-        channels : list
-            List of visual elements
+        names : list
+            Name of each visual element
+        xs, ys, rots : np.ndarray
+            Position and rotation (rads) of each visual element
+        templates : list
+            Lyrebird template of each visual element
+        abs_smurf_chans : np.ndarray
+            Absolute smurf-channel of each visual element
+        cmap_idxs : np.ndarray
+            Colormap index of each visual element
         """
-        self.channels = []
         self.chan_mask = np.full(MAX_CHANS, -1)
+        self.names = []
+        self.xs = np.zeros(0)
+        self.ys = np.zeros(0)
+        self.rots = np.zeros(0)
+        self.templates = []
+        self.abs_smurf_chans = np.zeros(0, dtype=int)
+        self.cmap_idxs = np.zeros(0, dtype=int)
+        self._config_frame = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def channels(self):
+        """
+        List of VisElem objects for each visual element
+        """
+        return [
+            VisElem(*args) for args in zip(
+                self.names, self.xs, self.ys, self.rots, self.templates,
+                self.abs_smurf_chans, self.cmap_idxs
+            )
+        ]
 
     def config_frame(self):
         """
-        Generates a config frame for lyrebird
+        Generates a config frame for lyrebird. The frame is cached, and only
+        rebuilt after visual elements are added, so the returned frame should
+        not be modified.
         """
-        xs = []
-        ys = []
-        rots = []
-        cnames = []
-        templates = []
-        value_names = []
+        if self._config_frame is not None:
+            return self._config_frame
+
+        names = self.names
+        bands = self.abs_smurf_chans // CHANS_PER_BAND
+        chans = self.abs_smurf_chans % 512
+        labels = ['raw', 'demod', 'wl', 'flagged', 'smurf_band', 'smurf_chan']
+        nlabels = len(labels)
+
+        value_names = [f'{n}/{v}' for n in names for v in labels]
         eqs = []
-        eq_labels = []
-        eq_color_is_dynamic = []
-        cmaps = []
-
-        for c in self.channels:
-            xs.append(c.x)
-            ys.append(c.y)
-            rots.append(c.rot)
-            cnames.append(c.name)
-            templates.append(c.template)
-            value_names.extend(c.vals)
-            eqs.extend(c.eqs)
-            eq_labels.extend(c.eq_labels)
-            eq_color_is_dynamic.extend(c.color_is_dynamic)
-            cmaps.extend(c.cmaps)
+        for n, b, c in zip(names, bands, chans):
+            eqs.extend([
+                f'{n}/raw', f'* {n}/demod rms_scale', f'* {n}/wl wl_scale',
+                f'{n}/flagged', str(b), str(c)
+            ])
+        cmaps = np.array(['red_cmap', 'blue_cmap'])[self.cmap_idxs]
+        color_is_dynamic = np.zeros(nlabels, dtype=bool)
+        color_is_dynamic[0] = True
 
         frame = core.G3Frame(core.G3FrameType.Wiring)
-        frame['x'] = core.G3VectorDouble(xs)
-        frame['y'] = core.G3VectorDouble(ys)
-        frame['cname'] = core.G3VectorString(cnames)
-        frame['rotation'] = core.G3VectorDouble(rots)
-        frame['templates'] = core.G3VectorString(templates)
+        frame['x'] = core.G3VectorDouble(self.xs)
+        frame['y'] = core.G3VectorDouble(self.ys)
+        frame['cname'] = core.G3VectorString(names)
+        frame['rotation'] = core.G3VectorDouble(self.rots)
+        frame['templates'] = core.G3VectorString(self.templates)
         frame['values'] = core.G3VectorString(value_names)
-        frame['color_is_dynamic'] = core.G3VectorBool(eq_color_is_dynamic)
+        frame['color_is_dynamic'] = core.G3VectorBool(
+            np.tile(color_is_dynamic, len(names)).tolist())
         frame['equations'] = core.G3VectorString(eqs)
-        frame['eq_labels'] = core.G3VectorString(eq_labels)
-        frame['cmaps'] = core.G3VectorString(cmaps)
+        frame['eq_labels'] = core.G3VectorString(labels * len(names))
+        frame['cmaps'] = core.G3VectorString(
+            np.repeat(cmaps, nlabels).tolist())
+        self._config_frame = frame
         return frame
 
-    def add_vis_elem(self, *args, **kwargs):
+    def add_vis_elems(self, names, xs, ys, rots, templates, abs_smurf_chans,
+                      cmap_idxs=0):
+        """
+        Adds visual elements to the focal-plane and updates the channel mask.
+        Arguments are sequences with one entry per element (see ``VisElem``),
+        though ``templates``, ``rots`` and ``cmap_idxs`` may be scalars.
+        """
+        n0, n = len(self), len(names)
+        abs_smurf_chans = np.asarray(abs_smurf_chans, dtype=int)
+        if isinstance(templates, str):
+            templates = [templates] * n
+
+        self.names = self.names + list(names)
+        self.xs = np.append(self.xs, np.broadcast_to(xs, n))
+        self.ys = np.append(self.ys, np.broadcast_to(ys, n))
+        self.rots = np.append(self.rots, np.broadcast_to(rots, n))
+        self.templates = self.templates + list(templates)
+        self.abs_smurf_chans = np.append(self.abs_smurf_chans, abs_smurf_chans)
+        self.cmap_idxs = np.append(self.cmap_idxs, np.broadcast_to(cmap_idxs, n))
+        self.chan_mask[abs_smurf_chans] = np.arange(n0, n0 + n)
+        self._config_frame = None
+
+    def add_vis_elem(self, name, x, y, rot, template, abs_smurf_chan,
+                     cmap_idx=0):
         """
         Adds a visual element to the focal-plane and updates the channel mask
         """
-        c = VisElem(*args, **kwargs)
-        self.channels.append(c)
-        self.chan_mask[c.abs_smurf_chan] = len(self.channels) - 1
+        self.add_vis_elems([name], [x], [y], [rot], [template],
+                           [abs_smurf_chan], [cmap_idx])
 
     @classmethod
     def grid(cls, stream_id, xdim, ydim, ygap=0, offset=(0., 0.)):
@@ -425,12 +1356,10 @@ class FocalplaneConfig:
         if ygap > 0:
             ys = ys + .5 * (ys // ygap)
 
-        template = 'box'
-        for i in range(xdim * ydim):
-            x, y = xs[i % xdim], ys[i // xdim]
-            name = f"{stream_id}/channel_{i}"
-            fp.add_vis_elem(name, x, y, 0, template, i)
-
+        idxs = np.arange(xdim * ydim)
+        names = [f"{stream_id}/channel_{i}" for i in idxs]
+        fp.add_vis_elems(names, xs[idxs % xdim], ys[idxs // xdim], 0, 'box',
+                         idxs)
         return fp
 
     @classmethod
@@ -458,40 +1387,260 @@ class FocalplaneConfig:
         fp = cls()
         df = pd.read_csv(detmap_file)
 
-        templates = ["template_c0_p0", "template_c1_p0", ]
+        templates = np.array(["template_c0_p0", "template_c1_p0", ])
+
+        # Just skip detectors with unknown bandpass
+        bandpass = pd.to_numeric(df['bandpass'], errors='coerce')
+        valid = bandpass.notna().to_numpy()
+        df, bandpass = df[valid], bandpass[valid].astype(int).to_numpy()
+
+        # Colors are assigned in the order bandpasses first appear
+        _, first_idxs, cidxs = np.unique(
+            bandpass, return_index=True, return_inverse=True)
+        cidxs = np.argsort(np.argsort(first_idxs))[cidxs]
+
+        has_chan = (df['smurf_channel'] != -1).to_numpy()
+        df, cidxs = df[has_chan], cidxs[has_chan]
+
+        rots = np.where(df['pol'].astype(str).str.strip() == 'B', np.pi / 2, 0)
+        xs = df['det_x'].to_numpy() * wafer_scale + offset[0]
+        ys = df['det_y'].to_numpy() * wafer_scale + offset[1]
+        abs_smurf_chans = (df['smurf_band'].to_numpy() * CHANS_PER_BAND
+                           + df['smurf_channel'].to_numpy())
+        names = [f"{stream_id}/det_{i}" for i in df.index]
+
+        fp.add_vis_elems(names, xs, ys, rots, templates[cidxs].tolist(),
+                         abs_smurf_chans, cidxs)
+        return fp
+
+
+class SharedRingBuffer:
+    """
+    Ring of fixed-size shared-memory slots used to pass arrays between
+    pipeline processes without pickling them. Each slot contains an array
+    for every registered field. A producer acquires a free slot, fills it,
+    and publishes it along with a small metadata dict. The consumer gets the
+    slot and its metadata, and releases it once it's done with the data.
+    Since the number of slots is fixed, a slow consumer will back-pressure
+    the producer.
+
+    Messages without array data, such as control messages, can be published
+    with a slot of None.
+
+    The buffer is inherited by forked worker processes, so workers must be
+    started using the ``fork`` context. The ``SharedMemory`` API isn't used
+    because its resource tracker can't be started once txaio has redirected
+    stderr.
+
+    Args
+    -----
+    nslots : int
+        Number of slots in the ring
+    fields : dict
+        Dict mapping field name to ``(shape, dtype)`` of the max-size array
+        that can be stored in that field.
+    ctx : multiprocessing context
+        Context used to create the shared buffer and queues
+    """
+
+    def __init__(self, nslots, fields, ctx=None):
+        if ctx is None:
+            ctx = mp.get_context('fork')
+        self.nslots = nslots
+        self.fields = {}
+        slot_size = 0
+        for name, (shape, dtype) in fields.items():
+            dtype = np.dtype(dtype)
+            self.fields[name] = (tuple(shape), dtype, slot_size)
+            slot_size += int(np.prod(shape)) * dtype.itemsize
+        self.slot_size = slot_size
+        self.buf = ctx.RawArray('B', max(nslots * slot_size, 1))
+        self.free = ctx.Queue()
+        self.ready = ctx.Queue()
+        for i in range(nslots):
+            self.free.put(i)
+
+    def slot_arrays(self, slot):
+        """
+        Returns a dict of numpy arrays backed by the shared memory of a slot
+        """
+        base = slot * self.slot_size
+        return {
+            name: np.ndarray(shape, dtype=dtype, buffer=self.buf,
+                             offset=base + offset)
+            for name, (shape, dtype, offset) in self.fields.items()
+        }
 
-        color_idxs = {}
-        ncolors = 0
-        for i, row in df.iterrows():
-            rot = 0
+    def acquire(self, stop_event=None, timeout=1):
+        """
+        Blocks until a slot is free and returns its index. Returns None if
+        ``stop_event`` is set while waiting.
+        """
+        while stop_event is None or not stop_event.is_set():
             try:
-                bandpass = int(row['bandpass'])
-                if bandpass in color_idxs:
-                    cidx = color_idxs[bandpass]
-                else:
-                    color_idxs[bandpass] = ncolors
-                    ncolors += 1
-                    cidx = color_idxs[bandpass]
-
-                template = templates[cidx]
-                if row['pol'].strip() == 'B':
-                    rot = np.pi / 2
-            except ValueError:
-                # Just skip detectors with unknown bandpass
+                return self.free.get(timeout=timeout)
+            except queue.Empty:
+                continue
+        return None
+
+    def publish(self, slot, meta):
+        """Publishes a filled slot (or None) and its metadata"""
+        self.ready.put((slot, meta))
+
+    def get(self, timeout=None):
+        """
+        Returns the next published ``(slot, meta)`` tuple. Raises queue.Empty
+        on timeout.
+        """
+        return self.ready.get(timeout=timeout)
+
+    def release(self, slot):
+        """Returns a slot to the pool of free slots"""
+        if slot is not None:
+            self.free.put(slot)
+
+    def depth(self):
+        """Number of published messages waiting to be consumed"""
+        try:
+            return self.ready.qsize()
+        except NotImplementedError:  # qsize isn't implemented on macOS
+            return -1
+
+
+def _worker_error(stage, e):
+    """
+    Creates an ``error`` message to pass an exception raised in a pipeline
+    worker on to the read process. Exceptions that can't be pickled are
+    replaced by a RuntimeError with the same message.
+    """
+    try:
+        pickle.dumps(e)
+    except Exception:
+        e = RuntimeError(f"{type(e).__name__}: {e}")
+    return {'type': 'error', 'stage': stage, 'error': e,
+            'traceback': traceback.format_exc()}
+
+
+def _decode_worker(sources, ring, stop_event, max_samps):
+    """
+    Pipeline stage that reads G3Frames and decodes detector data into the
+    shared ring buffer. Channel mask updates from status frames are passed
+    along as ``mask`` messages. Frames with more than ``max_samps`` samples
+    are split into multiple chunks of nearly equal length. Exceptions are
+    passed along as an ``error`` message.
+    """
+    log = txaio.make_logger()
+    decoder = FrameDecoder(nsamps=max_samps)
+    try:
+        running = lambda: not stop_event.is_set()  # noqa: E731
+        for frame, source_offset in read_frames(sources, log, running):
+            if frame.type == core.G3FrameType.Wiring:
+                decoder.reset()
+                mask = load_channel_mask(frame)
+                if mask is not None:
+                    ring.publish(None, {'type': 'mask', 'mask': mask})
+                continue
+            elif frame.type != core.G3FrameType.Scan:
+                continue
+            if 'session_id' not in frame:
+                continue
+
+            t_start = time.time()
+            times, data = decoder.decode(frame)
+            times = times - source_offset
+            decode_latency = time.time() - t_start
+            nchans, nsamps = data.shape
+            sample_rate = 1. / np.median(np.diff(times))
+            # Chunks are processed with the sample rate of the whole frame,
+            # and are of nearly equal length to avoid tiny chunks
+            nchunks = max(-(-nsamps // max_samps), 1)
+            bounds = [k * nsamps // nchunks for k in range(nchunks + 1)]
+            for i0, i1 in zip(bounds[:-1], bounds[1:]):
+                slot = ring.acquire(stop_event)
+                if slot is None:
+                    return
+                arrs = ring.slot_arrays(slot)
+                arrs['times'][:i1 - i0] = times[i0:i1]
+                arrs['data'][:nchans, :i1 - i0] = data[:, i0:i1]
+                ring.publish(slot, {
+                    'type': 'data', 'nchans': nchans, 'nsamps': i1 - i0,
+                    'sample_rate': sample_rate,
+                    'decode_latency': decode_latency,
+                    'decode_time': time.time(),
+                })
+    except Exception as e:
+        ring.publish(None, _worker_error('decode', e))
+    finally:
+        ring.publish(None, {'type': 'stop'})
+
+
+def _dsp_worker(ring_in, ring_out, stop_event, config_queue, proc,
+                monitored_channels, monitored_chan_sample_rate):
+    """
+    Pipeline stage that runs the FrameProcessor over decoded data, and writes
+    downsampled raw, demod and white-noise data to the output ring buffer.
+    Downsampled monitored channel data is sent along in the message metadata.
+    Config updates such as the target rate can be sent through
+    ``config_queue`` as dicts. Exceptions are passed along as an ``error``
+    message.
+    """
+    try:
+        while True:
+            while True:
+                try:
+                    cfg = config_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if 'target_rate' in cfg:
+                    proc.target_rate = cfg['target_rate']
+                if 'monitored_channels' in cfg:
+                    monitored_channels = cfg['monitored_channels']
+                    monitored_chan_sample_rate = cfg['monitored_chan_sample_rate']
+
+            try:
+                slot, meta = ring_in.get(timeout=1)
+            except queue.Empty:
+                if stop_event.is_set():
+                    break
                 continue
-            x, y = row['det_x'] * wafer_scale, row['det_y'] * wafer_scale
-            x += offset[0]
-            y += offset[1]
 
-            band, chan = row['smurf_band'], row['smurf_channel']
-            if chan == -1:
+            if meta['type'] != 'data':
+                ring_out.publish(None, meta)
+                if meta['type'] in ('stop', 'error'):
+                    break
                 continue
-            abs_smurf_chan = band * CHANS_PER_BAND + chan
 
-            name = f"{stream_id}/det_{i}"
-            fp.add_vis_elem(name, x, y, rot, template, abs_smurf_chan, cmap_idx=cidx)
+            t_start = time.time()
+            nchans, nsamps = meta['nchans'], meta['nsamps']
+            arrs = ring_in.slot_arrays(slot)
+            times = arrs['times'][:nsamps].copy()
+            data = arrs['data'][:nchans, :nsamps]
 
-        return fp
+            if monitored_channels:
+                meta['monitored'] = downsample_monitored_chans(
+                    times, data, monitored_channels, monitored_chan_sample_rate
+                )
+            sample_idxs, demod, wl = proc.process(
+                times, data, sample_rate=meta['sample_rate'])
+            nout = len(sample_idxs)
+
+            out_slot = ring_out.acquire(stop_event)
+            if out_slot is None:
+                ring_in.release(slot)
+                break
+            out = ring_out.slot_arrays(out_slot)
+            out['times'][:nout] = times[sample_idxs]
+            out['raw'][:nchans, :nout] = data[:, sample_idxs]
+            out['demod'][:nchans, :nout] = demod
+            out['wl'][:nchans, :nout] = wl
+            ring_in.release(slot)
+
+            meta['nsamps'] = nout
+            meta['dsp_start'] = t_start
+            meta['dsp_time'] = time.time()
+            ring_out.publish(out_slot, meta)
+    except Exception as e:
+        ring_out.publish(None, _worker_error('dsp', e))
 
 
 class MagpieAgent:
@@ -503,8 +1652,9 @@ class MagpieAgent:
     target_rate : float
         This is the target sample rate of data to be sent to lyrebird.
         Incoming data will be downsampled to this rate before being sent out.
-    ds_offset : int
-        Offset for downsample to avoid hiccups at frame boundaries
+    proc : FrameProcessor
+        Processor used to downsample incoming data and calculate the demod
+        signal and white noise levels.
     fp : FocalplaneConfig
         This is the FocalplaneConfig object that contains info about what
         channels are present in the focal-plane representation, and their
@@ -515,15 +1665,40 @@ class MagpieAgent:
         is seen in the G3Stream, this defaults to being an identity mapping
         which just sends the readout channel no. to itself. Once a status
         frame with the channel mask is seen, this will be updated
+    scatter_idxs : tuple, optional
+        Cached tuple of ``(nchans, readout_chans, elem_idxs)`` used to scatter
+        readout-channel data into the focal-plane output arrays. This is
+        built from ``mask`` and ``fp.chan_mask``, and is reset whenever the
+        mask changes.
     out_queue : Queue
         This is a queue containing outgoing G3Frames to be sent to lyrebird.
+    frame_format : str
+        Format of outgoing lyrebird frames. If ``sample``, a frame is sent for
+        every sample of every data quantity. If ``block``, all samples and
+        data quantities from an incoming frame are packed into a single frame
+        (see ``block_frame``), which requires a lyrebird build that can unpack
+        them.
     delay : float
         The outgoing stream will attempt to enforce this delay between the
         relative timestamps in the G3Frames and the real time to ensure a
         smooth flow of data. This must be greater than the frame-aggregation
         time of the SmurfStreamer or else lyrebird will update data in spurts.
+    latency_budget : float
+        Max time (sec) an outgoing frame can fall behind its send time before
+        it is dropped.
+    send_batch_interval : float
+        Max time (sec) between batches of frames sent to lyrebird.
+    send_stats_interval : float
+        Time (sec) between publishing pacing metrics to the ``send_stats``
+        feed.
     avg1, avg2 : RollingAvg
         Two Rolling Averagers which are used to calculate the rolling RMS data.
+    wl_median : P2Quantile
+        Streaming estimator of the median white-noise level of each channel
+        since the last white-noise publish.
+    wl_publish_interval : float
+        Time (sec) between publishing white-noise quantiles to the
+        ``white_noise`` feed.
     monitored_channels : list
         List of monitored channels whose data should be sent to grafana.
         This list will contain entries which look like
@@ -531,17 +1706,26 @@ class MagpieAgent:
     monitored_chan_sample_rate : float
         Sample rate (Hz) to target when downsampling monitored channel data for
         grafana.
-    demod : Demodulator
-        Demodulator used to calculate demod signal for incoming timestreams
+    tod_batcher : MonitoredChanBatcher
+        Buffers downsampled monitored channel data, which is published to the
+        ``detector_tods`` feed as a single block every flush interval.
+    tod_flush_loop : twisted.internet.task.LoopingCall
+        Polls the ``tod_batcher`` every flush interval, so buffered data is
+        published even when no new frames arrive.
     self.demod_freq : float
         Demodulation frequency
     self.demod_bandwidth : float
         Filter cutoff for demodulation lowpass
-    wlcalc : WhiteNoiseCalculator
-        WhiteNoiseCalculator used to calculate white noise levels for incoming
-        timestreams
+    pipeline : bool
+        If True, the read process will decode and process frames in separate
+        worker processes, connected by shared-memory ring buffers.
+    pipeline_slots : int
+        Number of slots in each pipeline ring buffer
+    pipeline_max_samps : int
+        Max number of samples per ring buffer slot. Frames with more samples
+        are split into multiple chunks.
     """
-    mask_register = 'AMCc.SmurfProcessor.ChannelMapper.Mask'
+    mask_register = MASK_REGISTER
 
     def __init__(self, agent, args):
         self.agent: ocs_agent.OCSAgent = agent
@@ -549,7 +1733,6 @@ class MagpieAgent:
         self._running = False
 
         self.target_rate = args.target_rate
-        self.ds_offset = 0
         layout = args.layout.lower()
         if layout == 'grid':
             self.fp = FocalplaneConfig.grid(
@@ -565,22 +1748,43 @@ class MagpieAgent:
                                  "using wafer layout")
 
         self.mask = np.arange(MAX_CHANS)
+        self.scatter_idxs = None
+        self.decoder = FrameDecoder()
         self.out_queue = queue.Queue(1000)
+        self.frame_format = args.frame_format
         self.delay = args.delay
+        self.latency_budget = args.latency_budget
+        self.send_batch_interval = args.send_batch_interval
+        self.send_stats_interval = 1.
 
-        self.demod = None
         self.demod_freq = args.demod_freq
         self.demod_bandwidth = args.demod_bandwidth
+        self.proc = FrameProcessor(
+            self.target_rate, self.demod_freq, self.demod_bandwidth
+        )
+
+        self.pipeline = args.pipeline
+        self.pipeline_slots = args.pipeline_slots
+        self.pipeline_max_samps = args.pipeline_max_samps
+        self._pipeline_config = None
 
-        self.wncalc = None
+        self.wl_publish_interval = args.wl_publish_interval
+        self.wl_median = P2Quantile(0.5)
+        self._wl_last_publish = time.time()
 
         self.monitored_channels = []
         self.monitored_chan_sample_rate = 10
+        self.tod_batcher = MonitoredChanBatcher(
+            flush_interval=args.monitored_channel_flush_interval,
+            max_points=args.monitored_channel_max_points,
+        )
+        self.tod_flush_loop = task.LoopingCall(self._poll_tods)
         self.agent.register_feed(
             'detector_tods', record=True,
             agg_params={'exclude_aggregator': True}
         )
         self.agent.register_feed('white_noise', record=True,)
+        self.agent.register_feed('send_stats', record=True)
 
     @ocs_agent.param('target_rate', type=float)
     def set_target_rate(self, session, params):
@@ -593,6 +1797,8 @@ class MagpieAgent:
                 Target sample rate for lyrebird (Hz)
         """
         self.target_rate = params['target_rate']
+        self.proc.target_rate = self.target_rate
+        self._update_pipeline_config(target_rate=self.target_rate)
         return True, f'Set target rate to {self.target_rate}'
 
     @ocs_agent.param('delay', type=float)
@@ -624,6 +1830,10 @@ class MagpieAgent:
         in the influx database, so be wary of programatically adding many of
         them.
 
+        Data for all monitored channels is buffered and published to the
+        ``detector_tods`` feed as a single block every
+        ``--monitored-channel-flush-interval`` seconds.
+
         Args
         ------
         chan_info : list
@@ -659,55 +1869,123 @@ class MagpieAgent:
 
         self.monitored_channels = monitored_chans
         self.monitored_chan_sample_rate = params['sample_rate']
+        self._update_pipeline_config(
+            monitored_channels=self.monitored_channels,
+            monitored_chan_sample_rate=self.monitored_chan_sample_rate
+        )
         return True, "Set monitored channels"
 
+    def _update_pipeline_config(self, **cfg):
+        """
+        Sends config updates to the pipeline DSP worker if it is running
+        """
+        if self._pipeline_config is not None:
+            self._pipeline_config.put(cfg)
+
+    def _set_mask(self, mask):
+        """Sets the channel mask and resets the cached scatter indices"""
+        self.mask = mask
+        self.scatter_idxs = None
+
     def _process_status(self, frame):
         """
         Processes a status frame. This will set or update the channel
-        mask whenever the smurf metadata is updated.
+        mask whenever the smurf metadata is updated, and invalidates the
+        decoder's cached channel lookups.
         """
-        if 'session_id' not in frame:
-            return
-        if self.mask_register in frame['status']:
-            status = yaml.safe_load(frame['status'])
-            self.mask = np.array(
-                ast.literal_eval(status[self.mask_register])
+        self.decoder.reset()
+        mask = load_channel_mask(frame)
+        if mask is not None:
+            self._set_mask(mask)
+
+    def _get_scatter_idxs(self, nchans):
+        """
+        Returns the readout-channel and visual-element index arrays used to
+        copy data into the focal-plane output arrays. Readout channels that
+        aren't in the focal-plane are dropped. The result is cached until
+        the channel mask or the number of streamed channels changes.
+        """
+        if self.scatter_idxs is None or self.scatter_idxs[0] != nchans:
+            abs_chans = self.mask[np.arange(nchans)]
+            elem_idxs = np.full(nchans, -1)
+            m = abs_chans < len(self.fp.chan_mask)
+            elem_idxs[m] = self.fp.chan_mask[abs_chans[m]]
+            readout_chans = np.where(elem_idxs >= 0)[0]
+            self.scatter_idxs = (
+                nchans, readout_chans, elem_idxs[readout_chans]
             )
+        return self.scatter_idxs[1:]
 
     def _process_monitored_chans(self, times, data):
         """
-        Downsamples data for monitored channels and publishes tods to a grafana
-        feed.
+        Downsamples data for monitored channels and adds it to the tod batcher,
+        which publishes all monitored channels to a grafana feed as a single
+        block every flush interval.
         """
         if not self.monitored_channels:
+            self._publish_tods(self.tod_batcher.flush())
             return
 
-        target_rate = self.monitored_chan_sample_rate
-        if len(times) <= 1:
-            ds_factor = 1
-        else:
-            input_rate = 1. / np.median(np.diff(times))
-            ds_factor = max(int(input_rate // target_rate), 1)
-
-        sl = slice(None, None, ds_factor)
+        self._check_monitored_chans(len(data))
+        self._publish_tods(self.tod_batcher.add(*downsample_monitored_chans(
+            times, data, self.monitored_channels,
+            self.monitored_chan_sample_rate
+        )))
 
-        times_out = times[sl]
+    def _check_monitored_chans(self, nchans):
+        """
+        Warns about monitored channels that aren't in the streamed data.
+        """
         for rc, field_name in self.monitored_channels:
-            if rc >= len(data):
+            if rc >= nchans:
                 self.log.warn(
-                    f"Readout channel {rc} is larger than the number of"
-                    f"streamed channels ({len(data)})! Data won't be published"
+                    f"Readout channel {rc} is larger than the number of "
+                    f"streamed channels ({nchans})! Data won't be published "
                     "to grafana."
                 )
-                continue
-            _data = {
-                'timestamps': times_out.tolist(),
-                'block_name': field_name,
-                'data': {
-                    field_name: data[rc, sl].tolist()
-                }
-            }
-            self.agent.publish_to_feed('detector_tods', _data)
+
+    def start_tod_flush_loop(self, clock=reactor):
+        """
+        Starts polling the ``tod_batcher`` from the reactor once every flush
+        interval.
+        """
+        self.tod_flush_loop.clock = clock
+        self.tod_flush_loop.start(self.tod_batcher.flush_interval, now=False)
+
+    def _poll_tods(self):
+        """
+        Publishes buffered monitored channel data if the flush interval has
+        elapsed since the last flush.
+        """
+        self._publish_tods(self.tod_batcher.poll())
+
+    def _publish_tods(self, blocks):
+        """
+        Publishes monitored channel blocks to the detector_tods feed
+        """
+        for block in blocks:
+            self.agent.publish_to_feed('detector_tods', block)
+
+    def _update_wls(self, wl):
+        """
+        Adds the latest white-noise level of each channel to the streaming
+        per-channel median estimator, and publishes the cross-channel
+        quantiles of those medians once every ``wl_publish_interval`` seconds.
+        The estimator is reset after each publish, so each published value
+        covers a single interval.
+        """
+        if wl.shape[1] == 0:
+            return
+        # wl is already averaged over ~1 sec of samples, so the last one
+        # is representative of the frame
+        self.wl_median.update(wl[:, -1])
+
+        now = time.time()
+        if now - self._wl_last_publish < self.wl_publish_interval:
+            return
+        self._publish_wls(self.wl_median.estimate())
+        self.wl_median.reset()
+        self._wl_last_publish = now
 
     def _publish_wls(self, wls):
         """
@@ -715,16 +1993,49 @@ class MagpieAgent:
         """
         quantiles = [15, 25, 50, 75, 85]
         labels = [f'white_noise_q{q}' for q in quantiles]
+        values = np.quantile(wls, np.array(quantiles) / 100)
         data = {
             'timestamp': time.time(),
             'block_name': 'white_noise',
-            'data': {
-                k: np.quantile(wls, q / 100)
-                for k, q in zip(labels, quantiles)
-            }
+            'data': dict(zip(labels, values)),
         }
         self.agent.publish_to_feed('white_noise', data)
 
+    def _make_output_frames(self, times, data):
+        """
+        Packs downsampled data into lyrebird frames based on the
+        ``frame_format``.
+        """
+        if self.frame_format == 'block':
+            if not len(times):
+                return []
+            return [block_frame(times, data)]
+        return sample_frames(times, data)
+
+    def _encode_data(self, times, raw, demod, wl):
+        """
+        Maps downsampled readout-channel data onto the focal-plane and packs it
+        into lyrebird frames.
+
+        Args
+        ----
+        times : np.ndarray
+            Array with shape (nsamps) of timestamps (sec)
+        raw, demod, wl : np.ndarray
+            Arrays with shape (nchans, nsamps) of downsampled raw data,
+            demodulated data, and white noise levels for each readout channel.
+        """
+        nchans, nsamps = raw.shape
+        readout_chans, elem_idxs = self._get_scatter_idxs(nchans)
+        nelems = len(self.fp)
+
+        out = {}
+        for name, d in [('raw', raw), ('demod', demod), ('wl', wl)]:
+            out[name] = np.zeros((nsamps, nelems))
+            out[name][:, elem_idxs] = d[readout_chans].T
+
+        return self._make_output_frames(times, out)
+
     def _process_data(self, frame, source_offset=0):
         """
         Processes a Scan frame. If lyrebird is enabled, this will return a seq
@@ -733,76 +2044,17 @@ class MagpieAgent:
         if 'session_id' not in frame:
             return []
 
-        # Calculate downsample factor
-        times_in, data_in = load_frame_data(frame)
+        times_in, data_in = self.decoder.decode(frame)
         times_in = times_in - source_offset
-        sample_rate = 1. / np.median(np.diff(times_in))
-        nsamps = len(times_in)
-        nchans = len(data_in)
 
         self._process_monitored_chans(times_in, data_in)
 
-        if self.demod is None:
-            self.demod = Demodulator(self.demod_freq, self.demod_bandwidth,
-                                     fs=sample_rate)
-        if self.wncalc is None:
-            self.wncalc = WhiteNoiseCalculator(
-                fs=sample_rate, navg=int(sample_rate)
-            )
-
-        demod = self.demod.apply(times_in, data_in)
-        # white noise in units of pA/rt(Hz)
-        wl = self.wncalc.apply(data_in * pA_per_rad)
-        self._publish_wls(np.median(wl, axis=1))
-
-        ds_factor = sample_rate // self.target_rate
-        if np.isnan(ds_factor):  # There is only one element in the timestream
-            ds_factor = 1
-        ds_factor = max(int(ds_factor), 1)  # Prevents downsample factors < 1
-
-        # Arrange output data structure
-        sample_idxs = np.arange(self.ds_offset, nsamps, ds_factor, dtype=np.int32)
-        self.ds_offset = ds_factor - (nsamps - self.ds_offset) % ds_factor
-        num_frames = len(sample_idxs)
-
-        times_out = times_in[sample_idxs]
-        abs_chans = self.mask[np.arange(nchans)]
-
-        nelems = len(self.fp.channels)
-        raw_out = np.zeros((num_frames, nelems))
-        demod_out = np.zeros((num_frames, nelems))
-        wl_out = np.zeros((num_frames, nelems))
-
-        for i, c in enumerate(abs_chans):
-            if c >= len(self.fp.chan_mask):
-                continue
-            idx = self.fp.chan_mask[c]
-            if idx >= 0:
-                raw_out[:, idx] = data_in[i, sample_idxs]
-                demod_out[:, idx] = demod[i, sample_idxs]
-                wl_out[:, idx] = wl[i, sample_idxs]
-
-        out = []
-        for i in range(num_frames):
-            fr = core.G3Frame(core.G3FrameType.Scan)
-            fr['idx'] = 0
-            fr['data'] = core.G3VectorDouble(raw_out[i])
-            fr['timestamp'] = core.G3Time(times_out[i] * core.G3Units.s)
-            out.append(fr)
-
-            fr = core.G3Frame(core.G3FrameType.Scan)
-            fr['idx'] = 1
-            fr['data'] = core.G3VectorDouble(demod_out[i])
-            fr['timestamp'] = core.G3Time(times_out[i] * core.G3Units.s)
-            out.append(fr)
+        sample_idxs, demod, wl = self.proc.process(times_in, data_in)
+        self._update_wls(wl)
 
-            fr = core.G3Frame(core.G3FrameType.Scan)
-            fr['idx'] = 2
-            fr['data'] = core.G3VectorDouble(wl_out[i])
-            fr['timestamp'] = core.G3Time(times_out[i] * core.G3Units.s)
-            out.append(fr)
-
-        return out
+        return self._encode_data(
+            times_in[sample_idxs], data_in[:, sample_idxs], demod, wl
+        )
 
     def read(self, session, params=None):
         """read(src='tcp://localhost:4532')
@@ -814,61 +2066,44 @@ class MagpieAgent:
         pointing to G3Files to be streamed. If a list of filenames is passed,
         once the first file is finished streaming, subsequent files will be
         streamed.
+
+        If the agent is run with ``--pipeline``, frame decoding and processing
+        are run in separate worker processes and this process only encodes
+        lyrebird frames. The queue depth and latency of each stage will then
+        be reported in the session data. ``latency`` is the time spent
+        processing the most recent chunk of data in a stage, and
+        ``queue_wait`` is the time the chunk then waited in the stage's output
+        ring buffer. Errors in the worker processes are raised by the read
+        process.
+
+        Notes:
+            An example of the session data in pipeline mode::
+
+                >>> response.session['data']
+                {'pipeline': {
+                    'decode': {'queue_depth': 0, 'latency': 0.002,
+                               'queue_wait': 0.001},
+                    'dsp': {'queue_depth': 1, 'latency': 0.061,
+                            'queue_wait': 0.003},
+                    'encode': {'queue_depth': 12, 'latency': 0.004}},
+                 'timestamp': 1601924466.1}
         """
 
         self._running = True
         session.set_status('running')
 
-        src_idx = 0
         if isinstance(params['src'], str):
             sources = [params['src']]
         else:
             sources = params['src']
 
-        reader = None
-        source = None
-        source_offset = 0
-        while self._running:
-
-            if reader is None:
-                try:
-                    source = sources[src_idx]
-                    source_is_file = not source.startswith('tcp://')
-                    reader = core.G3Reader(source, timeout=5)
-                except RuntimeError as e:
-                    if source_is_file:
-                        # Raise error if file cannot be found
-                        raise e
-                    else:
-                        # If not a file, log error and try again
-                        self.log.error("G3Reader could not connect! Retrying in 10 sec.")
-                        time.sleep(10)
-                        continue
-
-            frames = reader.Process(None)
-            if not frames:
-                # If source is a file, start over with next file or break if
-                # finished all sources. If socket, just reset reader and try to
-                # reconnect
-                if source_is_file:
-                    src_idx += 1
-                    if src_idx >= len(sources):
-                        self.log.info("Finished reading all sources")
-                        break
-                reader = None
-                continue
-
-            frame = frames[0]
-
-            # If this source is a file, this will shift the timestamps so that
-            # data lines up with the current timestamp instead of using the
-            # timestamps in the file
-            if source_is_file and (not source_offset):
-                source_offset = frame['time'].time / core.G3Units.s \
-                    - time.time()
-            elif not source_is_file:
-                source_offset = 0
+        if self.pipeline:
+            self._read_pipelined(session, sources)
+            self._publish_tods(self.tod_batcher.flush())
+            return True, "Stopped read process"
 
+        running = lambda: self._running  # noqa: E731
+        for frame, source_offset in read_frames(sources, self.log, running):
             if frame.type == core.G3FrameType.Wiring:
                 self._process_status(frame)
                 continue
@@ -882,8 +2117,115 @@ class MagpieAgent:
                 # This is useful if the src is a file and reader.Process does
                 # not block
                 self.out_queue.put(f)
+        self._publish_tods(self.tod_batcher.flush())
         return True, "Stopped read process"
 
+    def _read_pipelined(self, session, sources):
+        """
+        Runs the read process as a pipeline. Frame decoding and processing
+        run in separate worker processes connected by shared-memory ring
+        buffers, and this process maps the processed data onto the focal-plane
+        and encodes lyrebird frames.
+        """
+        ctx = mp.get_context('fork')
+        max_samps = self.pipeline_max_samps
+        decode_ring = SharedRingBuffer(self.pipeline_slots, {
+            'times': ((max_samps,), np.float64),
+            'data': ((MAX_CHANS, max_samps), np.float32),
+        }, ctx=ctx)
+        dsp_ring = SharedRingBuffer(self.pipeline_slots, {
+            'times': ((max_samps,), np.float64),
+            'raw': ((MAX_CHANS, max_samps), np.float32),
+            'demod': ((MAX_CHANS, max_samps), np.float32),
+            'wl': ((MAX_CHANS, max_samps), np.float32),
+        }, ctx=ctx)
+        stop_event = ctx.Event()
+        self._pipeline_config = ctx.Queue()
+        workers = [
+            ctx.Process(target=_decode_worker, name='decode', daemon=True,
+                        args=(sources, decode_ring, stop_event, max_samps)),
+            ctx.Process(target=_dsp_worker, name='dsp', daemon=True, args=(
+                decode_ring, dsp_ring, stop_event, self._pipeline_config,
+                self.proc, self.monitored_channels,
+                self.monitored_chan_sample_rate)),
+        ]
+        for w in workers:
+            w.start()
+
+        stats = {
+            'decode': {'queue_depth': 0, 'latency': 0, 'queue_wait': 0},
+            'dsp': {'queue_depth': 0, 'latency': 0, 'queue_wait': 0},
+            'encode': {'queue_depth': 0, 'latency': 0},
+        }
+        try:
+            while self._running:
+                try:
+                    slot, meta = dsp_ring.get(timeout=1)
+                except queue.Empty:
+                    for w in workers:
+                        if not w.is_alive() and w.exitcode != 0:
+                            raise RuntimeError(
+                                f"Pipeline {w.name} worker exited "
+                                f"unexpectedly (exit code {w.exitcode})"
+                            )
+                    continue
+
+                if meta['type'] == 'stop':
+                    break
+                elif meta['type'] == 'error':
+                    self.log.error("Pipeline {stage} worker failed:\n{tb}",
+                                   stage=meta['stage'], tb=meta['traceback'])
+                    raise meta['error']
+                elif meta['type'] == 'mask':
+                    self._set_mask(meta['mask'])
+                    continue
+
+                t_start = time.time()
+                nchans, nsamps = meta['nchans'], meta['nsamps']
+                arrs = dsp_ring.slot_arrays(slot)
+                times = arrs['times'][:nsamps].copy()
+                raw = arrs['raw'][:nchans, :nsamps]
+                demod = arrs['demod'][:nchans, :nsamps]
+                wl = arrs['wl'][:nchans, :nsamps]
+
+                if not self.monitored_channels:
+                    self._publish_tods(self.tod_batcher.flush())
+                elif 'monitored' in meta:
+                    self._check_monitored_chans(nchans)
+                    self._publish_tods(self.tod_batcher.add(*meta['monitored']))
+                self._update_wls(wl)
+                out = self._encode_data(times, raw, demod, wl)
+                dsp_ring.release(slot)
+                t_stop = time.time()
+
+                stats['decode']['queue_depth'] = decode_ring.depth()
+                stats['decode']['latency'] = meta['decode_latency']
+                stats['decode']['queue_wait'] = meta['dsp_start'] - meta['decode_time']
+                stats['dsp']['queue_depth'] = dsp_ring.depth()
+                stats['dsp']['latency'] = meta['dsp_time'] - meta['dsp_start']
+                stats['dsp']['queue_wait'] = t_start - meta['dsp_time']
+                stats['encode']['queue_depth'] = self.out_queue.qsize()
+                stats['encode']['latency'] = t_stop - t_start
+                session.data = {'pipeline': stats, 'timestamp': t_stop}
+
+                for f in out:
+                    self.out_queue.put(f)
+        finally:
+            stop_event.set()
+            # Drain the output ring so the DSP worker isn't blocked on it
+            drain_until = time.time() + 5
+            while any(w.is_alive() for w in workers) and time.time() < drain_until:
+                try:
+                    slot, _ = dsp_ring.get(timeout=0.1)
+                    dsp_ring.release(slot)
+                except queue.Empty:
+                    pass
+            for w in workers:
+                w.join(timeout=1)
+                if w.is_alive():
+                    w.terminate()
+            self._pipeline_config = None
+
     def _stop_read(self, session, params=None):
         self._running = False
         return True, "Stopping read process"
@@ -895,7 +2237,7 @@ class MagpieAgent:
         G3Frames full of fake data to be sent to lyrebird.
         """
         self._run_fake_stream = True
-        ndets = len(self.fp.channels)
+        ndets = len(self.fp)
         chans = np.arange(ndets)
         frame_start = time.time()
         while self._run_fake_stream:
@@ -908,18 +2250,11 @@ class MagpieAgent:
             data_out = np.random.normal(0, 1, (nframes, ndets))
             data_out += np.sin(2 * np.pi * ts[:, None] + .2 * chans[None, :])
 
-            for t, d in zip(ts, data_out):
-                fr = core.G3Frame(core.G3FrameType.Scan)
-                fr['idx'] = 0
-                fr['data'] = core.G3VectorDouble(d)
-                fr['timestamp'] = core.G3Time(t * core.G3Units.s)
-                self.out_queue.put(fr)
-
-                fr = core.G3Frame(core.G3FrameType.Scan)
-                fr['idx'] = 1
-                fr['data'] = core.G3VectorDouble(np.sin(d))
-                fr['timestamp'] = core.G3Time(t * core.G3Units.s)
-                self.out_queue.put(fr)
+            out = self._make_output_frames(
+                ts, {'raw': data_out, 'demod': np.sin(data_out)}
+            )
+            for f in out:
+                self.out_queue.put(f)
 
         return True, "Stopped fake stream process"
 
@@ -936,29 +2271,61 @@ class MagpieAgent:
         regulate how fast it sends frames such that the delay between when the
         frames are sent, and the timestamp of the frames are fixed.
 
+        Frames are paced by a PacingScheduler, and frames that fall more than
+        ``--latency-budget`` seconds behind are dropped. Pacing metrics are
+        published to the ``send_stats`` feed and saved in the session data.
+
+        Notes:
+            An example of the session data::
+
+                >>> response.session['data']
+                {'backlog': 12,
+                 'pending': 3,
+                 'dropped_frames': 0,
+                 'resyncs': 1,
+                 'send_latency': 0.004,
+                 'send_jitter': 0.002,
+                 'timestamp': 1601924466.1}
         """
         self._send_running = True
 
-        first_frame_time = None
-        stream_start_time = None
-
         sender = core.G3NetworkSender(
             hostname='*', port=params['dest'], max_queue_size=1000
         )
+        sched = PacingScheduler(
+            self.delay, latency_budget=self.latency_budget,
+            batch_interval=self.send_batch_interval
+        )
 
         sender.Process(self.fp.config_frame())
         session.set_status('running')
+        last_stats = time.monotonic()
         while session.status in ['starting', 'running']:
-            f = self.out_queue.get(block=True)
-            t = f['timestamp'].time / core.G3Units.s
-            now = time.time()
-            if first_frame_time is None:
-                first_frame_time = t
-                stream_start_time = now
-
-            this_frame_time = stream_start_time + (t - first_frame_time) + self.delay
-            sleep_while_running(this_frame_time - now, session)
-            sender.Process(f)
+            now = time.monotonic()
+            sched.delay = self.delay
+            while sched.wants_frames(now):
+                try:
+                    f = self.out_queue.get_nowait()
+                except queue.Empty:
+                    break
+                sched.add(f, now, caught_up=self.out_queue.empty())
+
+            now = time.monotonic()
+            for f in sched.pop_due(now):
+                sender.Process(f)
+
+            if now - last_stats > self.send_stats_interval:
+                last_stats = now
+                stats = sched.stats()
+                stats['backlog'] = stats['pending'] + self.out_queue.qsize()
+                self.agent.publish_to_feed('send_stats', {
+                    'timestamp': time.time(),
+                    'block_name': 'send_stats',
+                    'data': stats,
+                })
+                session.data = dict(stats, timestamp=time.time())
+
+            time.sleep(sched.wait_time(time.monotonic()))
 
         return True, "Stopped send process"
 
@@ -989,6 +2356,30 @@ def make_parser(parser=None):
              "This must be larger than the frame-aggregation time for smooth "
              "update times in lyrebird."
     )
+    pgroup.add_argument('--latency-budget', type=float, default=2.,
+                        help="Max time (sec) an outgoing frame can fall "
+                             "behind its send time before it is dropped.")
+    pgroup.add_argument('--send-batch-interval', type=float, default=0.05,
+                        help="Max time (sec) between batches of frames sent "
+                             "to lyrebird.")
+    pgroup.add_argument('--frame-format', default='sample',
+                        choices=['sample', 'block'],
+                        help="Format of frames sent to lyrebird. 'sample' sends "
+                             "one frame per sample per data quantity. 'block' "
+                             "packs all samples from an incoming frame into a "
+                             "single frame, and requires a lyrebird build that "
+                             "supports block frames.")
+    pgroup.add_argument('--pipeline', action='store_true',
+                        help="If set, incoming frames will be decoded and "
+                             "processed in separate worker processes.")
+    pgroup.add_argument('--pipeline-slots', type=int, default=4,
+                        help="Number of slots in each pipeline ring buffer.")
+    pgroup.add_argument('--pipeline-max-samps', type=int, default=400,
+                        help="Max number of samples per pipeline ring buffer "
+                             "slot. Larger frames will be split into chunks.")
+    pgroup.add_argument('--wl-publish-interval', type=float, default=10,
+                        help="Time (sec) between publishing white-noise "
+                             "quantiles to the white_noise feed.")
     pgroup.add_argument('--layout', '-l', default='grid', choices=['grid', 'wafer'],
                         help="Focal plane layout style")
     pgroup.add_argument('--xdim', type=int, default=64,
@@ -1008,6 +2399,14 @@ def make_parser(parser=None):
                         help="Readout channels to start monitoring on startup")
     pgroup.add_argument('--monitored-channel-rate', type=float, default=10,
                         help="Target sample rate for monitored channels")
+    pgroup.add_argument('--monitored-channel-flush-interval', type=float,
+                        default=1.,
+                        help="Time (sec) between publishing buffered "
+                             "monitored channel data")
+    pgroup.add_argument('--monitored-channel-max-points', type=int,
+                        default=10000,
+                        help="Max number of data points (samples x channels) "
+                             "in a single published detector_tods block")
     pgroup.add_argument('--demod-freq', type=float, default=8,
                         help="Demodulation frequency")
     pgroup.add_argument('--demod-bandwidth', type=float, default=0.5,
@@ -1023,6 +2422,7 @@ if __name__ == '__main__':
 
     agent, runner = ocs_agent.init_site_agent(args)
     magpie = MagpieAgent(agent, args)
+    magpie.start_tod_flush_loop()
 
     if args.fake_data:
         read_startup = False
@@ -10,6 +10,7 @@ from twisted.internet import reactor
 from ocs import ocs_agent, site_config, ocs_feed
 
 from socs.db.suprsync import SupRsyncFilesManager, create_file
+from socs.util import get_md5sums
 
 
 def create_remote_path(meta, archive_name):
@@ -86,6 +87,8 @@ class PysmurfMonitor(DatagramProtocol):
         echo_sql (bool):
             If True, will echo all sql statements whenever writing to the
             suprsync db.
+        hash_workers (int):
+            Number of threads used to compute the md5sums of new files.
     """
 
     def __init__(self, agent, args):
@@ -95,6 +98,7 @@ class PysmurfMonitor(DatagramProtocol):
         self.db_path = args.db_path
         self.running = False
         self.echo_sql = args.echo_sql
+        self.hash_workers = args.hash_workers
 
         self.agent.register_feed('pysmurf_session_data')
 
@@ -164,7 +168,7 @@ class PysmurfMonitor(DatagramProtocol):
         self.running = True
         session.set_status('running')
         while self.running:
-            files = []
+            new_files = []
             while not self.file_queue.empty():
                 meta = self.file_queue.get()
                 # Archive name defaults to pysmurf because that is currently
@@ -189,8 +193,28 @@ class PysmurfMonitor(DatagramProtocol):
                             if key in local_path:
                                 deletable = False
 
+                    new_files.append(
+                        (meta, local_path, remote_path, archive_name, deletable)
+                    )
+                except Exception as e:
+                    self.agent.log.error(
+                        "Could not generate SupRsync file object from "
+                        "metadata:\n{meta}\nRaised Exception: {e}",
+                        meta=meta, e=e
+                    )
+
+            # Hash the whole burst of new files concurrently
+            md5sums = get_md5sums([f[1] for f in new_files],
+                                  max_workers=self.hash_workers)
+
+            files = []
+            for meta, local_path, remote_path, archive_name, deletable in new_files:
+                try:
+                    # create_file computes the md5sum itself if the batch
+                    # couldn't, raising the error for unreadable files
                     files.append(
                         create_file(local_path, remote_path, archive_name,
+                                    local_md5sum=md5sums.get(local_path),
                                     deletable=deletable)
                     )
                 except Exception as e:
@@ -224,6 +248,9 @@ def make_parser(parser=None):
     pgroup.add_argument('--db-path', type=str, default='/data/so/databases/suprsync.db',
                         help="Path to suprsync sqlite database")
     pgroup.add_argument('--echo-sql', action='store_true')
+    pgroup.add_argument('--hash-workers', type=int, default=4,
+                        help="Number of threads used to compute md5sums of "
+                             "new files")
     return parser
 
 
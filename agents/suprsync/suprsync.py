@@ -44,6 +44,14 @@ class SupRsync:
         Time (sec) for which cmds run on the remote will timeout
     copy_timeout : float
         Time (sec) after which a copy command will timeout
+    copy_streams : int
+        Number of concurrent rsync processes used to copy each batch
+    copy_retries : int
+        Number of times a failed rsync process is retried
+    verify_workers : int, optional
+        Number of parallel md5sum processes used to verify copied files
+    ssh_multiplex : bool
+        If true, ssh and rsync commands share a persistent ssh connection
     """
 
     def __init__(self, agent, args):
@@ -59,6 +67,10 @@ class SupRsync:
         self.running = False
         self.cmd_timeout = args.cmd_timeout
         self.copy_timeout = args.copy_timeout
+        self.copy_streams = args.copy_streams
+        self.copy_retries = args.copy_retries
+        self.verify_workers = args.verify_workers
+        self.ssh_multiplex = args.ssh_multiplex
         self.files_per_batch = args.files_per_batch
         self.sleep_time = args.sleep_time
 
@@ -67,6 +79,21 @@ class SupRsync:
 
         **Process** - Main run process for the SupRsync agent. Continuosly
         checks the suprsync db checking for files that need to be handled.
+
+        Notes:
+            Stats for the most recent batch of copied files are stored in
+            session data in the structure::
+
+                >>> response.session['data']
+                {'last_copy': {'timestamp': 1634850000.,
+                               'files': 100,
+                               'bytes': 2000000000,
+                               'duration': 20.,
+                               'throughput': 100.,
+                               'failed_shards': 0}}
+
+            ``throughput`` is the total rate across all rsync processes, in
+            MB/s.
         """
 
         srfm = SupRsyncFilesManager(self.db_path, create_all=True)
@@ -74,23 +101,33 @@ class SupRsync:
         handler = SupRsyncFileHandler(
             srfm, self.archive_name, self.remote_basedir, ssh_host=self.ssh_host,
             ssh_key=self.ssh_key, cmd_timeout=self.cmd_timeout,
-            copy_timeout=self.copy_timeout
+            copy_timeout=self.copy_timeout, num_streams=self.copy_streams,
+            copy_retries=self.copy_retries, verify_workers=self.verify_workers,
+            ssh_multiplex=self.ssh_multiplex
         )
 
         self.running = True
         session.set_status('running')
-
-        while self.running:
-            try:
-                handler.copy_files(max_copy_attempts=self.max_copy_attempts,
-                                   num_files=self.files_per_batch)
-            except subprocess.TimeoutExpired as e:
-                self.log.error("Timeout when copying files! {e}", e=e)
-
-            if self.delete_after is not None:
-                handler.delete_files(self.delete_after)
-            time.sleep(self.sleep_time)
-
+        session.data = {}
+
+        try:
+            while self.running:
+                try:
+                    stats = handler.copy_files(
+                        max_copy_attempts=self.max_copy_attempts,
+                        num_files=self.files_per_batch
+                    )
+                    if stats is not None:
+                        session.data['last_copy'] = {'timestamp': time.time(),
+                                                     **stats}
+                except subprocess.TimeoutExpired as e:
+                    self.log.error("Timeout when copying files! {e}", e=e)
+
+                if self.delete_after is not None:
+                    handler.delete_files(self.delete_after)
+                time.sleep(self.sleep_time)
+        finally:
+            handler.close()
         return True, "Stopped run process"
 
     def _stop(self, session, params=None):
@@ -98,6 +135,13 @@ class SupRsync:
         session.set_status('stopping')
 
 
+def _positive_int(value):
+    ivalue = int(value)
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return ivalue
+
+
 def make_parser(parser=None):
     if parser is None:
         parser = argparse.ArgumentParser()
@@ -116,6 +160,10 @@ def make_parser(parser=None):
                              "'<user>@<host>'). If None, will copy files locally")
     pgroup.add_argument('--ssh-key', type=str,
                         help="Path to ssh-key needed to access remote host")
+    pgroup.add_argument('--ssh-multiplex', action='store_true',
+                        help="Share one persistent ssh connection (ssh "
+                             "ControlMaster) between all ssh and rsync "
+                             "commands, reopening it if it drops")
     pgroup.add_argument('--delete-local-after', type=float,
                         help="Time (sec) after which this agent will delete "
                              "local copies of successfully transfered files. "
@@ -125,6 +173,18 @@ def make_parser(parser=None):
                              "will stop trying to copy a file")
     pgroup.add_argument('--copy-timeout', type=float,
                         help="Time (sec) before the rsync command will timeout")
+    pgroup.add_argument('--copy-streams', type=int, default=1,
+                        help="Number of rsync processes to run concurrently. "
+                             "Each batch is split into this many shards of "
+                             "roughly equal size.")
+    pgroup.add_argument('--copy-retries', type=int, default=0,
+                        help="Number of times to retry a failed rsync process "
+                             "before counting a failed copy attempt")
+    pgroup.add_argument('--verify-workers', type=_positive_int,
+                        help="Number of md5sum processes to run in parallel "
+                             "on the remote when verifying copied files. "
+                             "Results are streamed back over one ssh session. "
+                             "If None, runs a single md5sum over all files.")
     pgroup.add_argument('--cmd-timeout', type=float,
                         help="Time (sec) before remote commands will timeout")
     pgroup.add_argument('--files-per-batch', type=int,
@@ -0,0 +1,380 @@
+import argparse
+import calendar
+import json
+import logging
+import socket
+import struct
+import time
+from collections import deque
+
+from twisted.internet import protocol, reactor, task
+from twisted.web import resource, server
+
+# Used when soaculib isn't installed. Matches the layout of the ACU's
+# PositionBroadcast stream: day of year and seconds of day, followed by
+# doubles.
+DEFAULT_SCHEMA = {
+    'format': '<i' + 'd' * 12,
+    'fields': ['Day', 'Time', 'Azimuth', 'Elevation', 'Azimuth_raw',
+               'Elevation_raw', 'Azimuth_Current_1', 'Azimuth_Current_2',
+               'Elevation_Current_1', 'Boresight', 'Boresight_raw',
+               'Corrected_Azimuth', 'Corrected_Elevation'],
+}
+
+# Minimal StatusSATPDetailed8100-style dataset, used when no status file is
+# given
+DEFAULT_STATUS = {
+    'Time': 1.,
+    'Year': 1970,
+    'Azimuth mode': 'Stop',
+    'Azimuth current position': 0.,
+    'Azimuth current velocity': 0.,
+    'Azimuth commanded position': float('nan'),
+    'Elevation mode': 'Stop',
+    'Elevation current position': 0.,
+    'Elevation current velocity': 0.,
+    'Elevation commanded position': float('nan'),
+    'Boresight mode': 'Stop',
+    'Boresight current position': 0.,
+    'Boresight commanded position': float('nan'),
+    'Qty of free program track stack positions': 9999,
+}
+
+MODES = ('Stop', 'Preset', 'ProgramTrack', 'Stow', 'SurvivalMode', 'Rate',
+         'StarTrack')
+
+
+def get_schema(name=None):
+    """
+    Returns the UDP stream schema with the given name from soaculib, or the
+    default schema if soaculib isn't installed or no name is given.
+    """
+    if name is not None:
+        try:
+            import soaculib
+            return soaculib.get_stream_schema(name)
+        except ImportError:
+            logging.getLogger().warning(
+                'soaculib not installed, using the default UDP schema')
+    return DEFAULT_SCHEMA
+
+
+def day_time(t):
+    """
+    Converts a ctime into the ACU's (year, day of year, seconds of day)
+    time code.
+    """
+    tm = time.gmtime(t)
+    gyear = calendar.timegm((tm.tm_year, 1, 1, 0, 0, 0))
+    day, sec = divmod(t - gyear, 86400)
+    return tm.tm_year, int(day) + 1, sec
+
+
+def parse_ptstack(text, now):
+    """
+    Parses uploaded ProgramTrack lines into a list of (ctime, az, el) points.
+    Lines are ``DDD, HH:MM:SS.ffffff; az; el; azvel; elvel; azflag;
+    elflag``. Points are assumed to be in the same year as ``now``.
+    """
+    gyear = calendar.timegm((time.gmtime(now).tm_year, 1, 1, 0, 0, 0))
+    points = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        cols = line.split(';')
+        if len(cols) != 7:
+            raise ValueError(f'Invalid ProgramTrack line: {line!r}')
+        day, hms = cols[0].split(',')
+        h, m, s = hms.split(':')
+        t = (gyear + (int(day) - 1) * 86400 + int(h) * 3600 + int(m) * 60
+             + float(s))
+        points.append((t, float(cols[1]), float(cols[2])))
+    return points
+
+
+class ACUState:
+    """
+    Simulated ACU axes and ProgramTrack stack. Axes jump to commanded
+    positions, and in ProgramTrack mode follow the stack, dropping points as
+    their times pass.
+
+    Parameters:
+        az (float): Initial azimuth
+        el (float): Initial elevation
+        stack_size (int): Number of ProgramTrack stack positions
+        status (dict): Template of the status dataset returned by Values.
+            Keys for time, positions, modes and free stack positions are
+            kept up to date.
+
+    """
+
+    def __init__(self, az=180., el=50., stack_size=9999, status=None):
+        self.az = az
+        self.el = el
+        self.bs = 0.
+        self.modes = {'Azimuth': 'Stop', 'Elevation': 'Stop',
+                      'Boresight': 'Stop'}
+        self.stack_size = stack_size
+        self.stack = deque()
+        self.status = dict(DEFAULT_STATUS if status is None else status)
+        self.n_uploads = 0
+        self.n_values = 0
+
+    @property
+    def free_positions(self):
+        return self.stack_size - len(self.stack)
+
+    def step(self, now):
+        """Advances the ProgramTrack stack to the given time."""
+        tracking = self.modes['Azimuth'] == 'ProgramTrack'
+        while self.stack and self.stack[0][0] <= now:
+            _, az, el = self.stack.popleft()
+            if tracking:
+                self.az = az
+                if self.modes['Elevation'] == 'ProgramTrack':
+                    self.el = el
+
+    def upload(self, text, now):
+        """Adds ProgramTrack lines to the stack."""
+        points = parse_ptstack(text, now)
+        if len(points) > self.free_positions:
+            raise ValueError('ProgramTrack stack overflow')
+        self.stack.extend(points)
+        self.n_uploads += 1
+
+    def command(self, identifier, command, params):
+        """
+        Handles mode changes, presets and stack clears. Modes are taken from
+        the command parameters, and apply to the axes named in the command,
+        or to all axes if none are named.
+        """
+        words = ' '.join([identifier, command] + list(params))
+        if 'Clear' in words and 'Stack' in words:
+            self.stack.clear()
+            return
+        axes = [a for a in self.modes if a in command] or list(self.modes)
+        for mode in MODES:
+            if mode in params or mode == command:
+                for a in axes:
+                    self.modes[a] = mode
+        nums = []
+        for p in params:
+            try:
+                nums.append(float(p))
+            except ValueError:
+                pass
+        if 'Preset' in words and nums:
+            for axis, value in zip(axes, nums):
+                setattr(self, {'Azimuth': 'az', 'Elevation': 'el',
+                               'Boresight': 'bs'}[axis], value)
+
+    def values(self, now):
+        """Returns the status dataset at the given time."""
+        self.step(now)
+        year, day, sec = day_time(now)
+        self.status.update({
+            'Time': day + sec / 86400.,
+            'Year': year,
+            'Azimuth mode': self.modes['Azimuth'],
+            'Azimuth current position': self.az,
+            'Elevation mode': self.modes['Elevation'],
+            'Elevation current position': self.el,
+            'Boresight mode': self.modes['Boresight'],
+            'Boresight current position': self.bs,
+            'Qty of free program track stack positions': self.free_positions,
+        })
+        self.n_values += 1
+        return self.status
+
+    def broadcast_values(self, t, fields):
+        """Returns the values of one UDP broadcast record at time t."""
+        _, day, sec = day_time(t)
+        vals = {'Day': day, 'Time': sec}
+        for name in ('Azimuth', 'Azimuth_raw', 'Corrected_Azimuth'):
+            vals[name] = self.az
+        for name in ('Elevation', 'Elevation_raw', 'Corrected_Elevation'):
+            vals[name] = self.el
+        for name in ('Boresight', 'Boresight_raw'):
+            vals[name] = self.bs
+        return [vals.get(f.replace(' ', '_'), 0.) for f in fields]
+
+
+class ACUResource(resource.Resource):
+    """
+    HTTP interface of the ACU. Serves ``Values``, ``Version``, ``Command``
+    and ``UploadPtStack`` at any path ending in those names, so it works
+    with both the base and readonly URLs used by soaculib.
+    """
+    isLeaf = True
+
+    def __init__(self, state, clock=reactor):
+        super().__init__()
+        self.state = state
+        self.clock = clock
+        self.log = logging.getLogger()
+
+    def render_GET(self, request):
+        endpoint = request.path.decode().rstrip('/').split('/')[-1]
+        args = {k.decode(): [v.decode() for v in vs]
+                for k, vs in request.args.items()}
+        now = self.clock.seconds()
+        try:
+            if endpoint == 'Values':
+                return json.dumps(self.state.values(now)).encode()
+            elif endpoint == 'Version':
+                return b'ACU simulator'
+            elif endpoint == 'Command':
+                params = [v for k, vs in args.items()
+                          if k.startswith('param') for v in vs]
+                self.state.step(now)
+                self.state.command(args.get('identifier', [''])[0],
+                                   args.get('command', [''])[0], params)
+                return b'OK, Command executed.'
+            elif endpoint == 'UploadPtStack':
+                self.state.step(now)
+                body = request.content.read() if request.content else b''
+                if not body.strip():
+                    # Lines may also be sent as a form field
+                    body = max((v for vs in request.args.values() for v in vs),
+                               key=len, default=b'')
+                self.state.upload(body.decode(), now)
+                return b'OK, Command send.'
+        except ValueError as e:
+            self.log.warning(str(e))
+            request.setResponseCode(400)
+            return str(e).encode()
+        request.setResponseCode(404)
+        return b'Unknown endpoint'
+
+    render_POST = render_GET
+
+
+class UDPBroadcaster:
+    """
+    Sends PositionBroadcast-style UDP datagrams of the simulated positions.
+
+    Parameters:
+        state (ACUState): Simulated ACU
+        address (tuple): (host, port) to send datagrams to
+        schema (dict): UDP stream schema with ``format`` and ``fields``
+        sample_rate (float): Records per second
+        samples_per_packet (int): Records per datagram
+        clock (IReactorTime): Provides the time and looping calls
+
+    """
+
+    def __init__(self, state, address, schema=DEFAULT_SCHEMA,
+                 sample_rate=200., samples_per_packet=10, clock=reactor):
+        self.state = state
+        self.address = address
+        self.fields = schema['fields']
+        self.packer = struct.Struct(schema['format'])
+        self.sample_rate = sample_rate
+        self.samples_per_packet = samples_per_packet
+        self.clock = clock
+        self.n_records = 0
+        self.transport = None
+        self._loop = None
+        self._t0 = None
+        self._k = 0
+
+    def packet(self):
+        """Builds the next datagram, advancing the sample time."""
+        now = self.clock.seconds()
+        if self._t0 is None or now - self._sample_time(self._k) > 1.:
+            # Start (or restart, after falling behind) the sample clock
+            self._t0, self._k = now - self.samples_per_packet / self.sample_rate, 0
+        self.state.step(now)
+        records = []
+        for _ in range(self.samples_per_packet):
+            self._k += 1
+            records.append(self.packer.pack(*self.state.broadcast_values(
+                self._sample_time(self._k), self.fields)))
+        self.n_records += self.samples_per_packet
+        return b''.join(records)
+
+    def _sample_time(self, k):
+        return self._t0 + k / self.sample_rate
+
+    def _send(self):
+        self.transport.write(self.packet(), self.address)
+
+    def start(self):
+        # Twisted UDP transports need an IP address rather than a host name
+        host, port = self.address
+        self.address = (socket.gethostbyname(host), port)
+        self.transport = reactor.listenUDP(0, protocol.DatagramProtocol())
+        self._loop = task.LoopingCall(self._send)
+        self._loop.clock = self.clock
+        self._loop.start(self.samples_per_packet / self.sample_rate)
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        if self.transport is not None:
+            self.transport.stopListening()
+
+
+def make_parser(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser()
+
+    parser.add_argument('--http-port', type=int, default=8100,
+                        help="Port to serve the ACU HTTP interface on")
+    parser.add_argument('--udp-host', type=str, default='localhost',
+                        help="Host to send UDP broadcast datagrams to")
+    parser.add_argument('--udp-port', type=int, default=10004,
+                        help="Port to send UDP broadcast datagrams to")
+    parser.add_argument('--schema', type=str, default=None,
+                        help="soaculib UDP stream schema name, e.g. 'v2'. "
+                             "Uses a built-in schema if not given.")
+    parser.add_argument('--sample-rate', type=float, default=200.,
+                        help="UDP broadcast records per second")
+    parser.add_argument('--samples-per-packet', type=int, default=10,
+                        help="UDP broadcast records per datagram")
+    parser.add_argument('--stack-size', type=int, default=9999,
+                        help="Number of ProgramTrack stack positions")
+    parser.add_argument('--status-file', type=str, default=None,
+                        help="JSON file with a recorded Values response, "
+                             "used as the template of the status dataset")
+    parser.add_argument('--log-level',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        default='info',
+                        help="Minimum log level to be displayed")
+    return parser
+
+
+def load_status(filename):
+    """
+    Loads a recorded Values response. The file may hold the response itself,
+    or a dict with the response under ``values``.
+    """
+    with open(filename) as f:
+        status = json.load(f)
+    return status.get('values', status)
+
+
+if __name__ == '__main__':
+    parser = make_parser()
+    args = parser.parse_args()
+
+    log_level = {
+        'debug': logging.DEBUG,
+        'info': logging.INFO,
+        'warning': logging.WARNING,
+        'error': logging.ERROR
+    }[args.log_level]
+    logging.basicConfig(level=log_level,
+                        format='%(asctime)-15s [%(levelname)s]:  %(message)s')
+
+    status = None if args.status_file is None else load_status(args.status_file)
+    state = ACUState(stack_size=args.stack_size, status=status)
+    reactor.listenTCP(args.http_port, server.Site(ACUResource(state)))
+    broadcaster = UDPBroadcaster(state, (args.udp_host, args.udp_port),
+                                 schema=get_schema(args.schema),
+                                 sample_rate=args.sample_rate,
+                                 samples_per_packet=args.samples_per_packet)
+    reactor.callWhenRunning(broadcaster.start)
+    logging.info(f'Serving ACU HTTP interface on port {args.http_port}, '
+                 f'broadcasting to {args.udp_host}:{args.udp_port}')
+    reactor.run()
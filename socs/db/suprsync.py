@@ -1,16 +1,25 @@
 import os
+import re
+import heapq
+import shlex
+import shutil
 import time
 import subprocess
+import signal
 import tempfile
+import threading
 import txaio
+from concurrent.futures import ThreadPoolExecutor
 
-from sqlalchemy import (Column, create_engine, Integer, String, Float, Boolean)
+from sqlalchemy import (Column, create_engine, Integer, String, Float, Boolean,
+                        Index, or_)
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 from socs.util import get_md5sum
 
 TABLE_VERSION = 0
+MD5_RE = re.compile('[0-9a-f]{32}')
 txaio.use_twisted()
 
 
@@ -48,6 +57,12 @@ class SupRsyncFile(Base):
             Whether file should be deleted after copying
     """
     __tablename__ = f"supersync_v{TABLE_VERSION}"
+    __table_args__ = (
+        Index('ix_supersync_copyable', 'archive_name', 'removed',
+              'failed_copy_attempts'),
+        Index('ix_supersync_deletable', 'archive_name', 'removed',
+              'deletable', 'timestamp'),
+    )
 
     id = Column(Integer, primary_key=True)
     local_path = Column(String, nullable=False)
@@ -147,6 +162,16 @@ class SupRsyncFilesManager:
 
         if create_all:
             Base.metadata.create_all(self._engine)
+            self.create_indexes()
+
+    def create_indexes(self):
+        """
+        Creates any indexes missing from the files table. ``create_all`` only
+        creates indexes along with new tables, so this adds indexes to tables
+        created by older versions of socs.
+        """
+        for index in SupRsyncFile.__table__.indexes:
+            index.create(self._engine, checkfirst=True)
 
     def add_file(self, local_path, remote_path, archive_name,
                  local_md5sum=None, timestamp=None, session=None,
@@ -212,18 +237,15 @@ class SupRsyncFilesManager:
         query = session.query(SupRsyncFile).filter(
             SupRsyncFile.removed == None,  # noqa: E711
             SupRsyncFile.archive_name == archive_name,
-            SupRsyncFile.failed_copy_attempts < max_copy_attempts
-        )
+            SupRsyncFile.failed_copy_attempts < max_copy_attempts,
+            or_(SupRsyncFile.remote_md5sum == None,  # noqa: E711
+                SupRsyncFile.local_md5sum != SupRsyncFile.remote_md5sum),
+        ).order_by(SupRsyncFile.id)
 
-        files = []
-        for f in query.all():
-            if f.local_md5sum != f.remote_md5sum:
-                files.append(f)
-            if num_files is not None:
-                if len(files) >= num_files:
-                    break
+        if num_files is not None:
+            query = query.limit(num_files)
 
-        return files
+        return query.all()
 
     def get_deletable_files(self, archive_name, delete_after, session=None):
         """
@@ -247,28 +269,70 @@ class SupRsyncFilesManager:
         query = session.query(SupRsyncFile).filter(
             SupRsyncFile.removed == None,  # noqa: E711
             SupRsyncFile.archive_name == archive_name,
-            SupRsyncFile.deletable,
-        )
+            SupRsyncFile.deletable == True,  # noqa: E712
+            SupRsyncFile.timestamp < time.time() - delete_after,
+            SupRsyncFile.local_md5sum == SupRsyncFile.remote_md5sum,
+        ).order_by(SupRsyncFile.id)
+
+        return query.all()
 
-        files = []
-        now = time.time()
-        for f in query.all():
-            if f.local_md5sum == f.remote_md5sum:
-                if now > f.timestamp + delete_after:
-                    files.append(f)
 
-        return files
+def shard_by_size(sizes, num_shards):
+    """
+    Splits items into shards with roughly equal total size, assigning the
+    largest remaining item to the smallest shard.
+
+    Args
+    ----
+        sizes : list
+            Size of each item
+        num_shards : int
+            Maximum number of shards
+
+    Returns
+    -------
+        shards : list
+            List of non-empty lists of item indices. Indices within each
+            shard are sorted.
+    """
+    heap = [(0, i) for i in range(min(num_shards, len(sizes)))]
+    shards = [[] for _ in heap]
+    for idx in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        total, i = heapq.heappop(heap)
+        shards[i].append(idx)
+        heapq.heappush(heap, (total + sizes[idx], i))
+    return [sorted(shard) for shard in shards]
 
 
 class SupRsyncFileHandler:
     """
     Helper class to handle files in the suprsync db and copy them to their
     dest / delete them if enough time has passed.
+
+    Args
+    ----
+        num_streams : int
+            Number of rsync processes to copy each batch of files with
+        copy_retries : int
+            Number of times to retry a failed rsync process before counting a
+            failed copy attempt for its files
+        verify_workers : int, optional
+            If set, copied files are verified by this many parallel md5sum
+            processes on the remote, streaming results back over a single ssh
+            session. Must be at least 1. Otherwise a single md5sum command is
+            run over all files.
+        ssh_multiplex : bool
+            If true, all ssh and rsync commands share a persistent master ssh
+            connection, which is checked and reopened before each copy.
+        control_persist : int
+            Seconds the master connection stays open while unused
     """
 
     def __init__(self, file_manager, archive_name, remote_basedir,
                  ssh_host=None, ssh_key=None, cmd_timeout=None,
-                 copy_timeout=None):
+                 copy_timeout=None, num_streams=1, copy_retries=0,
+                 verify_workers=None, ssh_multiplex=False,
+                 control_persist=600):
         self.srfm = file_manager
         self.archive_name = archive_name
         self.ssh_host = ssh_host
@@ -277,6 +341,119 @@ class SupRsyncFileHandler:
         self.log = txaio.make_logger()
         self.cmd_timeout = cmd_timeout
         self.copy_timeout = copy_timeout
+        self.num_streams = max(int(num_streams), 1)
+        self.copy_retries = copy_retries
+        if verify_workers is not None and verify_workers < 1:
+            raise ValueError(
+                f"verify_workers must be at least 1, not {verify_workers}")
+        self.verify_workers = verify_workers
+        self.ssh_multiplex = ssh_multiplex and ssh_host is not None
+        self.control_persist = control_persist
+        self._control_dir = None
+        if self.ssh_multiplex:
+            self._control_dir = tempfile.mkdtemp(prefix='suprsync-ssh-')
+
+    def _ssh_cmd(self, master=False):
+        """
+        Returns the ssh command and options used for connections.
+
+        Args
+        ----
+            master : bool
+                If True, returns the options for starting the master
+                connection. Otherwise commands use the master connection if it
+                is running, and open their own connection if it isn't.
+        """
+        cmd = ['ssh']
+        if self.ssh_key is not None:
+            cmd.extend(['-i', self.ssh_key])
+        if self.ssh_multiplex:
+            # %C is a hash of the connection parameters, which keeps the
+            # socket path short
+            if master:
+                cmd.extend([
+                    '-o', 'ControlMaster=yes',
+                    '-o', f'ControlPersist={self.control_persist}',
+                ])
+            else:
+                cmd.extend(['-o', 'ControlMaster=no'])
+            cmd.extend(['-o', f'ControlPath={self._control_dir}/%C'])
+        return cmd
+
+    def _remote_cmd(self, cmd):
+        """
+        Prefixes a command with ssh if it should run on the remote server.
+        """
+        if self.ssh_host is None:
+            return list(cmd)
+        return self._ssh_cmd() + [self.ssh_host] + cmd
+
+    def check_connection(self):
+        """
+        Checks whether the master ssh connection is alive.
+
+        Returns
+        -------
+            alive : bool
+                True if the master connection is running, or if ssh
+                multiplexing isn't used.
+        """
+        if not self.ssh_multiplex:
+            return True
+        try:
+            res = subprocess.run(
+                self._ssh_cmd() + ['-O', 'check', self.ssh_host],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                timeout=self.cmd_timeout
+            )
+        except subprocess.TimeoutExpired:
+            return False
+        return res.returncode == 0
+
+    def ensure_connection(self):
+        """
+        Opens the master ssh connection if it isn't alive, e.g. because it
+        was idle for longer than ``control_persist`` or the network dropped.
+        If this fails, commands fall back to opening their own connections.
+
+        Returns
+        -------
+            alive : bool
+                True if the master connection is running
+        """
+        if self.check_connection():
+            return True
+
+        self.log.info("Opening master ssh connection to {host}",
+                      host=self.ssh_host)
+        cmd = self._ssh_cmd(master=True) + ['-N', '-f', self.ssh_host]
+        # The backgrounded master inherits stdout and stderr, so these can't
+        # be pipes or run would wait for the master to exit
+        try:
+            subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, timeout=self.cmd_timeout,
+                           check=True)
+        except (subprocess.TimeoutExpired,
+                subprocess.CalledProcessError) as e:
+            self.log.error("Could not open master ssh connection: {e}", e=e)
+            return False
+
+        if not self.check_connection():
+            self.log.error("Master ssh connection to {host} is not running",
+                           host=self.ssh_host)
+            return False
+        return True
+
+    def close(self):
+        """
+        Closes the master ssh connection, if there is one.
+        """
+        if not self.ssh_multiplex:
+            return
+        if self.check_connection():
+            subprocess.run(self._ssh_cmd() + ['-O', 'exit', self.ssh_host],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self._control_dir, ignore_errors=True)
 
     def run_on_remote(self, cmd, timeout=None):
         """
@@ -287,12 +464,7 @@ class SupRsyncFileHandler:
         cmd : list
             Command to be run
         """
-        _cmd = []
-        if self.ssh_host is not None:
-            _cmd += ['ssh', self.ssh_host]
-            if self.ssh_key is not None:
-                _cmd.extend(['-i', self.ssh_key])
-        _cmd += cmd
+        _cmd = self._remote_cmd(cmd)
 
         if timeout is None:
             timeout = self.cmd_timeout
@@ -304,16 +476,152 @@ class SupRsyncFileHandler:
                            cmd=_cmd, err=res.stderr.decode())
         return res
 
+    def stream_md5sums(self, paths, timeout=None):
+        """
+        Computes md5sums of files on the remote server with
+        ``verify_workers`` parallel md5sum processes, in a single ssh session.
+        Paths are passed to ``xargs`` on stdin, and results are yielded as
+        each file is hashed.
+
+        Parameters
+        -----------
+        paths : list
+            Paths of the files on the remote
+        timeout : float
+            Time (sec) after which the remote command is killed. Defaults to
+            ``cmd_timeout``.
+
+        Yields
+        -------
+        (path, md5sum) : tuple
+            Normalized path and md5sum of each file that could be hashed
+        """
+        if timeout is None:
+            timeout = self.cmd_timeout
+
+        # Small groups of files per md5sum keep the workers evenly loaded and
+        # results streaming, without starting a process for every file
+        per_proc = min(max(len(paths) // (4 * self.verify_workers), 1), 32)
+        cmd = self._remote_cmd(['xargs', '-0', '-P', str(self.verify_workers),
+                                '-n', str(per_proc), 'md5sum'])
+        self.log.debug(f"Running: {' '.join(cmd)}")
+        # A new session lets the whole process group be killed, including
+        # md5sum processes that would otherwise hold stdout open
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                start_new_session=True)
+
+        def kill():
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        def feed():
+            # Writes from a thread, so a full stdout pipe can't block stdin
+            try:
+                proc.stdin.write(b'\0'.join(p.encode() for p in paths))
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        writer = threading.Thread(target=feed, daemon=True)
+        writer.start()
+
+        timed_out = threading.Event()
+
+        def on_timeout():
+            timed_out.set()
+            kill()
+        timer = threading.Timer(timeout, on_timeout) if timeout else None
+        if timer is not None:
+            timer.start()
+
+        try:
+            for line in proc.stdout:
+                line = line.decode(errors='replace').rstrip('\n')
+                split = line.split(None, 1)
+                if len(split) == 2 and MD5_RE.fullmatch(split[0]):
+                    # md5sum marks files read in binary mode with '*'
+                    yield os.path.normpath(split[1].lstrip('*')), split[0]
+                elif line:
+                    self.log.error("md5sum: {line}", line=line)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            proc.stdout.close()
+            if proc.poll() is None:
+                kill()
+            proc.wait()
+            writer.join()
+
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, timeout)
+
+    def _rsync_shard(self, files, dest):
+        """
+        Copies a shard of files with a single rsync process, retrying up to
+        ``copy_retries`` times.
+
+        Args
+        ----
+            files : list
+                List of (SupRsyncFile, remote_path) tuples to copy
+            dest : str
+                rsync destination
+
+        Returns
+        -------
+            ok : bool
+                True if rsync succeeded
+        """
+        # Creates temp directory with remote dir structure of symlinks for
+        # rsync to copy.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for file, _ in files:
+                tmp_path = os.path.join(tmp_dir, file.remote_path)
+                os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+                os.symlink(file.local_path, tmp_path)
+
+            cmd = ['rsync', '-Lrt']
+            if self.ssh_key is not None or self.ssh_multiplex:
+                cmd.extend(['--rsh', ' '.join(map(shlex.quote, self._ssh_cmd()))])
+            cmd.extend([tmp_dir + '/', dest])
+
+            for attempt in range(self.copy_retries + 1):
+                try:
+                    subprocess.run(cmd, check=True, timeout=self.copy_timeout)
+                    return True
+                except (subprocess.TimeoutExpired,
+                        subprocess.CalledProcessError) as e:
+                    self.log.error(
+                        "rsync of {n} files failed (attempt {a}/{tot}): {e}",
+                        n=len(files), a=attempt + 1, tot=self.copy_retries + 1,
+                        e=e)
+        return False
+
     def copy_files(self, max_copy_attempts=None, num_files=None):
         """
         Copies a batch of files, and computes remote md5sums.
 
+        The batch is split into ``num_streams`` shards of roughly equal size,
+        which are copied by concurrent rsync processes. If a shard can't be
+        copied, the failed copy attempts of each of its files are incremented.
+
         Args
         ----
             max_copy_attempts : int
                 Max number of failed copy atempts
             num_files : int
                 Number of files to return
+
+        Returns
+        -------
+            stats : dict
+                Summary of the copy, with the number of ``files`` and
+                ``bytes`` copied, the ``duration`` of the transfer in seconds,
+                the ``throughput`` in MB/s and the number of
+                ``failed_shards``. None if there were no files to copy.
         """
         with self.srfm.Session.begin() as session:
             files = self.srfm.get_copyable_files(
@@ -324,65 +632,83 @@ class SupRsyncFileHandler:
             if not files:
                 return
 
+            self.ensure_connection()
+
             if self.ssh_host is not None:
                 dest = self.ssh_host + ':' + self.remote_basedir
             else:
                 dest = self.remote_basedir
 
-            # Creates temp directory with remote dir structure of symlinks for
-            # rsync to copy.
-            file_map = {}
-            remote_paths = []
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                self.log.info("Copying files:")
-                for file in files:
-                    self.log.info(f"- {file.local_path}")
-                    tmp_path = os.path.join(tmp_dir, file.remote_path)
-                    os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-
-                    if not os.path.exists(file.local_path):
-                        self.log.warn("Cannot find file {path}", path=file.local_path)
-                        file.failed_copy_attempts += 1
-                        continue
-
-                    if os.path.exists(tmp_path):
-                        self.log.warn("Temp file {path} already exists!", path=tmp_path)
-                        file.failed_copy_attempts += 1
-                        continue
-
-                    os.symlink(file.local_path, tmp_path)
+            to_copy = []
+            remote_paths = set()
+            self.log.info("Copying files:")
+            for file in files:
+                self.log.info(f"- {file.local_path}")
+                if not os.path.exists(file.local_path):
+                    self.log.warn("Cannot find file {path}", path=file.local_path)
+                    file.failed_copy_attempts += 1
+                    continue
 
-                    remote_path = os.path.normpath(
-                        os.path.join(self.remote_basedir, file.remote_path)
-                    )
-                    remote_paths.append(remote_path)
-                    file_map[remote_path] = file
+                remote_path = os.path.normpath(
+                    os.path.join(self.remote_basedir, file.remote_path)
+                )
+                if remote_path in remote_paths:
+                    self.log.warn("Remote path {path} is duplicated!",
+                                  path=remote_path)
+                    file.failed_copy_attempts += 1
+                    continue
 
-                cmd = ['rsync', '-Lrt']
-                if self.ssh_key is not None:
-                    cmd.extend(['--rsh', f'ssh -i {self.ssh_key}'])
-                cmd.extend([tmp_dir + '/', dest])
+                remote_paths.add(remote_path)
+                to_copy.append((file, remote_path))
 
-                subprocess.run(cmd, check=True, timeout=self.copy_timeout)
+            sizes = [os.path.getsize(file.local_path) for file, _ in to_copy]
+            shards = [
+                [to_copy[i] for i in shard]
+                for shard in shard_by_size(sizes, self.num_streams)
+            ]
 
-            for file in files:
-                file.copied = time.time()
+            t0 = time.time()
+            with ThreadPoolExecutor(max_workers=max(len(shards), 1)) as ex:
+                results = list(ex.map(self._rsync_shard, shards,
+                                      [dest] * len(shards)))
+            duration = time.time() - t0
 
-            res = self.run_on_remote(['md5sum'] + remote_paths)
-            for line in res.stdout.decode().split('\n'):
-                split = line.split()
+            file_map = {}
+            nbytes = 0
+            for shard, ok in zip(shards, results):
+                for file, remote_path in shard:
+                    if not ok:
+                        file.failed_copy_attempts += 1
+                        continue
+                    file.copied = time.time()
+                    file_map[remote_path] = file
+                    nbytes += os.path.getsize(file.local_path)
 
-                # If file cannot be found, line will say:
-                # "md5sum: file: No such file or directory
-                if len(split) != 2:
-                    continue
+            if file_map and self.verify_workers is not None:
+                for key, md5sum in self.stream_md5sums(list(file_map)):
+                    file = file_map.get(key)
+                    if file is None:
+                        continue
+                    file.remote_md5sum = md5sum
+                    if md5sum != file.local_md5sum:
+                        self.log.info(f"Remote md5sum mismatch for file "
+                                      f"{file.local_path}")
+            elif file_map:
+                res = self.run_on_remote(['md5sum'] + list(file_map))
+                for line in res.stdout.decode().split('\n'):
+                    split = line.split()
+
+                    # If file cannot be found, line will say:
+                    # "md5sum: file: No such file or directory
+                    if len(split) != 2:
+                        continue
 
-                md5sum, path = line.split()
-                key = os.path.normpath(path)
-                if key in file_map:
-                    file_map[key].remote_md5sum = md5sum
+                    md5sum, path = line.split()
+                    key = os.path.normpath(path)
+                    if key in file_map:
+                        file_map[key].remote_md5sum = md5sum
 
-            for file in files:
+            for file in file_map.values():
                 if file.remote_md5sum != file.local_md5sum:
                     file.failed_copy_attempts += 1
                     self.log.info(
@@ -392,6 +718,20 @@ class SupRsyncFileHandler:
                     self.log.info(f"Local md5: {file.local_md5sum}, "
                                   f"remote_md5: {file.remote_md5sum}")
 
+            stats = {
+                'files': len(file_map),
+                'bytes': nbytes,
+                'duration': duration,
+                'throughput': nbytes / 1e6 / duration if duration > 0 else 0.,
+                'failed_shards': results.count(False),
+            }
+            self.log.info(
+                f"Copied {stats['files']} files ({nbytes / 1e6:.1f} MB) in "
+                f"{duration:.1f} s with {len(shards)} streams "
+                f"({stats['throughput']:.2f} MB/s)"
+            )
+            return stats
+
     def delete_files(self, delete_after):
         """
         Gets deletable files, deletes them, and updates file info
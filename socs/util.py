@@ -1,9 +1,56 @@
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 
-def get_md5sum(filename):
-    m = hashlib.md5()
+def get_md5sum(filename, chunk_size=2**20):
+    """Returns the md5 checksum of a file, reading it in fixed-size chunks.
 
-    for line in open(filename, 'rb'):
-        m.update(line)
+    Args:
+        filename (str): Path of the file
+        chunk_size (int): Number of bytes to read at a time, if
+            ``hashlib.file_digest`` isn't available (Python < 3.11)
+
+    """
+    with open(filename, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'md5').hexdigest()
+
+        m = hashlib.md5()
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            m.update(view[:n])
     return m.hexdigest()
+
+
+def get_md5sums(filenames, max_workers=4):
+    """Computes the md5 checksums of many files concurrently.
+
+    hashlib releases the GIL while hashing, so files are hashed in parallel
+    by a pool of threads.
+
+    Args:
+        filenames (list): Paths of the files
+        max_workers (int): Number of files to hash at once
+
+    Returns:
+        dict: md5 checksum of each file, keyed by filename. Files that can't
+        be read are left out.
+
+    """
+    filenames = list(dict.fromkeys(filenames))
+    if not filenames:
+        return {}
+
+    def md5sum(filename):
+        try:
+            return get_md5sum(filename)
+        except OSError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(filenames))) as ex:
+        md5sums = ex.map(md5sum, filenames)
+        return {f: m for f, m in zip(filenames, md5sums) if m is not None}
@@ -0,0 +1,122 @@
+import sys
+sys.path.insert(0, '../agents/acu/')
+import broadcast_helpers as bh
+
+import struct
+import numpy as np
+import pytest
+
+
+FIELDS = ['Day', 'Time', 'Azimuth', 'Elevation', 'Azimuth_raw',
+          'Elevation_raw', 'Azimuth_Current_1', 'Azimuth_Current_2',
+          'Elevation_Current_1', 'Boresight']
+FMT = '<iddddddddd'
+
+
+def make_datagram(fmt, nrecs, seed=0):
+    """Packs nrecs random records with struct, returning bytes and tuples"""
+    rng = np.random.default_rng(seed)
+    recs = []
+    for _ in range(nrecs):
+        vals = []
+        for c in struct.unpack(fmt, bytes(struct.calcsize(fmt))):
+            if isinstance(c, float):
+                vals.append(float(rng.normal()))
+            elif isinstance(c, bool):
+                vals.append(bool(rng.integers(2)))
+            else:
+                vals.append(int(rng.integers(0, 100)))
+        # Round-trip through struct so the reference matches packed precision
+        recs.append(struct.unpack(fmt, struct.pack(fmt, *vals)))
+    return b''.join(struct.pack(fmt, *r) for r in recs), recs
+
+
+@pytest.mark.parametrize('fmt', [FMT, '>iddddddddd', 'idid?xhqddddd',
+                                 '=2i2H6f'])
+def test_udp_dtype(fmt):
+    nvals = len(struct.unpack(fmt, bytes(struct.calcsize(fmt))))
+    fields = [f'f{i}' for i in range(nvals)]
+    dtype = bh.udp_dtype(fmt, fields)
+    assert dtype.itemsize == struct.calcsize(fmt)
+
+    data, recs = make_datagram(fmt, 7)
+    decoded = np.frombuffer(data, dtype=dtype)
+    for d, r in zip(decoded, recs):
+        assert d.tolist() == r
+
+
+def test_udp_dtype_errors():
+    with pytest.raises(ValueError):
+        bh.udp_dtype(FMT, FIELDS[:-1])
+    with pytest.raises(ValueError):
+        bh.udp_dtype('<iddp', ['a', 'b', 'c', 'd'])
+
+
+def test_udp_ring_buffer():
+    dtype = bh.udp_dtype(FMT, FIELDS)
+    ring = bh.UDPRingBuffer(dtype, size=25)
+
+    data, recs = make_datagram(FMT, 10)
+    ring.push(data)
+    # Partial records are ignored
+    ring.push(data[:dtype.itemsize - 1])
+    assert len(ring) == 10
+    out = ring.pop(4)
+    assert [r.tolist() for r in out] == recs[:4]
+    assert len(ring) == 6
+
+    # Wrap around the end of the buffer and then overflow it
+    data2, recs2 = make_datagram(FMT, 15, seed=1)
+    data3, recs3 = make_datagram(FMT, 8, seed=2)
+    ring.push(data2)
+    assert len(ring) == 21
+    ring.push(data3)
+    assert len(ring) == 25
+    assert ring.dropped == 4
+    out = ring.pop()
+    assert [r.tolist() for r in out] == (recs + recs2 + recs3)[8:]
+    assert len(ring) == 0
+    assert len(ring.pop(10)) == 0
+
+    # Datagrams larger than the buffer keep the newest records
+    data4, recs4 = make_datagram(FMT, 30, seed=3)
+    ring.push(data4)
+    assert [r.tolist() for r in ring.pop()] == recs4[5:]
+    assert ring.dropped == 9
+
+
+def test_udp_ctimes():
+    dtype = bh.udp_dtype(FMT, FIELDS)
+    data, recs = make_datagram(FMT, 5)
+    decoded = np.frombuffer(data, dtype=dtype)
+    gyear = 1.6e9
+    ctimes = bh.udp_ctimes(decoded, FIELDS, gyear)
+    expected = [gyear + (r[0] - 1) * 86400 + r[1] for r in recs]
+    assert ctimes.tolist() == expected
+
+
+def test_broadcast_batcher():
+    dtype = bh.udp_dtype(FMT, FIELDS)
+    data, recs = make_datagram(FMT, 50)
+    decoded = np.frombuffer(data, dtype=dtype)
+    ctimes = 1.6e9 + np.arange(50) * 0.05
+
+    batcher = bh.BroadcastBatcher(FIELDS, max_duration=1.)
+    assert batcher.add(ctimes[:10], decoded[:10]) == []
+    assert batcher.add(ctimes[10:15], decoded[10:15]) == []
+    blocks = batcher.add(ctimes[15:30], decoded[15:30])
+    assert [len(b['timestamps']) for b in blocks] == [20, 10]
+
+    blocks += batcher.add(ctimes[30:35], decoded[30:35]) + batcher.flush()
+    assert batcher.flush() == []
+    assert sum(len(b['timestamps']) for b in blocks) == 35
+    for b in blocks:
+        assert b['block_name'] == 'ACU_broadcast'
+        assert b['timestamps'][-1] - b['timestamps'][0] < 1.
+        assert b['data']['Time'] == b['timestamps']
+        assert set(b['data']) == {'Time'} | set(FIELDS[2:])
+
+    ts = [t for b in blocks for t in b['timestamps']]
+    assert ts == ctimes[:35].tolist()
+    az = [a for b in blocks for a in b['data']['Azimuth']]
+    assert az == [r[2] for r in recs[:35]]
@@ -0,0 +1,238 @@
+import sys
+sys.path.insert(0, '../agents/acu/')
+import scan_helpers as sh
+
+import itertools
+import time
+import numpy as np
+import pytest
+
+
+def generate_constant_velocity_scan_loop(az_endpoint1, az_endpoint2, az_speed,
+                                         acc, el_endpoint1, el_speed,
+                                         num_batches=None, start_time=0.,
+                                         step_time=0.1, batch_size=500):
+    """
+    Point-by-point constant-velocity scan generator, used as the reference
+    for the vectorized scan_helpers.generate_constant_velocity_scan.
+    """
+    az_min = min(az_endpoint1, az_endpoint2)
+    az_max = max(az_endpoint1, az_endpoint2)
+    t0 = start_time
+    t = 0
+    turntime = 2.0 * az_speed / acc
+    az = az_endpoint1
+    el = el_endpoint1
+    daz = step_time * az_speed
+    az_flag = 0
+    increasing = az < az_endpoint2
+    az_vel = az_speed if increasing else -1 * az_speed
+    if num_batches is not None:
+        batch_size = int(np.ceil((az_max - az_min) / daz))
+    i = 0
+    while num_batches is None or i < num_batches:
+        i += 1
+        point_block = [[], [], [], [], [], [], []]
+        for j in range(batch_size):
+            for col, val in zip(point_block, [t + t0, az, el, az_vel,
+                                              el_speed, az_flag, 0]):
+                col.append(val)
+            t += step_time
+            if increasing:
+                if az <= (az_max - 2 * daz):
+                    az += daz
+                    az_vel, az_flag = az_speed, 1
+                elif az == az_max:
+                    t += turntime
+                    az_vel, az_flag = -1 * az_speed, 1
+                    increasing = False
+                else:
+                    az_remaining = az_max - az
+                    time_remaining = az_remaining / az_speed
+                    az = az_max
+                    t += (time_remaining - step_time)
+                    az_vel, az_flag = az_speed, 2
+            else:
+                if az >= (az_min + 2 * daz):
+                    az -= daz
+                    az_vel, az_flag = -1 * az_speed, 1
+                elif az == az_min:
+                    t += turntime
+                    az_vel, az_flag = az_speed, 1
+                    increasing = True
+                else:
+                    az_remaining = az - az_min
+                    time_remaining = az_remaining / az_speed
+                    az = az_min
+                    t += (time_remaining - step_time)
+                    az_vel, az_flag = -1 * az_speed, 2
+        yield tuple(point_block)
+
+
+def constant_velocity_scanpoints_loop(azpts, el, azvel, acc, ntimes):
+    """
+    List-concatenating constant-velocity scan points, used as the reference
+    for the preallocated scan_helpers.constant_velocity_scanpoints. Unlike the
+    original, elevations and elevation velocities aren't given an extra leg.
+    """
+    turn_time = 2 * azvel / acc
+    tot_time_dir = float((abs(azpts[1] - azpts[0])) / azvel)
+    num_dirpoints = int(tot_time_dir * 10.)
+    sect_start_time = 0.0
+    conctimes = []
+    concaz = []
+    el1 = np.linspace(el, el, num_dirpoints)
+    concel = []
+    concva = []
+    ve1 = np.zeros(num_dirpoints)
+    concve = []
+    azflags = [1 for i in range(num_dirpoints - 1)]
+    azflags += [2]
+    all_azflags = []
+    elflags = [0 for i in range(num_dirpoints)]
+    all_elflags = []
+    for n in range(ntimes):
+        end_dir_time = sect_start_time + tot_time_dir
+        time_for_section = np.linspace(sect_start_time, end_dir_time,
+                                       num_dirpoints)
+        if n % 2 != 0:
+            new_az = np.linspace(azpts[1], azpts[0], num_dirpoints)
+            new_va = np.zeros(num_dirpoints) + \
+                np.sign(azpts[0] - azpts[1]) * azvel
+        else:
+            new_az = np.linspace(azpts[0], azpts[1], num_dirpoints)
+            new_va = np.zeros(num_dirpoints) + \
+                np.sign(azpts[1] - azpts[0]) * azvel
+        conctimes.extend(time_for_section)
+        concaz.extend(new_az)
+        concel.extend(el1)
+        concva.extend(new_va)
+        concve.extend(ve1)
+        all_azflags.extend(azflags)
+        all_elflags.extend(elflags)
+        sect_start_time = time_for_section[-1] + turn_time
+    all_azflags[-1] = 0
+    return conctimes, concaz, concel, concva, concve, all_azflags, \
+        all_elflags
+
+
+def ptstack_format_loop(conctimes, concaz, concel, concva, concve, az_flags,
+                        el_flags, start_time=0.):
+    """
+    Per-line ProgramTrack formatter, used as the reference for the bulk
+    scan_helpers.ptstack_format.
+    """
+    lines = []
+    for n, t in enumerate(conctimes):
+        t = start_time + t
+        ftime = time.strftime('%j, %H:%M:%S', time.gmtime(t)) \
+            + ('{tt:.6f}'.format(tt=t % 1.))[1:]
+        lines.append('{ftime}; {az:.6f}; {el:.6f}; {azvel:.4f}; '
+                     '{elvel:.4f}; {azflag}; {elflag}'
+                     '\r\n'.format(ftime=ftime, az=concaz[n], el=concel[n],
+                                   azvel=concva[n], elvel=concve[n],
+                                   azflag=az_flags[n], elflag=el_flags[n]))
+    return lines
+
+
+def test_ptstack_format():
+    rng = np.random.default_rng(0)
+    n = 5000
+    # Includes values that are close to rounding ties, negative zero and
+    # values that round up to the next integer
+    vals = np.concatenate([
+        rng.uniform(-400, 400, n),
+        rng.integers(-400, 400, n) + rng.integers(0, 10**7, n) / 1e7 + 5e-8,
+        [0., -0., -1e-9, 5e-7, -5e-7, 2.5e-5, 359.9999995, 1e10, -3e12,
+         np.nan, np.inf],
+    ])
+    times = rng.uniform(0, 2e9, len(vals))
+    times[:100] = np.floor(times[:100]) + 0.9999996
+    cols = (times, vals, vals[::-1], vals, vals[::-1],
+            rng.integers(0, 3, len(vals)).tolist(),
+            rng.integers(0, 3, len(vals)).astype(float))
+    assert sh.ptstack_format(*cols, generator=True, start_offset=3.) \
+        == ptstack_format_loop(*cols, start_time=3.)
+    assert sh.ptstack_format([], [], [], [], [], [], []) == []
+
+    # Extra values beyond the number of times are ignored
+    cols = (times[:100],) + tuple(c[:150] for c in cols[1:])
+    assert sh.ptstack_format(*cols, generator=True, start_offset=3.) \
+        == ptstack_format_loop(*cols, start_time=3.)
+
+
+@pytest.mark.parametrize('decimals', [6, 4])
+def test_fixed_chars(decimals):
+    rng = np.random.default_rng(1)
+    scale = 10**decimals
+    # Odd multiples of 2**-(decimals + 1) are exact ties
+    ties = np.arange(-2001, 2001, 2) / 2**(decimals + 1)
+    near = (rng.integers(-360 * scale, 360 * scale, 2000) + 0.5) / scale
+    carries = np.array([359.9999995, 359.9999996, 359.99999949, 9.99995,
+                        99.999951, 0.99999951, -359.9999995, -359.9999996,
+                        -9.99995, -0.99999951])
+    vals = np.concatenate([
+        ties, near, carries,
+        np.nextafter(ties, np.inf), np.nextafter(ties, -np.inf),
+        np.nextafter(near, np.inf), np.nextafter(near, -np.inf),
+        np.nextafter(carries, np.inf), np.nextafter(carries, -np.inf),
+        rng.uniform(-1e4, 1e4, 5000), rng.uniform(-1, 1, 1000) / scale,
+        [0., -0., -1e-9, 1e-9, 2**52 / scale, -2**53 / scale, 1e300,
+         np.nan, np.inf, -np.inf],
+    ])
+    chars = sh._fixed_chars(vals, decimals)
+    strs = [bytes(row).lstrip(b'\0').decode() for row in chars]
+    assert strs == ['%.*f' % (decimals, v) for v in vals]
+
+
+@pytest.mark.parametrize('azpts,el,azvel,acc,ntimes', [
+    ((120., 130.), 50., 1., 4., 3),
+    ((130., 120.), 35.5, 2., 4., 1),
+    ((10., 370.123), 55., 1.7, 2., 50),
+    ((33.3, 12.1), 40., 0.37, 1.3, 2000),
+])
+def test_constant_velocity_scanpoints(azpts, el, azvel, acc, ntimes):
+    ref = constant_velocity_scanpoints_loop(azpts, el, azvel, acc, ntimes)
+    out = sh.constant_velocity_scanpoints(azpts, el, azvel, acc, ntimes)
+    for r, o in zip(ref, out):
+        assert isinstance(o, np.ndarray)
+        assert np.array_equal(np.asarray(r), o)
+    assert sh.ptstack_format(*out, generator=True, start_offset=3.) \
+        == ptstack_format_loop(*ref, start_time=3.)
+    assert sh.constant_velocity_scanpoints(azpts, el, 0., acc, ntimes) is False
+    assert sh.constant_velocity_scanpoints((10., 10.01), el, 2., acc,
+                                           ntimes) is False
+
+
+@pytest.mark.parametrize('az1,az2,speed,acc,step_time,batch_size,num_batches', [
+    (120., 130., 1., 4., 0.1, 500, None),
+    (130., 120., 2., 4., 0.05, 77, None),
+    (10., 10.3, 1., 4., 0.1, 33, None),
+    (10., 370.123, 1.7, 2., 0.07, 500, 5),
+    (33.3, 12.1, 0.37, 1.3, 0.23, 1, None),
+])
+def test_generate_constant_velocity_scan(az1, az2, speed, acc, step_time,
+                                         batch_size, num_batches):
+    kw = dict(num_batches=num_batches, start_time=1.6e9, step_time=step_time,
+              batch_size=batch_size)
+    ref = generate_constant_velocity_scan_loop(az1, az2, speed, acc, 55., 0.,
+                                               **kw)
+    vec = sh.generate_constant_velocity_scan(az1, az2, speed, acc, 55., 55.,
+                                             0., ptstack_fmt=False, **kw)
+    nbatches = 20 if num_batches is None else num_batches
+    batches = list(itertools.islice(vec, nbatches))
+    assert len(batches) == nbatches
+    for b_ref, b_vec in zip(itertools.islice(ref, nbatches), batches):
+        assert b_ref == b_vec
+
+    lines = sh.generate_constant_velocity_scan(az1, az2, speed, acc, 55., 55.,
+                                               0., **kw)
+    assert next(lines) == sh.ptstack_format(*batches[0], generator=True)
+
+
+def test_generate_constant_velocity_scan_errors():
+    with pytest.raises(ValueError):
+        next(sh.generate_constant_velocity_scan(10., 10., 1., 4., 55., 55., 0.))
+    with pytest.raises(ValueError):
+        next(sh.generate_constant_velocity_scan(10., 20., 1., 4., 55., 55., 0.,
+                                                step_time=0.01))
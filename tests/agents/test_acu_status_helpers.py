@@ -0,0 +1,172 @@
+import sys
+sys.path.insert(0, '../agents/acu/')
+import status_helpers
+
+import copy
+import json
+import math
+import os
+
+
+# Recorded-style StatusSATPDetailed8100 Values response and monitor fields
+STATUS_FILE = os.path.join(os.path.dirname(__file__), 'data',
+                           'acu_status_satp.json')
+
+
+def load_status():
+    with open(STATUS_FILE) as f:
+        d = json.load(f)
+    return d['monitor_fields'], d['values']
+
+
+def empty_status(monitor_fields):
+    return {category: {} for category in monitor_fields}
+
+
+def process_status_loop(values, monitor_fields, status):
+    """
+    Nested key x category status processing used by the ACU agent's monitor
+    process before the precompiled StatusFieldMap. Returns the influx status.
+    """
+    mode_key = {'Stop': 0,
+                'Preset': 1,
+                'ProgramTrack': 2,
+                'Stow': 3,
+                'SurvivalMode': 4,
+                'Rate': 5,
+                'StarTrack': 6,
+                }
+    tfn_key = {'None': float('nan'),
+               'False': 0,
+               'True': 1,
+               }
+    for (key, value) in values.items():
+        for category in monitor_fields:
+            if key in monitor_fields[category]:
+                if isinstance(value, bool):
+                    status[category][monitor_fields[category][key]] = int(value)
+                elif isinstance(value, int) or isinstance(value, float):
+                    status[category][monitor_fields[category][key]] = value
+                elif value is None:
+                    status[category][monitor_fields[category][key]] = float('nan')
+                else:
+                    status[category][monitor_fields[category][key]] = str(value)
+
+    influx_status = {}
+    for category in status:
+        if category != 'commands':
+            for statkey, statval in status[category].items():
+                if isinstance(statval, float):
+                    influx_status[statkey + '_influx'] = statval
+                elif isinstance(statval, str):
+                    if statval == 'None':
+                        influx_status[statkey + '_influx'] = float('nan')
+                    elif statval in ['True', 'False']:
+                        influx_status[statkey + '_influx'] = tfn_key[statval]
+                    else:
+                        influx_status[statkey + '_influx'] = mode_key[statval]
+                elif isinstance(statval, int):
+                    if statkey in ['Year', 'Free_upload_positions']:
+                        influx_status[statkey + '_influx'] = float(statval)
+                    else:
+                        influx_status[statkey + '_influx'] = int(statval)
+    return influx_status
+
+
+def assert_same(a, b):
+    """Compares dicts, treating nans as equal and checking value types"""
+    assert a.keys() == b.keys()
+    for k in a:
+        if isinstance(a[k], dict):
+            assert_same(a[k], b[k])
+        elif isinstance(a[k], float) and math.isnan(a[k]):
+            assert math.isnan(b[k])
+        else:
+            assert a[k] == b[k] and type(a[k]) is type(b[k]), k
+
+
+def test_status_field_map():
+    monitor_fields, values = load_status()
+    # Exercise strings, Nones and a key shared by two categories
+    monitor_fields['axis_state']['Azimuth mode'] = 'Azimuth_mode_state'
+    values['Safe'] = 'True'
+    values['PCU operation'] = None
+    values['Elevation mode'] = 'Stow'
+
+    status_ref = empty_status(monitor_fields)
+    influx_ref = process_status_loop(values, monitor_fields, status_ref)
+
+    field_map = status_helpers.StatusFieldMap(monitor_fields)
+    status, influx = empty_status(monitor_fields), {}
+    field_map.apply(values, status, influx)
+    assert_same(status_ref, status)
+    assert_same(influx_ref, influx)
+    assert influx['Year_influx'] == 2021.
+    assert influx['Elevation_mode_influx'] == 3
+    assert status['axis_state']['Azimuth_mode_state'] == values['Azimuth mode']
+
+    # Following responses update the same dicts in place
+    values2 = copy.deepcopy(values)
+    values2['Azimuth mode'] = 'ProgramTrack'
+    values2['Azimuth current position'] = 12.5
+    del values2['Unmonitored register 0']
+    process_status_loop(values2, monitor_fields, status_ref)
+    influx_ref = process_status_loop({}, monitor_fields, status_ref)
+    field_map.apply(values2, status, influx)
+    assert_same(status_ref, status)
+    assert_same(influx_ref, influx)
+
+
+def test_change_filter_block():
+    cf = status_helpers.ChangeFilter(heartbeat=10.)
+    data = {'a': 1, 'b': float('nan')}
+    assert cf.block('x', data, 0.)
+    assert not cf.block('x', dict(data), 1.)
+    assert cf.block('y', data, 1.)
+
+    # Changes to the published dict itself are detected
+    data['a'] = 2
+    assert cf.block('x', data, 2.)
+    assert not cf.block('x', data, 3.)
+    assert cf.block('x', data, 12.)
+
+
+def test_change_filter_fields():
+    cf = status_helpers.ChangeFilter(heartbeat=10.)
+    data = {'pos': 1., 'fault': 0, 'mode': float('nan')}
+    assert cf.fields('x', data, 0., always={'pos'}) == data
+    assert cf.fields('x', data, 1., always={'pos'}) == {'pos': 1.}
+    data['fault'] = 1
+    assert cf.fields('x', data, 2., always={'pos'}) == {'pos': 1., 'fault': 1}
+    assert cf.fields('x', data, 3., always={'pos'}) == {'pos': 1.}
+    data['new'] = 5
+    assert cf.fields('x', data, 4.) == {'new': 5}
+    assert cf.fields('x', data, 10.).keys() == data.keys()
+
+
+def test_change_filter_status():
+    # Only positions change between responses, so only the summary and
+    # position error blocks are published between heartbeats
+    monitor_fields, values = load_status()
+    field_map = status_helpers.StatusFieldMap(monitor_fields)
+    status, influx = empty_status(monitor_fields), {}
+    cf = status_helpers.ChangeFilter(heartbeat=10.)
+    fast = {f + '_influx' for f in monitor_fields['summary'].values()}
+
+    published = {}
+    nfields = 0
+    for i in range(100):
+        values['Time'] += 0.05 / 86400
+        values['Azimuth current position'] += 0.01
+        values['Azimuth average position error'] = i * 1e-5
+        field_map.apply(values, status, influx)
+        for category, data in status.items():
+            if cf.block(category, data, i * 0.05):
+                published[category] = published.get(category, 0) + 1
+        nfields += len(cf.fields('influx', influx, i * 0.05, always=fast))
+
+    assert published['summary'] == 100
+    assert published['position_errors'] == 100
+    assert published['axis_faults_errors_overages'] == 1
+    assert published['axis_limits'] == 1
+    assert nfields < 100 * len(influx) / 10
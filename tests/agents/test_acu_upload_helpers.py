@@ -0,0 +1,165 @@
+import sys
+sys.path.insert(0, '../agents/acu/')
+import scan_helpers as sh
+import upload_helpers as uh
+
+import calendar
+import time
+import numpy as np
+import pytest
+from twisted.internet import task
+
+
+@pytest.mark.parametrize('sizes', [[500, 500, 500], [7, 3, 300, 1], [250],
+                                   [], [0, 10]])
+def test_line_groups(sizes):
+    batches, n = [], 0
+    for size in sizes:
+        batches.append([f'{i}\n' for i in range(n, n + size)])
+        n += size
+    groups = list(uh.line_groups(iter(batches), 250))
+    assert [line for g in groups for line in g] == [f'{i}\n' for i in range(n)]
+    assert all(len(g) == 250 for g in groups[:-1])
+    assert all(0 < len(g) <= 250 for g in groups)
+
+
+class FakeStack:
+    """ACU ProgramTrack stack that drains at a fixed rate"""
+
+    def __init__(self, clock, rate=10., stack_size=9999, latency=0.02):
+        self.clock = clock
+        self.rate = rate
+        self.stack_size = stack_size
+        self.latency = latency
+        self.occupied = 0
+        self.max_occupied = 0
+        self.lines = []
+        self.report = (stack_size, 0.)
+        self.events = []
+
+    def upload(self, text):
+        self.events.append('upload')
+
+        def done():
+            lines = text.splitlines()
+            self.lines.extend(lines)
+            self.occupied += len(lines)
+            self.max_occupied = max(self.max_occupied, self.occupied)
+        return task.deferLater(self.clock, self.latency, done)
+
+    def step(self, dt):
+        # Report the stack state and then advance time, like the monitor
+        self.report = (self.stack_size - self.occupied, self.clock.seconds())
+        self.clock.advance(dt)
+        self.occupied = max(self.occupied - self.rate * dt, 0)
+
+    def free_positions(self):
+        return self.report
+
+
+def test_program_track_uploader():
+    clock = task.Clock()
+    stack = FakeStack(clock, rate=200.)
+    uploader = uh.ProgramTrackUploader(stack.upload, stack.free_positions,
+                                       min_free=9899, poll_interval=0.1,
+                                       clock=clock)
+    lines = [f'{i}\n' for i in range(1000)]
+
+    def blocks():
+        for i in range(0, len(lines), 120):
+            stack.events.append('format')
+            yield lines[i:i + 120]
+
+    stats = []
+
+    def on_upload(block, s):
+        # Called only once the block is on the stack
+        assert stack.lines[-len(block):] == [line.strip() for line in block]
+        assert len(stack.lines) == s['lines_uploaded']
+        stats.append(dict(s))
+
+    d = uploader.run(blocks(), on_upload=on_upload)
+    result = []
+    d.addCallback(result.append)
+    for _ in range(1000):
+        if result:
+            break
+        stack.step(0.05)
+
+    assert result == [1000]
+    assert stack.lines == [line.strip() for line in lines]
+    # The next block is formatted while the previous upload is in flight,
+    # and stale reports never let the stack fill past the threshold
+    assert stack.events[:4] == ['format', 'upload', 'format', 'upload']
+    assert stack.max_occupied <= 100 + 120
+    assert len(stats) == 9
+    assert stats[-1]['lines_uploaded'] == 1000
+    for s in stats:
+        assert s['upload_latency'] == pytest.approx(0.05, abs=0.05)
+        assert 0 <= s['upload_lag'] <= 0.2
+        assert s['stack_fill'] >= 0
+
+
+def test_program_track_uploader_stop():
+    clock = task.Clock()
+    stack = FakeStack(clock, rate=0.)
+    running = [True]
+    uploader = uh.ProgramTrackUploader(stack.upload, stack.free_positions,
+                                       min_free=9899, clock=clock)
+
+    def blocks():
+        while True:
+            yield ['a\n'] * 120
+
+    result = []
+    uploader.run(blocks(), running=lambda: running[0]).addCallback(result.append)
+    for _ in range(20):
+        stack.step(0.05)
+    # The stack never drains, so only the first block is uploaded
+    assert stack.lines == ['a'] * 120
+    assert result == []
+    running[0] = False
+    for _ in range(5):
+        stack.step(0.05)
+    assert result == [120]
+
+
+def uploadtime_to_ctime(ptstack_time, upload_year):
+    """String-parsing ctime conversion used before upload_block"""
+    year = int(upload_year)
+    gyear = calendar.timegm(time.strptime(str(year), '%Y'))
+    day_of_year = float(ptstack_time.split(',')[0]) - 1.0
+    hour = float(ptstack_time.split(',')[1].split(':')[0])
+    minute = float(ptstack_time.split(',')[1].split(':')[1])
+    second = float(ptstack_time.split(',')[1].split(':')[2])
+    return gyear + day_of_year * 60 * 60 * 24 + hour * 60 * 60 + minute * 60 + second
+
+
+def test_upload_block():
+    times, azs, els, vas, ves, azflags, elflags = \
+        sh.constant_velocity_scanpoints((120., 130.), 50., 1., 4., 2)
+    start_time = 1.6e9 + 0.123
+    lines = sh.ptstack_format(times, azs, els, vas, ves, azflags, elflags,
+                              start_offset=start_time, generator=True)
+    uploads = {'Start_Azimuth': 120., 'Command_Type': 2,
+               'PtStack_Lines': 'True', 'PtStack_Azimuth': 0.}
+    ctimes = np.asarray(times) + start_time
+    block = uh.upload_block(uploads, lines, ctimes, azs, els, vas, ves,
+                            azflags, elflags)
+
+    n = len(lines)
+    assert block['block_name'] == 'ACU_upload'
+    assert block['timestamps'] == ctimes.tolist()
+    data = block['data']
+    assert all(len(v) == n for v in data.values())
+    assert data['Command_Type'] == [2] * n
+    assert data['PtStack_Azimuth'] == list(azs)
+    assert data['PtStack_Elevation'] == list(els[:n])
+    assert data['PtStack_ElFlag'] == list(elflags)
+    year = time.gmtime(start_time).tm_year
+    assert np.allclose(
+        [uploadtime_to_ctime(t, year) for t in data['PtStack_Time']],
+        block['timestamps'], rtol=0, atol=1e-6)
+    # The upload status is left at the last point
+    assert uploads['PtStack_Azimuth'] == azs[-1]
+    assert uploads['PtStack_Time'] == lines[-1].split(';')[0]
@@ -0,0 +1,493 @@
+import sys
+sys.path.insert(0, '../agents/magpie/')
+from magpie_agent import (MagpieAgent, make_parser, MAX_CHANS,
+                          unpack_block_frame, Demodulator,
+                          WhiteNoiseCalculator, DemodNoiseEngine, pA_per_rad,
+                          FIRFilter, MASK_REGISTER, FrameDecoder,
+                          P2Quantile, MonitoredChanBatcher,
+                          downsample_monitored_chans, FocalplaneConfig,
+                          CHANS_PER_BAND, PacingScheduler)
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+import so3g
+from spt3g import core
+
+import time
+from unittest import mock
+from twisted.internet import task
+
+import txaio
+txaio.use_twisted()
+
+
+def create_agent(xdim=8, ydim=8, frame_format='sample', extra_args=()):
+    """Test fixture to setup a mocked OCSAgent."""
+    mock_agent = mock.MagicMock()
+    log = txaio.make_logger()
+    txaio.start_logging(level='debug')
+    mock_agent.log = log
+    log.info('Initialized mock OCSAgent')
+    parser = make_parser()
+    args = parser.parse_args(args=[
+        '--stream-id', 'test', '--xdim', str(xdim), '--ydim', str(ydim),
+        '--frame-format', frame_format, *extra_args
+    ])
+    agent = MagpieAgent(mock_agent, args)
+    return agent
+
+
+def create_data_frame(nchans, start=0., duration=1., sample_rate=200.):
+    """Creates a smurf-like Scan frame with random detector data"""
+    times = np.arange(start, start + duration, 1. / sample_rate)
+    nsamps = len(times)
+    g3times = core.G3VectorTime(times * core.G3Units.s)
+    names = [f'r{ch:0>4}' for ch in range(nchans)]
+    data = np.random.randint(1, 2**15, (nchans, nsamps), dtype=np.int32)
+
+    fr = core.G3Frame(core.G3FrameType.Scan)
+    fr['data'] = so3g.G3SuperTimestream(names, g3times, data)
+    primary_data = (times[None, :] * 1e9).astype(np.int64)
+    fr['primary'] = so3g.G3SuperTimestream(['UnixTime'], g3times, primary_data)
+    fr['session_id'] = 0
+    fr['time'] = core.G3Time(start * core.G3Units.s)
+    return fr
+
+
+def to_timestream_map(frame):
+    """Converts a SuperTimestream data frame to use a G3TimestreamMap"""
+    fr = core.G3Frame(core.G3FrameType.Scan)
+    d = frame['data']
+    tsm = core.G3TimestreamMap()
+    for name, ts in zip(d.names, d.data):
+        tsm[name] = core.G3Timestream(ts.astype(float))
+    tsm.start, tsm.stop = d.times[0], d.times[-1]
+    fr['data'] = tsm
+    fr['primary'] = frame['primary']
+    fr['session_id'] = 0
+    return fr
+
+
+def write_g3_file(path, nchans, nframes, nsamps=200):
+    """Writes a G3File containing a status frame and data frames"""
+    writer = core.G3Writer(str(path))
+    fr = core.G3Frame(core.G3FrameType.Wiring)
+    mask = np.arange(nchans)[::-1]
+    fr['status'] = yaml.dump({MASK_REGISTER: str(mask.tolist())})
+    fr['session_id'] = 0
+    fr['time'] = core.G3Time(0)
+    writer(fr)
+    for i in range(nframes):
+        fr = create_data_frame(nchans, start=i * nsamps / 200.,
+                               duration=(nsamps - 0.5) / 200.)
+        assert fr['data'].data.shape == (nchans, nsamps)
+        writer(fr)
+    writer(core.G3Frame(core.G3FrameType.EndProcessing))
+    return mask
+
+
+def test_scatter_idxs():
+    magpie = create_agent(xdim=4, ydim=4)
+    nchans = 32
+    magpie.mask = np.arange(MAX_CHANS)[::-1].copy()
+    magpie.mask[:nchans] = np.random.permutation(nchans)
+
+    readout_chans, elem_idxs = magpie._get_scatter_idxs(nchans)
+    for rc, idx in zip(readout_chans, elem_idxs):
+        assert magpie.fp.chan_mask[magpie.mask[rc]] == idx
+    assert len(readout_chans) == len(magpie.fp.channels)
+
+    # Cached until the mask changes
+    assert magpie._get_scatter_idxs(nchans)[0] is readout_chans
+    magpie.mask = np.arange(MAX_CHANS)
+    magpie.scatter_idxs = None
+    assert np.all(magpie._get_scatter_idxs(nchans)[0] == np.arange(16))
+
+
+def test_process_data():
+    magpie = create_agent(xdim=8, ydim=8)
+    nchans = 100
+    out = magpie._process_data(create_data_frame(nchans))
+    assert len(out) > 0 and len(out) % 3 == 0
+    for fr in out:
+        assert len(fr['data']) == len(magpie.fp.channels)
+
+    # Visual elements map to readout chans with the identity mask
+    raw = np.array(out[0]['data'])
+    assert np.all(raw != 0)
+
+
+def test_block_frames():
+    frame = create_data_frame(100)
+    magpie = create_agent(xdim=8, ydim=8)
+    sample_out = magpie._process_data(frame)
+
+    magpie = create_agent(xdim=8, ydim=8, frame_format='block')
+    block_out = magpie._process_data(frame)
+    assert len(block_out) == 1
+
+    unpacked = unpack_block_frame(block_out[0])
+    assert len(unpacked) == len(sample_out)
+    for f1, f2 in zip(sample_out, unpacked):
+        assert f1['idx'] == f2['idx']
+        assert f1['timestamp'] == f2['timestamp']
+        assert np.array_equal(f1['data'], f2['data'])
+
+
+def test_demod_noise_engine():
+    fs, nchans = 200., 16
+    demod = Demodulator(8, 0.5, fs=fs)
+    wncalc = WhiteNoiseCalculator(fs=fs, navg=int(fs))
+    engine = DemodNoiseEngine(8, 0.5, fs=fs, navg=int(fs), wl_scale=pA_per_rad)
+    engine_ds = DemodNoiseEngine(8, 0.5, fs=fs, navg=int(fs), wl_scale=pA_per_rad)
+
+    t0 = 0
+    for nsamps in [200, 200, 150, 50]:
+        times = t0 + np.arange(nsamps) / fs
+        t0 = times[-1] + 1 / fs
+        data = np.random.normal(0, 1, (nchans, nsamps))
+        data += np.sin(2 * np.pi * 8 * times)[None, :]
+
+        d1, d2 = demod.apply(times, data), engine.demod(times, data)
+        assert np.allclose(d1, d2, rtol=1e-4, atol=1e-5)
+
+        w1 = wncalc.apply(data * pA_per_rad)
+        w2 = engine.white_noise(data)
+        assert np.allclose(w1, w2, rtol=1e-6)
+
+        # Only computing a subset of samples shouldn't change the state
+        idxs = np.arange(3, nsamps, 10)
+        assert np.allclose(engine_ds.white_noise(data, idxs=idxs), w2[:, idxs])
+
+
+def test_decimating_filters():
+    fs, nchans = 200., 16
+    filts = [
+        (FIRFilter.moving_avg(20), FIRFilter.moving_avg(20, decimate=True)),
+        (FIRFilter.differ(10), FIRFilter.differ(10, decimate=True)),
+        (FIRFilter.butter_lowpass(1, fs), FIRFilter.butter_lowpass(1, fs)),
+    ]
+    wncalc = WhiteNoiseCalculator(fs=fs, navg=int(fs))
+    wncalc_ds = WhiteNoiseCalculator(fs=fs, navg=int(fs), decimate=True)
+    ds_offset = 0
+    for nsamps in [200, 200, 15, 183]:
+        data = np.random.normal(0, 1, (nchans, nsamps))
+        idxs = np.arange(ds_offset, nsamps, 10)
+        ds_offset = 10 - (nsamps - ds_offset) % 10
+        for f, f_ds in filts:
+            assert np.allclose(f.lfilt(data, in_place=False)[:, idxs],
+                               f_ds.lfilt_at(data, idxs))
+        assert np.allclose(wncalc.apply(data)[:, idxs],
+                           wncalc_ds.apply(data, idxs=idxs))
+
+
+def test_process_chunked():
+    # Processing a frame in chunks selects the same samples as processing it
+    # all at once
+    times = np.arange(3005) / 200.
+    data = np.random.normal(size=(4, len(times))).astype(np.float32)
+    full = create_agent().proc
+    idxs, demod, wl = full.process(times, data)
+
+    chunked = create_agent().proc
+    bounds = [0, 150, 300, 450, 601, 602, 1000, 3005]
+    chunk_idxs, chunk_demod = [], []
+    for i0, i1 in zip(bounds[:-1], bounds[1:]):
+        idx, d, _ = chunked.process(times[i0:i1], data[:, i0:i1],
+                                    sample_rate=200.)
+        chunk_idxs.append(idx + i0)
+        chunk_demod.append(d)
+    assert np.array_equal(np.concatenate(chunk_idxs), idxs)
+    assert np.allclose(np.concatenate(chunk_demod, axis=1), demod,
+                       rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('nsamps,max_samps',
+                         [(200, 400), (401, 400), (801, 400), (601, 200)])
+def test_read_pipelined(tmp_path, nsamps, max_samps):
+    # Frames longer than max_samps are split into chunks in the pipeline,
+    # which must not change the downsampling cadence
+    path = tmp_path / 'test.g3'
+    nchans = 64
+    mask = write_g3_file(path, nchans, 5, nsamps=nsamps)
+
+    frames = {}
+    for pipeline in [False, True]:
+        args = ['--pipeline', '--pipeline-max-samps', str(max_samps)] \
+            if pipeline else []
+        magpie = create_agent(xdim=8, ydim=8, frame_format='block',
+                              extra_args=args)
+        session = mock.MagicMock()
+        session.data = {}
+        magpie.read(session, {'src': str(path)})
+        assert np.array_equal(magpie.mask, mask)
+        frames[pipeline] = [magpie.out_queue.get()
+                            for _ in range(magpie.out_queue.qsize())]
+
+    stats = session.data['pipeline']
+    for stage in ['decode', 'dsp', 'encode']:
+        assert stats[stage]['latency'] >= 0
+    assert stats['decode']['queue_wait'] >= 0
+    # File sources are shifted to the current time, so the downsampled
+    # sample times are compared relative to the first one
+    t0, t1 = [
+        np.concatenate([np.array(f['timestamps']) for f in frames[p]])
+        for p in [False, True]
+    ]
+    assert len(t0) == len(t1) > 0
+    assert np.allclose(np.diff(t0), np.diff(t1), rtol=0, atol=1e5)
+    for key in ['raw', 'demod', 'wl']:
+        d0 = np.concatenate([np.array(f[key]) for f in frames[False]])
+        d1 = np.concatenate([np.array(f[key]) for f in frames[True]])
+        assert np.allclose(d0, d1, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_read_missing_file(tmp_path, pipeline):
+    args = ['--pipeline'] if pipeline else []
+    magpie = create_agent(extra_args=args)
+    session = mock.MagicMock()
+    with pytest.raises(RuntimeError):
+        magpie.read(session, {'src': str(tmp_path / 'missing.g3')})
+
+
+def test_read_pipelined_dsp_error(tmp_path):
+    path = tmp_path / 'test.g3'
+    write_g3_file(path, 64, 2)
+    magpie = create_agent(extra_args=['--pipeline'])
+
+    def process(times, data, sample_rate=None):
+        raise ValueError("DSP failure")
+    # Workers are forked, so they get the patched processor
+    magpie.proc.process = process
+    session = mock.MagicMock()
+    with pytest.raises(ValueError, match="DSP failure"):
+        magpie.read(session, {'src': str(path)})
+
+
+def test_frame_decoder():
+    decoder = FrameDecoder(nchans=16, nsamps=100)
+    nchans = 32
+    frame = create_data_frame(nchans)
+    expected = frame['data'].data * (2 * np.pi) / 2**16
+
+    times, data = decoder.decode(frame)
+    assert data.dtype == np.float32
+    assert data.shape == (nchans, len(times))
+    assert np.allclose(data, expected, rtol=1e-6)
+    assert np.allclose(times, np.arange(0, 1, 1 / 200.))
+
+    # Subsequent frames reuse the buffer
+    _, data2 = decoder.decode(create_data_frame(nchans))
+    assert np.shares_memory(data, data2)
+
+    times, data = decoder.decode(to_timestream_map(frame))
+    assert np.allclose(data, expected, rtol=1e-6)
+    names = decoder.chan_names
+    decoder.decode(to_timestream_map(frame))
+    assert decoder.chan_names is names
+    decoder.reset()
+    assert decoder.chan_names is None
+
+
+def test_p2_quantile():
+    nchans = 20
+    data = np.random.lognormal(0, 1, (nchans, 5000))
+    for p in [0.25, 0.5, 0.85]:
+        est = P2Quantile(p)
+        assert est.estimate() is None
+        est.update(data[:, :3])
+        assert np.allclose(est.estimate(), np.quantile(data[:, :3], p, axis=1))
+        for i in range(3, 5000, 100):
+            est.update(data[:, i:i + 100])
+        assert np.allclose(est.estimate(), np.quantile(data, p, axis=1),
+                           rtol=0.1)
+
+    # Changing the number of channels resets the estimator
+    est.update(data[:5, 0])
+    assert est.count == 1
+
+
+def test_wl_publish_interval():
+    magpie = create_agent(xdim=8, ydim=8, extra_args=[
+        '--wl-publish-interval', '0'])
+    magpie._process_data(create_data_frame(100))
+    wl_pubs = [c for c in magpie.agent.publish_to_feed.call_args_list
+               if c.args[0] == 'white_noise']
+    assert len(wl_pubs) == 1
+    assert magpie.wl_median.count == 0
+
+    magpie.wl_publish_interval = 1e6
+    magpie._process_data(create_data_frame(100, start=1))
+    assert magpie.wl_median.count == 1
+
+
+def test_monitored_chan_batcher():
+    batcher = MonitoredChanBatcher(flush_interval=10, max_points=30)
+    chans = [(0, 'r0000'), (5, 'in_transition'), (200, 'r0200')]
+    data = np.random.normal(size=(100, 200))
+    blocks, nsamps = [], 0
+    for i in range(3):
+        times = i + np.arange(200) / 200.
+        ds = downsample_monitored_chans(times, data, chans, 10)
+        assert ds[1] == ('r0000', 'in_transition')
+        idxs = np.searchsorted(times, ds[0])
+        assert np.array_equal(ds[2], data[[0, 5]][:, idxs])
+        blocks.extend(batcher.add(*ds, now=i))
+        nsamps += len(ds[0])
+    assert blocks == []
+
+    blocks = batcher.add(*ds, now=10)
+    nsamps += len(ds[0])
+    assert len(blocks) == int(np.ceil(nsamps / 15))
+    for b in blocks:
+        assert b['block_name'] == 'monitored_channels'
+        assert set(b['data']) == {'r0000', 'in_transition'}
+        assert len(b['timestamps']) * 2 <= 30
+    assert sum(len(b['timestamps']) for b in blocks) == nsamps
+    assert batcher.flush() == []
+
+    # Changing the set of channels flushes the old data first
+    batcher.add(*ds, now=11)
+    blocks = batcher.add(*downsample_monitored_chans(times, data, chans[:1], 10),
+                         now=12)
+    assert len(blocks) == 1 and set(blocks[0]['data']) == {'in_transition', 'r0000'}
+
+
+def test_monitored_chans_published():
+    magpie = create_agent(xdim=8, ydim=8, extra_args=[
+        '--monitored-channel-flush-interval', '1e6'])
+    magpie.monitored_channels = [(0, 'r0000'), (1, 'r0001')]
+    for i in range(3):
+        magpie._process_data(create_data_frame(100, start=i))
+    feeds = [c.args[0] for c in magpie.agent.publish_to_feed.call_args_list]
+    assert 'detector_tods' not in feeds
+
+    magpie._publish_tods(magpie.tod_batcher.flush())
+    calls = [c for c in magpie.agent.publish_to_feed.call_args_list
+             if c.args[0] == 'detector_tods']
+    assert len(calls) == 1
+    block = calls[0].args[1]
+    assert len(block['data']['r0001']) == len(block['timestamps']) > 0
+
+
+def test_monitored_chans_flush_loop():
+    magpie = create_agent(xdim=8, ydim=8, extra_args=[
+        '--monitored-channel-flush-interval', '0.2'])
+    clock = task.Clock()
+    magpie.start_tod_flush_loop(clock=clock)
+    magpie.monitored_channels = [(0, 'r0000'), (1, 'r0001')]
+    magpie.tod_batcher.flush()
+    magpie._process_data(create_data_frame(100))
+
+    def tod_calls():
+        return [c for c in magpie.agent.publish_to_feed.call_args_list
+                if c.args[0] == 'detector_tods']
+    assert tod_calls() == []
+
+    # Data is published once the flush interval elapses, with no more frames
+    time.sleep(0.25)
+    clock.advance(0.2)
+    assert len(tod_calls()) == 1
+    assert len(tod_calls()[0].args[1]['timestamps']) > 0
+    clock.advance(0.2)
+    assert len(tod_calls()) == 1
+    magpie.tod_flush_loop.stop()
+
+
+def test_focalplane_from_csv(tmp_path):
+    path = tmp_path / 'detmap.csv'
+    pd.DataFrame({
+        'bandpass': ['150', '90', 'NC', '150', '90'],
+        'pol': ['A', 'B', 'A', ' B', 'A'],
+        'det_x': [0., 1., 2., 3., 4.],
+        'det_y': [0., -1., -2., -3., -4.],
+        'smurf_band': [0, 1, 2, 3, 4],
+        'smurf_channel': [10, 11, 12, -1, 14],
+    }).to_csv(path, index=False)
+
+    fp = FocalplaneConfig.from_csv('test', path, wafer_scale=2, offset=(1, 0))
+    assert fp.names == ['test/det_0', 'test/det_1', 'test/det_4']
+    assert np.array_equal(fp.xs, [1., 3., 9.])
+    assert np.array_equal(fp.rots, [0, np.pi / 2, 0])
+    assert fp.templates == ['template_c0_p0', 'template_c1_p0', 'template_c1_p0']
+    abs_chans = [10, CHANS_PER_BAND + 11, 4 * CHANS_PER_BAND + 14]
+    assert np.array_equal(fp.chan_mask[abs_chans], [0, 1, 2])
+    assert np.sum(fp.chan_mask >= 0) == 3
+
+    # Config frame matches the per-element VisElem info
+    frame = fp.config_frame()
+    eqs, cmaps = [], []
+    for c in fp.channels:
+        eqs.extend(c.eqs)
+        cmaps.extend(c.cmaps)
+    assert list(frame['equations']) == eqs
+    assert list(frame['cmaps']) == cmaps
+    assert len(frame['values']) == 6 * len(fp)
+
+
+def test_focalplane_config_frame_cache():
+    fp = FocalplaneConfig.grid('test', 4, 4)
+    frame = fp.config_frame()
+    assert fp.config_frame() is frame
+    assert len(frame['cname']) == 16
+
+    fp.add_vis_elem('test/extra', 10., 10., 0., 'box', 100)
+    frame = fp.config_frame()
+    assert len(frame['cname']) == 17
+    assert fp.chan_mask[100] == 16
+
+
+def create_ts_frame(t):
+    fr = core.G3Frame(core.G3FrameType.Scan)
+    fr['timestamp'] = core.G3Time(t * core.G3Units.s)
+    return fr
+
+
+def test_pacing_scheduler():
+    sched = PacingScheduler(delay=5, latency_budget=1, batch_interval=0.1)
+    for i in range(10):
+        assert sched.add(create_ts_frame(100 + 0.1 * i), now=0)
+    assert sched.pop_due(4.99) == []
+    assert len(sched.pop_due(5.25)) == 3
+    assert np.isclose(sched.wait_time(5.25), 0.05)
+    assert not sched.wants_frames(5.25)
+    stats = sched.stats()
+    assert stats['pending'] == 7
+    assert np.isclose(stats['send_latency'], 0.15)
+
+    # Frames that are too late are dropped unless they're the newest
+    assert not sched.add(create_ts_frame(101), now=7.5)
+    assert sched.drops == 1
+    assert sched.add(create_ts_frame(101.1), now=7.5, caught_up=True)
+    assert sched.resyncs == 1
+    assert np.isclose(sched.last_send_time, 12.5)
+
+
+def test_send_paced():
+    magpie = create_agent(extra_args=['--delay', '0.2', '--frame-format', 'block'])
+    magpie.send_stats_interval = 0
+    for i in range(5):
+        magpie.out_queue.put(create_ts_frame(100 + 0.05 * i))
+
+    session = mock.MagicMock()
+    session.status = 'running'
+    sent = []
+
+    def process(frame):
+        sent.append((time.monotonic(), frame))
+        if len(sent) == 6:
+            session.status = 'stopping'
+
+    with mock.patch.object(core, 'G3NetworkSender') as sender:
+        sender.return_value.Process.side_effect = process
+        magpie.send(session, {'dest': 0})
+
+    assert sent[0][1].type == core.G3FrameType.Wiring
+    dts = np.diff([t for t, _ in sent[1:]])
+    assert np.all(dts > 0.02)
+    assert session.data['dropped_frames'] == 0
+    feeds = [c.args[0] for c in magpie.agent.publish_to_feed.call_args_list]
+    assert 'send_stats' in feeds
@@ -1,10 +1,16 @@
 import sys
 import os
+import subprocess
+import time
 import numpy as np
+import pytest
+import sqlalchemy
 import txaio
 
 sys.path.insert(0, '../agents/suprsync/')
-from socs.db.suprsync import SupRsyncFilesManager, SupRsyncFileHandler
+from socs.db.suprsync import (SupRsyncFilesManager, SupRsyncFileHandler,
+                              SupRsyncFile, shard_by_size)
+from socs.util import get_md5sum
 
 txaio.use_twisted()
 
@@ -21,7 +27,121 @@ def test_suprsync_files_manager(tmp_path):
     srfm.add_file(str(fpath.absolute()), 'test.txt', 'test')
 
 
-def test_suprsync_handle_files(tmp_path):
+def test_suprsync_file_queries(tmp_path):
+    """
+    Tests the copyable / deletable file filters of the SupRsyncFilesManager.
+    """
+    srfm = SupRsyncFilesManager(tmp_path / 'test.db')
+    now = time.time()
+    files = {
+        # name: (remote_md5sum, failed_copy_attempts, removed, timestamp)
+        'new': (None, 0, None, now),
+        'mismatch': ('bad', 1, None, now - 100),
+        'failed': (None, 5, None, now - 100),
+        'copied_old': ('md5', 0, None, now - 100),
+        'copied_new': ('md5', 0, None, now),
+        'removed': ('md5', 0, now, now - 100),
+    }
+    with srfm.Session.begin() as session:
+        for name, (remote_md5, attempts, removed, ts) in files.items():
+            srfm.add_file(f'/data/{name}', name, 'test', local_md5sum='md5',
+                          timestamp=ts, session=session)
+            f = session.query(SupRsyncFile).filter(
+                SupRsyncFile.local_path == f'/data/{name}').one()
+            f.remote_md5sum = remote_md5
+            f.failed_copy_attempts = attempts
+            f.removed = removed
+        srfm.add_file('/data/other', 'other', 'other', local_md5sum='md5',
+                      session=session)
+
+    session = srfm.Session()
+    copyable = srfm.get_copyable_files('test', session=session,
+                                       max_copy_attempts=5)
+    assert [f.remote_path for f in copyable] == ['new', 'mismatch']
+    copyable = srfm.get_copyable_files('test', session=session, num_files=1)
+    assert [f.remote_path for f in copyable] == ['new']
+    copyable = srfm.get_copyable_files('test', session=session)
+    assert [f.remote_path for f in copyable] == ['new', 'mismatch', 'failed']
+
+    deletable = srfm.get_deletable_files('test', 50, session=session)
+    assert [f.remote_path for f in deletable] == ['copied_old']
+    deletable = srfm.get_deletable_files('test', -10, session=session)
+    assert [f.remote_path for f in deletable] == ['copied_old', 'copied_new']
+
+
+def test_suprsync_create_indexes(tmp_path):
+    """
+    Tests that indexes are added to files tables created without them.
+    """
+    db_path = tmp_path / 'test.db'
+    engine = sqlalchemy.create_engine(f'sqlite:///{db_path}')
+    SupRsyncFile.__table__.create(engine)
+    for index in SupRsyncFile.__table__.indexes:
+        index.drop(engine)
+    table = SupRsyncFile.__tablename__
+    assert sqlalchemy.inspect(engine).get_indexes(table) == []
+
+    srfm = SupRsyncFilesManager(db_path)
+    srfm.add_file('/data/test', 'test', 'test', local_md5sum='md5')
+    indexes = sqlalchemy.inspect(engine).get_indexes(table)
+    assert {ix['name'] for ix in indexes} == \
+        {'ix_supersync_copyable', 'ix_supersync_deletable'}
+    # Opening the db again leaves the existing indexes alone
+    SupRsyncFilesManager(db_path)
+    assert len(srfm.get_copyable_files('test')) == 1
+
+
+@pytest.mark.parametrize('sizes,num_shards', [
+    ([10, 1, 1, 1, 5, 5, 3], 3),
+    ([1] * 10, 4),
+    ([5, 5], 4),
+    ([], 2),
+])
+def test_shard_by_size(sizes, num_shards):
+    shards = shard_by_size(sizes, num_shards)
+    assert sorted(i for shard in shards for i in shard) == list(range(len(sizes)))
+    assert len(shards) == min(num_shards, len(sizes))
+    totals = [sum(sizes[i] for i in shard) for shard in shards]
+    if totals:
+        assert max(totals) - min(totals) <= max(sizes)
+
+
+def test_suprsync_stream_md5sums(tmp_path):
+    """
+    Tests parallel md5sum verification on the "remote"
+    """
+    paths = []
+    for i in range(20):
+        path = tmp_path / f'file {i}.txt'
+        path.write_text(str(i) * 100)
+        paths.append(str(path))
+    missing = str(tmp_path / 'missing.txt')
+
+    handler = SupRsyncFileHandler(None, 'test', str(tmp_path),
+                                  verify_workers=3)
+    md5sums = dict(handler.stream_md5sums(paths + [missing]))
+    assert md5sums == {p: get_md5sum(p) for p in paths}
+
+
+def test_suprsync_stream_md5sums_timeout(tmp_path):
+    # md5sum blocks reading a fifo with no writer
+    fifo = str(tmp_path / 'fifo')
+    os.mkfifo(fifo)
+    handler = SupRsyncFileHandler(None, 'test', str(tmp_path),
+                                  verify_workers=1, cmd_timeout=0.5)
+    with pytest.raises(subprocess.TimeoutExpired):
+        list(handler.stream_md5sums([fifo]))
+
+
+@pytest.mark.parametrize('verify_workers', [0, -1])
+def test_suprsync_invalid_verify_workers(tmp_path, verify_workers):
+    with pytest.raises(ValueError):
+        SupRsyncFileHandler(None, 'test', str(tmp_path),
+                            verify_workers=verify_workers)
+
+
+@pytest.mark.parametrize('num_streams,verify_workers', [(1, None), (4, 2)])
+def test_suprsync_handle_files(tmp_path, num_streams, verify_workers):
     """
     Tests file handling
     """
@@ -57,8 +177,13 @@ def test_suprsync_handle_files(tmp_path):
                   deletable=False)
 
     # This is done in the suprsync run process
-    handler = SupRsyncFileHandler(srfm, 'test', remote_basedir)
-    handler.copy_files()
+    handler = SupRsyncFileHandler(srfm, 'test', remote_basedir,
+                                  num_streams=num_streams,
+                                  verify_workers=verify_workers)
+    stats = handler.copy_files()
+    assert stats['files'] == nfiles + 1
+    assert stats['bytes'] == (nfiles + 1) * os.path.getsize(path)
+    assert stats['failed_shards'] == 0
     handler.delete_files(0)
 
     # Check data path is empty
@@ -66,3 +191,86 @@ def test_suprsync_handle_files(tmp_path):
 
     ncopied = len(os.listdir(os.path.join(remote_basedir, 'test_remote')))
     assert ncopied == nfiles + 1
+
+
+def test_suprsync_failed_shards(tmp_path):
+    """
+    Tests that failed rsync processes count as failed copy attempts
+    """
+    srfm = SupRsyncFilesManager(str(tmp_path / 'test.db'))
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    for i in range(4):
+        path = data_dir / f'{i}.txt'
+        path.write_text('test' * (i + 1))
+        srfm.add_file(str(path), f'{i}.txt', 'test')
+
+    # rsync can't create missing parents of the destination directory
+    remote_basedir = str(tmp_path / 'missing' / 'dest')
+    handler = SupRsyncFileHandler(srfm, 'test', remote_basedir,
+                                  num_streams=2, copy_retries=1)
+    stats = handler.copy_files()
+    assert stats['files'] == 0
+    assert stats['failed_shards'] == 2
+    files = srfm.get_copyable_files('test')
+    assert [f.failed_copy_attempts for f in files] == [1] * 4
+    assert all(f.copied is None for f in files)
+
+
+def test_suprsync_ssh_multiplex(tmp_path):
+    """
+    Tests that ssh commands share a control socket when multiplexing
+    """
+    handler = SupRsyncFileHandler(None, 'test', '/remote', ssh_host='user@host',
+                                  ssh_key='/key', ssh_multiplex=True,
+                                  cmd_timeout=5)
+    cmd = handler._remote_cmd(['md5sum', 'a'])
+    assert cmd[:3] == ['ssh', '-i', '/key']
+    assert cmd[-3:] == ['user@host', 'md5sum', 'a']
+    assert 'ControlMaster=no' in cmd
+    assert not any(c.startswith('ControlPersist=') for c in cmd)
+    control_path = [c for c in cmd if c.startswith('ControlPath=')][0]
+    assert control_path.startswith(f'ControlPath={handler._control_dir}/')
+
+    # Only the master connection persists
+    master = handler._ssh_cmd(master=True)
+    assert 'ControlMaster=yes' in master
+    assert f'ControlPersist={handler.control_persist}' in master
+    assert 'ControlMaster=no' not in master
+    assert control_path in master
+    assert os.path.isdir(handler._control_dir)
+
+    # No master connection is running
+    assert not handler.check_connection()
+    handler.close()
+    assert not os.path.exists(handler._control_dir)
+
+    # Local copies never use ssh
+    handler = SupRsyncFileHandler(None, 'test', '/remote', ssh_multiplex=True)
+    assert handler._remote_cmd(['md5sum', 'a']) == ['md5sum', 'a']
+    assert handler.check_connection()
+    assert handler.ensure_connection()
+    handler.close()
+
+
+def test_suprsync_ensure_connection(monkeypatch):
+    """
+    Tests that the master connection is confirmed after it is started
+    """
+    import socs.db.suprsync as sr
+
+    handler = SupRsyncFileHandler(None, 'test', '/remote', ssh_host='user@host',
+                                  ssh_multiplex=True, cmd_timeout=5)
+    calls = []
+
+    def run(cmd, **kwargs):
+        calls.append((cmd, kwargs))
+        return subprocess.CompletedProcess(cmd, 0)
+
+    monkeypatch.setattr(sr.subprocess, 'run', run)
+    monkeypatch.setattr(handler, 'check_connection', lambda: False)
+    assert not handler.ensure_connection()
+    cmd, kwargs = calls[0]
+    assert 'ControlMaster=yes' in cmd and '-f' in cmd
+    assert kwargs['stderr'] == subprocess.DEVNULL
+    handler.close()
@@ -0,0 +1,161 @@
+"""
+Benchmarks for the ACU agent's scan generation, ProgramTrack formatting, UDP
+broadcast decoding and status processing.
+
+These aren't collected by pytest. Run them directly from the ``tests``
+directory with::
+
+    python benchmarks/bench_acu.py
+"""
+import os
+import sys
+import itertools
+import struct
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../agents/acu/'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../agents/'))
+import scan_helpers as sh
+import broadcast_helpers as bh
+import status_helpers
+from test_acu_broadcast_helpers import FIELDS, FMT, make_datagram
+from test_acu_status_helpers import (load_status, empty_status,
+                                     process_status_loop)
+from test_acu_scan_helpers import (generate_constant_velocity_scan_loop,
+                                   constant_velocity_scanpoints_loop,
+                                   ptstack_format_loop)
+
+
+def bench_scan_generator(npoints=100000, step_time=0.05, batch_size=500,
+                         number=3):
+    """
+    Compares the point-by-point constant-velocity scan generator with the
+    vectorized scan_helpers generator, without ProgramTrack formatting.
+    """
+    print(f"Constant-velocity scan generator ({npoints} points, "
+          f"step_time={step_time})")
+    nbatches = npoints // batch_size
+    args = (120., 160., 1., 4., 55.)
+    kw = dict(start_time=1.6e9, step_time=step_time, batch_size=batch_size)
+
+    def loop():
+        g = generate_constant_velocity_scan_loop(*args, 0., **kw)
+        for _ in itertools.islice(g, nbatches):
+            pass
+
+    def vectorized():
+        g = sh.generate_constant_velocity_scan(*args, 55., 0.,
+                                               ptstack_fmt=False, **kw)
+        for _ in itertools.islice(g, nbatches):
+            pass
+
+    t_loop = timeit.timeit(loop, number=number) / number
+    t_vec = timeit.timeit(vectorized, number=number) / number
+    print(f"  loop {npoints / t_loop:12,.0f} pts/s, vectorized "
+          f"{npoints / t_vec:12,.0f} pts/s ({t_loop / t_vec:.1f}x)")
+
+
+def bench_ptstack_format(npoints=100000, step_time=0.05, number=3):
+    """
+    Compares per-line ProgramTrack formatting with the bulk ptstack_format.
+    """
+    print(f"ProgramTrack formatting ({npoints} points)")
+    cols = next(sh.generate_constant_velocity_scan(
+        120., 160., 1., 4., 55., 55., 0., start_time=1.6e9,
+        step_time=step_time, batch_size=npoints, ptstack_fmt=False))
+
+    t_loop = timeit.timeit(lambda: ptstack_format_loop(*cols),
+                           number=number) / number
+    t_bulk = timeit.timeit(
+        lambda: sh.ptstack_format(*cols, start_offset=0, generator=True),
+        number=number) / number
+    print(f"  per-line {t_loop * 1e3:8.1f} ms ({npoints / t_loop:12,.0f} pts/s), "
+          f"bulk {t_bulk * 1e3:8.1f} ms ({npoints / t_bulk:12,.0f} pts/s)")
+
+
+def bench_cv_scanpoints(ntimes=2000, number=3):
+    """
+    Compares the list-concatenating constant_velocity_scanpoints with the
+    preallocated version.
+    """
+    args = ((120., 160.), 55., 1., 4., ntimes)
+    npoints = len(sh.constant_velocity_scanpoints(*args)[0])
+    print(f"Constant-velocity scan points ({ntimes} legs, {npoints} points)")
+    t_loop = timeit.timeit(lambda: constant_velocity_scanpoints_loop(*args),
+                           number=number) / number
+    t_pre = timeit.timeit(lambda: sh.constant_velocity_scanpoints(*args),
+                          number=number) / number
+    print(f"  lists {t_loop * 1e3:8.1f} ms, preallocated {t_pre * 1e3:8.1f} ms "
+          f"({t_loop / t_pre:.1f}x)")
+
+
+def _decode_loop(data, udp_data):
+    """Per-record struct.unpack decode used before the UDPRingBuffer"""
+    fmt_len = struct.calcsize(FMT)
+    offset = 0
+    while len(data) - offset >= fmt_len:
+        udp_data.append(struct.unpack(FMT, data[offset:offset + fmt_len]))
+        offset += fmt_len
+
+
+def bench_udp_decode(nrecs=10, ndatagrams=2000, number=3):
+    """
+    Compares per-record struct.unpack decoding of broadcast datagrams with
+    decoding into the UDPRingBuffer, including reading the records back out
+    in blocks of 200 and splitting them into per-field columns.
+    """
+    print(f"UDP broadcast decode ({ndatagrams} datagrams x {nrecs} records)")
+    data, _ = make_datagram(FMT, nrecs)
+    ring = bh.UDPRingBuffer(bh.udp_dtype(FMT, FIELDS))
+
+    def loop():
+        udp_data = []
+        for _ in range(ndatagrams):
+            _decode_loop(data, udp_data)
+        while udp_data:
+            process_data = udp_data[:200]
+            udp_data = udp_data[200:]
+            [[d[i] for d in process_data] for i in range(2, len(FIELDS))]
+
+    def buffered():
+        for _ in range(ndatagrams):
+            ring.push(data)
+            if len(ring) >= 200:
+                recs = ring.pop(200)
+                [recs[f].tolist() for f in FIELDS[2:]]
+        ring.pop()
+
+    total = nrecs * ndatagrams
+    t_loop = timeit.timeit(loop, number=number) / number
+    t_ring = timeit.timeit(buffered, number=number) / number
+    print(f"  struct.unpack {total / t_loop:12,.0f} recs/s, ring buffer "
+          f"{total / t_ring:12,.0f} recs/s ({t_loop / t_ring:.1f}x)")
+
+
+def bench_status(number=2000):
+    """
+    Compares the nested key x category status processing with the
+    precompiled StatusFieldMap on a recorded Values response.
+    """
+    monitor_fields, values = load_status()
+    print(f"ACU status processing ({len(values)} keys, "
+          f"{len(monitor_fields)} categories)")
+    status = empty_status(monitor_fields)
+    field_map = status_helpers.StatusFieldMap(monitor_fields)
+    influx = {}
+
+    t_loop = timeit.timeit(
+        lambda: process_status_loop(values, monitor_fields, status),
+        number=number) / number
+    t_map = timeit.timeit(
+        lambda: field_map.apply(values, status, influx),
+        number=number) / number
+    print(f"  nested loop {t_loop * 1e6:8.1f} us, field map "
+          f"{t_map * 1e6:8.1f} us ({t_loop / t_map:.1f}x)")
+
+
+if __name__ == '__main__':
+    bench_scan_generator()
+    bench_ptstack_format()
+    bench_cv_scanpoints()
+    bench_udp_decode()
+    bench_status()
@@ -0,0 +1,221 @@
+"""
+Benchmarks for the ACU agent's monitor, broadcast and upload paths, run
+against the ACU simulator over real HTTP and UDP sockets on localhost.
+
+The agent itself needs soaculib and a crossbar server, so these drive the
+same helpers the agent uses (StatusFieldMap, UDPRingBuffer,
+BroadcastBatcher and ProgramTrackUploader) with a plain twisted HTTP client.
+
+These aren't collected by pytest. Run them directly from the ``tests``
+directory with::
+
+    python benchmarks/bench_acu_sim.py
+"""
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from urllib.parse import urlencode
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../agents/acu/'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../simulators/acu/'))
+import acu_simulator as sim
+import broadcast_helpers as bh
+import scan_helpers as sh
+import status_helpers
+import upload_helpers as uh
+
+import numpy as np
+from twisted.internet import protocol, reactor, task
+from twisted.internet.defer import inlineCallbacks
+from twisted.web import server
+from twisted.web.client import Agent, FileBodyProducer, readBody
+
+STATUS_FILE = os.path.join(os.path.dirname(__file__), '../agents/data/',
+                           'acu_status_satp.json')
+
+
+class ACUClient:
+    """Minimal HTTP client for the simulator's ACU interface"""
+
+    def __init__(self, port):
+        self.url = f'http://127.0.0.1:{port}/'
+        self.agent = Agent(reactor)
+
+    @inlineCallbacks
+    def get(self, endpoint, body=None, **params):
+        url = self.url + endpoint
+        if params:
+            url += '?' + urlencode(params)
+        producer = None if body is None else FileBodyProducer(io.BytesIO(body))
+        resp = yield self.agent.request(b'GET' if body is None else b'POST',
+                                        url.encode(), None, producer)
+        content = yield readBody(resp)
+        if resp.code != 200:
+            raise RuntimeError(content.decode())
+        return content
+
+    @inlineCallbacks
+    def values(self):
+        content = yield self.get('Values',
+                                 identifier='DataSets.StatusSATPDetailed8100')
+        return json.loads(content)
+
+    def upload(self, text):
+        return self.get('UploadPtStack', body=text.encode(), Type='FileUpload')
+
+
+@inlineCallbacks
+def bench_monitor(client, monitor_fields, duration=5.):
+    """
+    Polls Values as fast as possible, processing each response with the
+    StatusFieldMap, as the agent's monitor process does.
+    """
+    print(f"Monitor ({duration:.0f} s, no minimum query period)")
+    field_map = status_helpers.StatusFieldMap(monitor_fields)
+    status = {category: {} for category in monitor_fields}
+    influx = {}
+    n, t_proc = 0, 0.
+    t0 = time.time()
+    while time.time() - t0 < duration:
+        values = yield client.values()
+        t = time.perf_counter()
+        field_map.apply(values, status, influx)
+        t_proc += time.perf_counter() - t
+        n += 1
+    elapsed = time.time() - t0
+    print(f"  {n / elapsed:8.1f} responses/s, {elapsed / n * 1e3:6.2f} ms per "
+          f"query, {t_proc / n * 1e6:6.1f} us processing")
+
+
+class _Receiver(protocol.DatagramProtocol):
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.t_decode = 0.
+
+    def datagramReceived(self, data, addr):
+        t = time.perf_counter()
+        self.ring.push(data)
+        self.t_decode += time.perf_counter() - t
+
+
+@inlineCallbacks
+def bench_broadcast(state, rates=(200., 2000., 20000.), samples_per_packet=10,
+                    duration=3.):
+    """
+    Sends UDP broadcasts from the simulator at several rates and decodes
+    them with the UDPRingBuffer and BroadcastBatcher, as the agent's
+    broadcast process does.
+    """
+    print(f"Broadcast decode ({duration:.0f} s per rate)")
+    schema = sim.DEFAULT_SCHEMA
+    fields = schema['fields']
+    for rate in rates:
+        # Keep datagrams at no more than 200 Hz, as the ACU does
+        nper = max(samples_per_packet, int(rate / 200))
+        ring = bh.UDPRingBuffer(bh.udp_dtype(schema['format'], fields))
+        batcher = bh.BroadcastBatcher(fields)
+        receiver = _Receiver(ring)
+        port = reactor.listenUDP(0, receiver, interface='127.0.0.1')
+        bc = sim.UDPBroadcaster(state, ('127.0.0.1', port.getHost().port),
+                                schema=schema, sample_rate=rate,
+                                samples_per_packet=nper)
+        bc.start()
+        n, nblocks, t_proc = 0, 0, 0.
+        t0 = time.time()
+        while time.time() - t0 < duration:
+            yield task.deferLater(reactor, 0.005, lambda: None)
+            t = time.perf_counter()
+            recs = ring.pop(200)
+            if len(recs):
+                ctimes = bh.udp_ctimes(recs, fields, 0.)
+                nblocks += len(batcher.add(ctimes, recs))
+            t_proc += time.perf_counter() - t
+            n += len(recs)
+        bc.stop()
+        # Let datagrams still in flight reach the ring buffer
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        port.stopListening()
+        backlog = len(ring)
+        # Records sent but never decoded or buffered were lost in the socket
+        # (or by the ring buffer overflowing, which is counted separately)
+        lost = bc.n_records - n - backlog
+        print(f"  rate {rate:8.0f} Hz x {nper:3d}/datagram: sent {bc.n_records:7d}, decoded "
+              f"{n:7d} ({n / duration:9,.0f} recs/s), {nblocks:3d} blocks, "
+              f"backlog {backlog}, lost {lost} ({lost / max(bc.n_records, 1):.1%}), "
+              f"ring overflow {ring.dropped}, "
+              f"{(receiver.t_decode + t_proc) / max(n, 1) * 1e6:5.2f} us/rec")
+
+
+@inlineCallbacks
+def bench_upload(client, state, npoints=240, step_time=0.05, group_size=120):
+    """
+    Streams a scan to the simulator's ProgramTrack stack with the
+    ProgramTrackUploader, polling free positions at 20 Hz like the monitor
+    process.
+    """
+    ngroups = int(np.ceil(npoints / group_size))
+    print(f"ProgramTrack upload ({ngroups * group_size} points, "
+          f"step_time={step_time}, groups of {group_size})")
+    yield client.get('Command', identifier='DataSets.CmdModeTransfer',
+                     command='Set Modes', param1='ProgramTrack',
+                     param2='ProgramTrack')
+    report = [state.free_positions, 0.]
+    running = [True]
+
+    @inlineCallbacks
+    def poll():
+        while running[0]:
+            t = time.time()
+            values = yield client.values()
+            report[:] = [values['Qty of free program track stack positions'], t]
+            yield task.deferLater(reactor, 0.05, lambda: None)
+    polling = poll()
+
+    # num_batches would reset the batch size to one scan leg, so the number
+    # of groups is limited here instead
+    g = sh.generate_constant_velocity_scan(
+        120., 130., 1., 4., 50., 50., 0., start_time=time.time() + 1.,
+        step_time=step_time, batch_size=group_size)
+    uploader = uh.ProgramTrackUploader(client.upload, lambda: tuple(report),
+                                       min_free=9899, poll_interval=0.02)
+    stats = []
+    t0 = time.time()
+    groups = itertools.islice(uh.line_groups(g, group_size), ngroups)
+    nlines = yield uploader.run(groups,
+                                on_upload=lambda b, s: stats.append(dict(s)))
+    elapsed = time.time() - t0
+    running[0] = False
+    yield polling
+
+    latency = np.array([s['upload_latency'] for s in stats]) * 1e3
+    lag = np.array([s['upload_lag'] for s in stats]) * 1e3
+    fill = np.array([s['stack_fill'] for s in stats])
+    print(f"  {nlines} lines in {len(stats)} uploads over {elapsed:.1f} s, "
+          f"max stack fill {fill.max()}")
+    print(f"  upload latency mean {latency.mean():6.2f} ms, max "
+          f"{latency.max():6.2f} ms; upload lag mean {lag.mean():6.2f} ms, "
+          f"max {lag.max():6.2f} ms")
+
+
+@inlineCallbacks
+def main():
+    try:
+        with open(STATUS_FILE) as f:
+            d = json.load(f)
+        state = sim.ACUState(status=d['values'])
+        site = reactor.listenTCP(0, server.Site(sim.ACUResource(state)),
+                                 interface='127.0.0.1')
+        client = ACUClient(site.getHost().port)
+        yield bench_monitor(client, d['monitor_fields'])
+        yield bench_broadcast(state)
+        yield bench_upload(client, state)
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
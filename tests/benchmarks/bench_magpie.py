@@ -0,0 +1,198 @@
+"""
+Benchmarks for the magpie agent's per-frame processing.
+
+These aren't collected by pytest. Run them directly from the ``tests``
+directory with::
+
+    python benchmarks/bench_magpie.py
+"""
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../agents/magpie/'))
+from magpie_agent import (FocalplaneConfig, MAX_CHANS, Demodulator,
+                          WhiteNoiseCalculator, DemodNoiseEngine, pA_per_rad,
+                          FrameDecoder, P2Quantile)
+
+import numpy as np
+import so3g
+from spt3g import core
+
+
+def _scatter_loop(mask, chan_mask, nelems, data, sample_idxs):
+    """Per-channel scatter used by magpie before the vectorized index map"""
+    abs_chans = mask[np.arange(len(data))]
+    out = np.zeros((len(sample_idxs), nelems))
+    for i, c in enumerate(abs_chans):
+        if c >= len(chan_mask):
+            continue
+        idx = chan_mask[c]
+        if idx >= 0:
+            out[:, idx] = data[i, sample_idxs]
+    return out
+
+
+def _scatter_vec(readout_chans, elem_idxs, nelems, data, sample_idxs):
+    """Vectorized scatter using a precomputed index map"""
+    out = np.zeros((len(sample_idxs), nelems))
+    out[:, elem_idxs] = data[np.ix_(readout_chans, sample_idxs)].T
+    return out
+
+
+def bench_scatter(nchans_list=(1024, 2048, 4096), nsamps=200, ds_factor=10,
+                  number=20):
+    """
+    Compares the per-channel scatter loop with the vectorized index map for
+    a single frame.
+    """
+    print("Channel scatter (3 outputs per frame)")
+    fp = FocalplaneConfig.grid('bench', 64, 64)
+    nelems = len(fp)
+    sample_idxs = np.arange(0, nsamps, ds_factor)
+    for nchans in nchans_list:
+        mask = np.random.permutation(MAX_CHANS)
+        data = np.random.normal(size=(nchans, nsamps))
+
+        abs_chans = mask[np.arange(nchans)]
+        elem_idxs = fp.chan_mask[abs_chans]
+        readout_chans = np.where(elem_idxs >= 0)[0]
+        elem_idxs = elem_idxs[readout_chans]
+
+        assert np.array_equal(
+            _scatter_loop(mask, fp.chan_mask, nelems, data, sample_idxs),
+            _scatter_vec(readout_chans, elem_idxs, nelems, data, sample_idxs)
+        )
+
+        t_loop = timeit.timeit(
+            lambda: _scatter_loop(mask, fp.chan_mask, nelems, data, sample_idxs),
+            number=number) / number * 3
+        t_vec = timeit.timeit(
+            lambda: _scatter_vec(readout_chans, elem_idxs, nelems, data, sample_idxs),
+            number=number) / number * 3
+        print(f"  nchans={nchans:>5}: loop {t_loop * 1e3:8.3f} ms, "
+              f"vectorized {t_vec * 1e3:8.3f} ms ({t_loop / t_vec:.1f}x)")
+
+
+def bench_dsp(nchans=4096, nsamps=200, fs=200., ds_factor=10, number=5):
+    """
+    Compares the separate Demodulator / WhiteNoiseCalculator passes with the
+    fused DemodNoiseEngine for a single frame, with and without only
+    evaluating the output at the downsampled indices.
+    """
+    print(f"Demod + white noise ({nchans} chans x {nsamps} samps)")
+    times = np.arange(nsamps) / fs
+    data = np.random.normal(size=(nchans, nsamps))
+
+    demod = Demodulator(8, 0.5, fs=fs)
+    wncalc = WhiteNoiseCalculator(fs=fs, navg=int(fs))
+    engine = DemodNoiseEngine(8, 0.5, fs=fs, navg=int(fs), wl_scale=pA_per_rad)
+
+    def separate():
+        demod.apply(times, data)
+        wncalc.apply(data * pA_per_rad)
+
+    def fused():
+        engine.demod(times, data)
+        engine.white_noise(data)
+
+    idxs = np.arange(0, nsamps, ds_factor)
+
+    def fused_ds():
+        engine.demod(times, data, idxs=idxs)
+        engine.white_noise(data, idxs=idxs)
+
+    t_sep = timeit.timeit(separate, number=number) / number
+    t_fused = timeit.timeit(fused, number=number) / number
+    t_ds = timeit.timeit(fused_ds, number=number) / number
+    print(f"  separate {t_sep * 1e3:8.1f} ms, fused {t_fused * 1e3:8.1f} ms "
+          f"({t_sep / t_fused:.1f}x), fused + decimated {t_ds * 1e3:8.1f} ms "
+          f"({t_sep / t_ds:.1f}x)")
+
+
+def _decode_copy(frame):
+    """Per-frame allocating decode used by magpie before the FrameDecoder"""
+    primary = frame['primary']
+    primary_idxs = {name: i for i, name in enumerate(primary.names)}
+    times = np.array(primary.data[primary_idxs['UnixTime']]) / 1e9
+    d = frame['data']
+    if isinstance(d, core.G3TimestreamMap):
+        nchans, nsamps = len(d), d.n_samples
+        data = np.ndarray((nchans, nsamps), dtype=np.float32)
+        for i in range(nchans):
+            data[i] = d[f'r{i:0>4}'] * (2 * np.pi) / 2**16
+    else:
+        data = d.data * (2 * np.pi) / 2**16
+    return times, data
+
+
+def _make_frames(nchans, nsamps, fs=200.):
+    """Builds a G3SuperTimestream frame and the G3TimestreamMap equivalent"""
+    times = np.arange(nsamps) / fs
+    g3times = core.G3VectorTime(times * core.G3Units.s)
+    names = [f'r{ch:0>4}' for ch in range(nchans)]
+    data = np.random.randint(1, 2**15, (nchans, nsamps), dtype=np.int32)
+    primary = so3g.G3SuperTimestream(
+        ['UnixTime'], g3times, (times[None, :] * 1e9).astype(np.int64))
+
+    sts = core.G3Frame(core.G3FrameType.Scan)
+    sts['data'] = so3g.G3SuperTimestream(names, g3times, data)
+    sts['primary'] = primary
+
+    tsm = core.G3TimestreamMap()
+    for name, d in zip(names, data):
+        tsm[name] = core.G3Timestream(d.astype(float))
+    tsm.start, tsm.stop = g3times[0], g3times[-1]
+    tsm_frame = core.G3Frame(core.G3FrameType.Scan)
+    tsm_frame['data'] = tsm
+    tsm_frame['primary'] = primary
+    return sts, tsm_frame
+
+
+def bench_decode(nchans_list=(1024, 4096), nsamps=200, number=20):
+    """
+    Compares the allocating per-frame decode with the buffer-reusing
+    FrameDecoder for both G3SuperTimestream and G3TimestreamMap data.
+    """
+    print(f"Frame decode ({nsamps} samps)")
+    for nchans in nchans_list:
+        for label, frame in zip(['SuperTimestream', 'TimestreamMap'],
+                                _make_frames(nchans, nsamps)):
+            decoder = FrameDecoder()
+            assert np.allclose(_decode_copy(frame)[1], decoder.decode(frame)[1])
+            t_copy = timeit.timeit(lambda: _decode_copy(frame),
+                                   number=number) / number
+            t_dec = timeit.timeit(lambda: decoder.decode(frame),
+                                  number=number) / number
+            print(f"  nchans={nchans:>5} {label:>15}: copy {t_copy * 1e3:8.3f} ms, "
+                  f"decoder {t_dec * 1e3:8.3f} ms ({t_copy / t_dec:.1f}x)")
+
+
+def bench_wl_quantiles(nchans=4096, nsamps_list=(20, 200), number=20):
+    """
+    Compares the per-frame median and white-noise quantile calculation with
+    updating the streaming P2Quantile median estimator for a single frame.
+    """
+    print(f"White-noise quantiles ({nchans} chans)")
+    quantiles = np.array([15, 25, 50, 75, 85]) / 100
+    for nsamps in nsamps_list:
+        wl = np.random.lognormal(3, 1, (nchans, nsamps)).astype(np.float32)
+        est = P2Quantile(0.5)
+        est.update(np.random.lognormal(3, 1, (nchans, 5)))
+
+        def per_frame():
+            wls = np.median(wl, axis=1)
+            for q in quantiles:
+                np.quantile(wls, q)
+
+        t_frame = timeit.timeit(per_frame, number=number) / number
+        t_p2 = timeit.timeit(lambda: est.update(wl[:, -1]),
+                             number=number) / number
+        print(f"  nsamps={nsamps:>4}: median + quantiles {t_frame * 1e3:8.3f} ms, "
+              f"P2 update {t_p2 * 1e3:8.3f} ms ({t_frame / t_p2:.1f}x)")
+
+
+if __name__ == '__main__':
+    bench_scatter()
+    bench_dsp()
+    bench_decode()
+    bench_wl_quantiles()
@@ -0,0 +1,93 @@
+import sys
+sys.path.insert(0, '../simulators/acu/')
+sys.path.insert(0, '../agents/acu/')
+import acu_simulator as sim
+import broadcast_helpers as bh
+import scan_helpers as sh
+
+import io
+import json
+import numpy as np
+import pytest
+from twisted.internet import task
+from twisted.web.test.requesthelper import DummyRequest
+
+
+def request(resource, path, args=None, body=b''):
+    req = DummyRequest(path.encode().split(b'/'))
+    req.path = b'/' + path.encode()
+    req.args = {k.encode(): [v.encode()] for k, v in (args or {}).items()}
+    req.content = io.BytesIO(body)
+    return resource.render(req), req
+
+
+@pytest.fixture
+def acu():
+    clock = task.Clock()
+    clock.advance(1.6e9)
+    state = sim.ACUState(az=120., el=50.)
+    return clock, state, sim.ACUResource(state, clock=clock)
+
+
+def test_values(acu):
+    clock, state, resource = acu
+    body, _ = request(resource, 'Values',
+                      {'identifier': 'DataSets.StatusSATPDetailed8100'})
+    values = json.loads(body)
+    assert values['Azimuth current position'] == 120.
+    assert values['Qty of free program track stack positions'] == 9999
+    # 2020-09-13 12:26:40 UTC
+    assert values['Year'] == 2020
+    assert values['Time'] == pytest.approx(257 + (12 * 3600 + 26 * 60 + 40) / 86400)
+
+
+def test_program_track(acu):
+    clock, state, resource = acu
+    request(resource, 'Command', {'identifier': 'DataSets.CmdModeTransfer',
+                                  'command': 'Set Modes',
+                                  'param1': 'ProgramTrack',
+                                  'param2': 'ProgramTrack'})
+    assert state.modes['Azimuth'] == 'ProgramTrack'
+
+    times, azs, els, vas, ves, azflags, elflags = \
+        sh.constant_velocity_scanpoints((120., 130.), 50., 1., 4., 2)
+    start = clock.seconds() + 1.
+    lines = sh.ptstack_format(times, azs, els, vas, ves, azflags, elflags,
+                              start_offset=start, generator=True)
+    _, req = request(resource, 'UploadPtStack', {'Type': 'FileUpload'},
+                     ''.join(lines[:100]).encode())
+    assert req.responseCode in (None, 200)
+    assert state.free_positions == 9999 - 100
+
+    clock.advance(2.)
+    done = np.sum(np.asarray(times[:100]) + start <= clock.seconds())
+    values = json.loads(request(resource, 'Values')[0])
+    assert values['Qty of free program track stack positions'] == 9999 - 100 + done
+    assert values['Azimuth current position'] == pytest.approx(azs[done - 1], abs=1e-6)
+
+    # Overflowing the stack is rejected
+    state.stack_size = 150
+    _, req = request(resource, 'UploadPtStack', {},
+                     ''.join(lines[100:200]).encode())
+    assert req.responseCode == 400
+    assert len(state.stack) == 100 - done
+
+
+def test_broadcast_packets(acu):
+    clock, state, resource = acu
+    schema = sim.DEFAULT_SCHEMA
+    bc = sim.UDPBroadcaster(state, ('127.0.0.1', 0), schema=schema,
+                            sample_rate=200., samples_per_packet=10,
+                            clock=clock)
+    fields = schema['fields']
+    dtype = bh.udp_dtype(schema['format'], fields)
+    ring = bh.UDPRingBuffer(dtype)
+    for _ in range(5):
+        ring.push(bc.packet())
+        clock.advance(0.05)
+    recs = ring.pop()
+    assert len(recs) == 50
+    ctimes = bh.udp_ctimes(recs, fields, 1577836800.)  # 2020-01-01
+    assert np.allclose(np.diff(ctimes), 0.005, rtol=0, atol=1e-6)
+    assert ctimes[-1] == pytest.approx(clock.seconds() - 0.05, abs=1e-6)
+    assert np.all(recs['Corrected_Azimuth'] == 120.)
@@ -1 +1,32 @@
-from socs import util  # noqa: F401
+import hashlib
+
+import pytest
+
+from socs import util
+
+
+@pytest.mark.parametrize('size', [0, 10, 2**20, 3 * 2**20 + 17])
+@pytest.mark.parametrize('file_digest', [True, False])
+def test_get_md5sum(tmp_path, monkeypatch, size, file_digest):
+    if not file_digest:
+        monkeypatch.delattr(hashlib, 'file_digest', raising=False)
+    data = bytes(range(256)) * (size // 256) + b'\n' * (size % 256)
+    path = tmp_path / 'test.g3'
+    path.write_bytes(data)
+    assert util.get_md5sum(str(path), chunk_size=4096) == \
+        hashlib.md5(data).hexdigest()
+
+
+def test_get_md5sums(tmp_path):
+    paths = []
+    for i in range(10):
+        path = tmp_path / f'{i}.txt'
+        path.write_text(str(i) * 1000)
+        paths.append(str(path))
+    missing = str(tmp_path / 'missing.txt')
+
+    md5sums = util.get_md5sums(paths + [missing, paths[0]])
+    assert list(md5sums) == paths
+    for path in paths:
+        assert md5sums[path] == util.get_md5sum(path)
+    assert util.get_md5sums([]) == {}